@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Size / speed / sampled quality of the efficiency codec profiles against desktop_mp4
+(flags mirror CommandGenerate for each profile in default_encode_profiles.json)
+
+Sources are a 'busy' synthetic clip and a synthetic lecture slide, plus any
+--sample files (e.g. real lecture captures). Quality is SSIM / PSNR against the
+scaled source on every --sample-every'th frame.
+
+Usage:
+    python scripts/benchmark_codecs.py --duration 30 --sample /path/to/lecture.mp4
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+from benchmark_utils import synthetic_source, run_timed, megabytes, print_table
+
+PROFILES = [
+    ('desktop_mp4 (x264 slow crf27)', ['-c:v', 'libx264', '-crf', '27', '-preset', 'slow']),
+    ('desktop_hevc (x265 medium crf28)', ['-c:v', 'libx265', '-crf', '28', '-tag:v', 'hvc1', '-preset', 'medium']),
+    ('x265 fast crf28', ['-c:v', 'libx265', '-crf', '28', '-tag:v', 'hvc1', '-preset', 'fast']),
+    ('desktop_av1 (svt-av1 p8 crf35)', ['-c:v', 'libsvtav1', '-crf', '35', '-pix_fmt', 'yuv420p', '-preset', '8']),
+    ('svt-av1 p10 crf35', ['-c:v', 'libsvtav1', '-crf', '35', '-pix_fmt', 'yuv420p', '-preset', '10']),
+]
+
+
+def available_encoders(ffmpeg):
+    output = subprocess.check_output([ffmpeg, '-hide_banner', '-encoders'], universal_newlines=True)
+    return set(line.split()[1] for line in output.splitlines() if len(line.split()) > 1)
+
+
+def quality(ffmpeg, encoded, source, height, sample_every):
+    """
+    Sampled SSIM (All) and PSNR (average) of encoded vs. source scaled to the encode size
+    """
+    select = "select='not(mod(n\\,{0}))',setpts=N/TB".format(sample_every)
+    graph = '[0:v]{select}[enc];[1:v]scale=-2:{height},{select}[ref];' \
+            '[enc]split[e1][e2];[ref]split[r1][r2];[e1][r1]ssim;[e2][r2]psnr'.format(select=select, height=height)
+    output = subprocess.run(
+        [ffmpeg, '-hide_banner', '-i', encoded, '-i', source, '-lavfi', graph, '-f', 'null', '-'],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True
+    ).stdout
+    ssim = re.search(r'All:([\d.]+)', output)
+    psnr = re.search(r'average:([\d.]+|inf)', output)
+    return (float(ssim.group(1)) if ssim else None, float(psnr.group(1)) if psnr else None)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=int, default=20, help='synthetic source seconds')
+    parser.add_argument('--height', type=int, default=720, help='profile resolution')
+    parser.add_argument('--sample', action='append', default=[], help='extra source file(s)')
+    parser.add_argument('--sample-every', type=int, default=10, help='quality on every Nth frame')
+    parser.add_argument('--workdir', default=os.getcwd())
+    parser.add_argument('--ffmpeg', default='ffmpeg')
+    args = parser.parse_args()
+
+    sources = [
+        ('synthetic', synthetic_source(
+            os.path.join(args.workdir, 'bench_source_{0}s_1080.mp4'.format(args.duration)),
+            args.duration, size='1920x1080', ffmpeg=args.ffmpeg)),
+        ('lecture', synthetic_source(
+            os.path.join(args.workdir, 'bench_lecture_{0}s_1080.mp4'.format(args.duration)),
+            args.duration, size='1920x1080', ffmpeg=args.ffmpeg, lecture=True)),
+    ] + [(os.path.basename(sample), sample) for sample in args.sample]
+
+    encoders = available_encoders(args.ffmpeg)
+    output = os.path.join(args.workdir, 'bench_output.mp4')
+
+    rows = []
+    for source_name, source in sources:
+        baseline = None
+        for profile_name, flags in PROFILES:
+            if flags[1] not in encoders:
+                rows.append([source_name, profile_name, 'n/a ({0} not built in)'.format(flags[1]), '', '', '', '', ''])
+                continue
+            command = [args.ffmpeg, '-hide_banner', '-y', '-i', source, '-vf', 'scale=-2:{0}'.format(args.height)] + \
+                flags + ['-c:a', 'aac', '-movflags', 'faststart', output]
+            result = run_timed(command)
+            size = os.stat(output).st_size
+            ssim, psnr = quality(args.ffmpeg, output, source, args.height, args.sample_every)
+            baseline = baseline or (result['cpu'], size)
+            rows.append([
+                source_name, profile_name,
+                '%.1f' % result['wall'],
+                '%.1f' % result['cpu'],
+                '%.2f' % (result['cpu'] / baseline[0]),
+                '%.2f' % megabytes(size),
+                '%.2f' % (float(size) / baseline[1]),
+                '%.4f / %.2f' % (ssim or 0, psnr or 0),
+            ])
+            os.remove(output)
+
+    print_table(
+        ['source', 'profile', 'wall_s', 'cpu_s', 'cpu_vs_x264', 'output_MB', 'size_vs_x264', 'ssim / psnr'],
+        rows
+    )
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Media engines: ffmpeg/ffprobe subprocesses (cli) vs in process libav (pyav)
+for the probe, thumbnail and short clip encode workloads (see video_worker/engines.py)
+
+Usage:
+    python scripts/benchmark_engines.py --duration 120 --probes 50 --clip 5
+"""
+
+import argparse
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark_utils import synthetic_source, best_of, print_table
+from video_worker.engines import CLIEngine, PyAVEngine, av
+
+
+def run_calls(calls):
+    """
+    Wall / cpu seconds (this process and its children) to make every call in `calls`
+    """
+    before_self = resource.getrusage(resource.RUSAGE_SELF)
+    before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    for func, args in calls:
+        if not func(*args):
+            raise RuntimeError('{0} failed'.format(func.__name__))
+    wall = time.time() - start
+    after_self = resource.getrusage(resource.RUSAGE_SELF)
+    after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = sum(
+        (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+        for before, after in ((before_self, after_self), (before_children, after_children))
+    )
+    return {'wall': wall, 'cpu': cpu}
+
+
+def workloads(engine, source, workdir, args):
+    positions = [args.duration * fraction for fraction in (0.1, 0.4, 0.7)]
+    return [
+        ('probe', args.probes, [(engine.probe, (source,))] * args.probes),
+        ('thumbnail', len(positions), [
+            (engine.extract_frame, (source, position, os.path.join(workdir, 'bench_frame.png'), 1280, 720))
+            for position in positions
+        ]),
+        ('clip encode', 1, [
+            (engine.encode_clip, (source, os.path.join(workdir, 'bench_clip.mp4'), args.clip, 360, 30, 'veryfast'))
+        ]),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=int, default=60, help='source seconds')
+    parser.add_argument('--size', default='1280x720')
+    parser.add_argument('--probes', type=int, default=50, help='probe calls per run')
+    parser.add_argument('--clip', type=int, default=5, help='clip encode seconds')
+    parser.add_argument('--workdir', default=os.getcwd())
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--ffmpeg', default='ffmpeg')
+    parser.add_argument('--ffprobe', default='ffprobe')
+    args = parser.parse_args()
+
+    source = synthetic_source(
+        os.path.join(args.workdir, 'bench_source_{0}s.mp4'.format(args.duration)),
+        args.duration, size=args.size, ffmpeg=args.ffmpeg
+    )
+    engines = [CLIEngine(settings={'ffmpeg_compiled': args.ffmpeg, 'ffprobe_compiled': args.ffprobe})]
+    if av is not None:
+        engines.append(PyAVEngine())
+    else:
+        print('PyAV is not installed (pip install av), cli only')
+
+    rows = []
+    baselines = {}
+    for engine in engines:
+        for name, count, calls in workloads(engine, source, args.workdir, args):
+            result = best_of(args.repeat, run_calls, calls)
+            baselines.setdefault(name, result['wall'])
+            rows.append([
+                name,
+                engine.name,
+                '%.1f' % (result['wall'] * 1000 / count),
+                '%.1f' % (count / result['wall']),
+                '%.1f' % (result['cpu'] * 1000 / count),
+                '%.2f' % (baselines[name] / result['wall']),
+            ])
+
+    for leftover in ('bench_frame.png', 'bench_clip.mp4'):
+        if os.path.exists(os.path.join(args.workdir, leftover)):
+            os.remove(os.path.join(args.workdir, leftover))
+
+    print_table(['workload', 'engine', 'ms_per_call', 'calls_per_s', 'cpu_ms_per_call', 'speedup_vs_cli'], rows)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Output I/O and wall time of the mp4 moov placement modes (see CommandGenerate._moov)
+
+    faststart   moov written last, then the whole output is re-read and rewritten
+    reserved    moov space reserved up front (-moov_size), single pass
+    fragmented  fragmented mp4, single pass
+
+Usage:
+    python scripts/benchmark_mp4_output.py --duration 600 --workdir /mnt/scratch
+
+I/O is the ffmpeg child's syscall read/write byte count (/proc/<pid>/io, Linux only).
+"""
+
+import argparse
+import os
+import sys
+
+from benchmark_utils import synthetic_source, run_timed, best_of, megabytes, print_table
+
+# mirrors video_worker.global_vars MOOV_* (kept standalone, the package needs its full environment)
+MOOV_SAMPLES_PER_SECOND = 60 + 50
+MOOV_BYTES_PER_SAMPLE = 24
+MOOV_HEADROOM = 65536
+
+MODES = {
+    'faststart': ['-movflags', 'faststart'],
+    'reserved': None,
+    'fragmented': ['-movflags', 'frag_keyframe+empty_moov+default_base_moof'],
+}
+
+
+def mode_flags(mode, duration):
+    if mode == 'reserved':
+        return ['-moov_size', str(int(duration * MOOV_SAMPLES_PER_SECOND * MOOV_BYTES_PER_SAMPLE) + MOOV_HEADROOM)]
+    return MODES[mode]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=int, default=300, help='source seconds')
+    parser.add_argument('--size', default='1280x720')
+    parser.add_argument('--workdir', default=os.getcwd())
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--ffmpeg', default='ffmpeg')
+    args = parser.parse_args()
+
+    source = synthetic_source(
+        os.path.join(args.workdir, 'bench_source_{0}s.mp4'.format(args.duration)),
+        args.duration, size=args.size, ffmpeg=args.ffmpeg
+    )
+    output = os.path.join(args.workdir, 'bench_output.mp4')
+
+    workloads = {
+        # remux is where the second pass dominates
+        'remux': ['-c', 'copy'],
+        'encode': ['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23', '-c:a', 'copy'],
+    }
+
+    rows = []
+    for workload, codec_flags in sorted(workloads.items()):
+        for mode in ('faststart', 'reserved', 'fragmented'):
+            command = [args.ffmpeg, '-hide_banner', '-y', '-i', source] + codec_flags + \
+                mode_flags(mode, args.duration) + ['-write_tmcd', 'off', output]
+            result = best_of(args.repeat, run_timed, command)
+            size = os.stat(output).st_size
+            rows.append([
+                workload, mode,
+                '%.2f' % result['wall'],
+                '%.1f' % megabytes(size),
+                '%.1f' % megabytes(result['read_bytes']),
+                '%.1f' % megabytes(result['write_bytes']),
+                '%.2f' % (float(result['write_bytes']) / size),
+            ])
+            os.remove(output)
+
+    print_table(['workload', 'mode', 'wall_s', 'output_MB', 'read_MB', 'written_MB', 'written/output'], rows)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Product validation backends for mp4: the box reader (video_worker/mp4.py) vs a json ffprobe
+(video_worker/probe.py), per moov placement mode
+
+Usage:
+    python scripts/benchmark_mp4_reader.py --duration 600 --calls 200
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark_utils import synthetic_source, print_table
+from video_worker.mp4 import read_mp4
+from video_worker.probe import ffprobe
+
+MODES = {
+    'moov_last': [],
+    'faststart': ['-movflags', 'faststart'],
+    'fragmented': ['-movflags', 'frag_keyframe+default_base_moof'],
+}
+
+
+def per_call(calls, func, *args):
+    """
+    Best of three: mean wall seconds per call of func(*args)
+    """
+    timings = []
+    for _ in range(3):
+        start = time.time()
+        for _ in range(calls):
+            if func(*args) is None:
+                raise RuntimeError('{0} could not read {1}'.format(func.__name__, args[0]))
+        timings.append((time.time() - start) / calls)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=int, default=120, help='source seconds')
+    parser.add_argument('--calls', type=int, default=100, help='calls per backend and mode')
+    parser.add_argument('--workdir', default=os.getcwd())
+    parser.add_argument('--ffmpeg', default='ffmpeg')
+    parser.add_argument('--ffprobe', default='ffprobe')
+    args = parser.parse_args()
+
+    source = synthetic_source(
+        os.path.join(args.workdir, 'bench_source_{0}s.mp4'.format(args.duration)),
+        args.duration, ffmpeg=args.ffmpeg
+    )
+    rows = []
+    for mode, flags in sorted(MODES.items()):
+        product = os.path.join(args.workdir, 'bench_{0}.mp4'.format(mode))
+        subprocess.check_call([args.ffmpeg, '-v', 'error', '-y', '-i', source, '-c', 'copy'] + flags + [product])
+        box_reader = per_call(args.calls, read_mp4, product)
+        probe = per_call(max(1, args.calls // 10), ffprobe, product, args.ffprobe)
+        rows.append([
+            mode,
+            '%.1f' % (os.path.getsize(product) / 1000000.0),
+            '%.3f' % (box_reader * 1000),
+            '%.3f' % (probe * 1000),
+            '%.0f' % (probe / box_reader),
+        ])
+        os.remove(product)
+
+    print_table(['mode', 'size_mb', 'box_reader_ms', 'ffprobe_ms', 'speedup'], rows)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
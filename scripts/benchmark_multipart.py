@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+Multipart delivery: the old split -b10m copy + one part at a time vs parts read from file
+offsets (video_worker/multipart.py) at several concurrencies
+
+Runs against a minimal in-process S3 stand-in (multipart calls only, bodies discarded) with a
+per request latency and a per connection rate cap, so the single stream limit that makes
+parallel parts pay off on a real link is reproducible; --endpoint host:port uses a real one
+(moto_server, minio) instead, with the dummy credentials below.
+
+Usage:
+    python scripts/benchmark_multipart.py --size-mb 512 --latency 20 --stream-mbps 200 --concurrency 1 4 8
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlparse, parse_qs
+
+import boto
+from boto.s3.connection import OrdinaryCallingFormat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark_utils import print_table
+from video_worker.generate_delivery import MemoryPeak
+from video_worker.multipart import MEGABYTE, MultipartUpload
+
+BUCKET = 'benchmark-deliverables'
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Just enough of S3 for boto's lookup / multipart upload
+    """
+    protocol_version = 'HTTP/1.1'
+    latency = 0
+    stream_rate = None
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status=200, body=b'', headers=None):
+        time.sleep(self.latency)
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        md5 = hashlib.md5()
+        start = time.time()
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+            md5.update(chunk)
+            remaining -= len(chunk)
+            if self.stream_rate:
+                # one connection never goes faster than stream_rate bytes/s
+                done = int(self.headers['Content-Length']) - remaining
+                time.sleep(max(0, done / self.stream_rate - (time.time() - start)))
+        return md5.hexdigest()
+
+    def do_HEAD(self):
+        self._reply()
+
+    def do_GET(self):
+        self._reply(body=b'<ListBucketResult><Name>%s</Name></ListBucketResult>' % BUCKET.encode())
+
+    def do_PUT(self):
+        self._reply(headers={'ETag': '"%s"' % self._body()})
+
+    def do_POST(self):
+        query = parse_qs(urlparse(self.path).query, keep_blank_values=True)
+        self._body()
+        if 'uploads' in query:
+            body = b'<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>k</Key>' \
+                   b'<UploadId>upload-1</UploadId></InitiateMultipartUploadResult>' % BUCKET.encode()
+        else:
+            body = b'<CompleteMultipartUploadResult><Bucket>%s</Bucket><Key>k</Key>' \
+                   b'<ETag>"etag"</ETag></CompleteMultipartUploadResult>' % BUCKET.encode()
+        self._reply(body=body)
+
+    def do_DELETE(self):
+        self._reply(status=204)
+
+
+class StandIn(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def split_upload(filepath, connect, workdir):
+    """
+    The replaced implementation: split into 10 MB part files, upload them in order
+    """
+    parts_dir = tempfile.mkdtemp(dir=workdir)
+    subprocess.check_call(['split', '-b10m', '-a5', filepath, os.path.join(parts_dir, 'x')])
+    upload = connect().initiate_multipart_upload(os.path.basename(filepath))
+    for number, part in enumerate(sorted(os.listdir(parts_dir)), 1):
+        with open(os.path.join(parts_dir, part), 'rb') as part_file:
+            upload.upload_part_from_file(part_file, number)
+    upload.complete_upload()
+    shutil.rmtree(parts_dir)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=256, help='product size')
+    parser.add_argument('--part-size-mb', type=int, default=16)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--latency', type=float, default=20, help='stand-in ms per request')
+    parser.add_argument('--stream-mbps', type=float, default=200, help='stand-in rate cap per connection, 0: none')
+    parser.add_argument('--endpoint', help='host:port of an S3 compatible server instead of the stand-in')
+    parser.add_argument('--workdir', default=os.getcwd())
+    args = parser.parse_args()
+
+    if args.endpoint:
+        host, port = args.endpoint.rsplit(':', 1)
+    else:
+        StandInHandler.latency = args.latency / 1000.0
+        StandInHandler.stream_rate = args.stream_mbps * 1000000 / 8 or None
+        server = StandIn(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+
+    def connect():
+        conn = boto.connect_s3(
+            'benchmark', 'benchmark', host=host, port=int(port), is_secure=False,
+            calling_format=OrdinaryCallingFormat()
+        )
+        return conn.lookup(BUCKET) or conn.create_bucket(BUCKET)
+
+    product = os.path.join(args.workdir, 'bench_product_{0}mb.mp4'.format(args.size_mb))
+    with open(product, 'wb') as product_file:
+        for _ in range(args.size_mb):
+            product_file.write(os.urandom(MEGABYTE))
+
+    runs = [('split_sequential', lambda: split_upload(product, connect, args.workdir), args.size_mb)]
+    for concurrency in args.concurrency:
+        upload = MultipartUpload(
+            product, os.path.basename(product), connect,
+            part_size=args.part_size_mb * MEGABYTE, concurrency=concurrency
+        )
+        runs.append(('offsets_c{0}'.format(concurrency), upload.run, 0))
+
+    rows = []
+    for name, run, temp_disk in runs:
+        start = time.time()
+        with MemoryPeak() as memory:
+            if not run():
+                raise RuntimeError('{0} failed'.format(name))
+        wall = time.time() - start
+        rows.append([
+            name,
+            '%.2f' % wall,
+            '%.1f' % (args.size_mb * MEGABYTE / 1000000.0 / wall),
+            temp_disk,
+            '%.1f' % (memory.peak / 1000000.0),
+        ])
+    os.remove(product)
+
+    # peak resident set growth: a run below an earlier run's high water mark shows 0
+    print_table(['strategy', 'seconds', 'MB/s', 'temp_disk_mb', 'peak_rss_growth_mb'], rows)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
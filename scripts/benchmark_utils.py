@@ -0,0 +1,98 @@
+"""
+Shared helpers for the encode / delivery benchmarks in this directory.
+
+Benchmarks only need ffmpeg/ffprobe on the PATH (or --ffmpeg/--ffprobe),
+sources are synthesized with lavfi so results are reproducible.
+"""
+
+import os
+import resource
+import subprocess
+import time
+
+
+def synthetic_source(path, duration, size='1280x720', rate=30, ffmpeg='ffmpeg', lecture=False):
+    """
+    Generate an h264/aac source clip (testsrc2 is 'busy' motion,
+    lecture is a mostly static slide with a small moving region)
+    """
+    if os.path.exists(path):
+        return path
+    if lecture:
+        video = 'color=c=white:s={size}:r={rate}:d={duration},drawbox=x=40:y=40:w=iw/3:h=ih/6:c=navy:t=fill,' \
+                'drawtext=text=%{{pts\\\\:hms}}:x=w/2:y=h/2:fontsize=48:fontcolor=black'
+    else:
+        video = 'testsrc2=s={size}:r={rate}:d={duration}'
+    command = [
+        ffmpeg, '-hide_banner', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', video.format(size=size, rate=rate, duration=duration),
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000:duration={0}'.format(duration),
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '128k', '-shortest', path
+    ]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if result.returncode != 0:
+        # drawtext needs a font, fall back to the plain slide
+        if lecture and 'drawtext' in result.stdout:
+            command[command.index('-i') + 1] = video.split(',drawtext')[0].format(
+                size=size, rate=rate, duration=duration
+            )
+            subprocess.check_call(command)
+        else:
+            raise RuntimeError(result.stdout)
+    return path
+
+
+def _proc_io(pid):
+    """
+    Syscall level I/O counters (Linux), page cache hits and rewrites included
+    """
+    counters = {}
+    try:
+        with open('/proc/{0}/io'.format(pid)) as io_file:
+            for line in io_file:
+                key, value = line.split(':')
+                counters[key.strip()] = int(value)
+    except (IOError, OSError):
+        pass
+    return counters
+
+
+def run_timed(command):
+    """
+    Run a child to completion, returning wall/cpu seconds and the bytes it read/wrote
+    (read via /proc/<pid>/io after exit, before the child is reaped)
+    """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    wall = time.time() - start
+    counters = _proc_io(process.pid)
+    if process.wait() != 0:
+        raise RuntimeError('{0} exited {1}'.format(command[0], process.returncode))
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'wall': wall,
+        'cpu': (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+        'read_bytes': counters.get('rchar', 0),
+        'write_bytes': counters.get('wchar', 0),
+    }
+
+
+def best_of(repeat, func, *args, **kwargs):
+    """
+    Lowest wall time run of func (which returns a run_timed dict)
+    """
+    runs = [func(*args, **kwargs) for _ in range(repeat)]
+    return min(runs, key=lambda r: r['wall'])
+
+
+def megabytes(value):
+    return float(value) / 1000000
+
+
+def print_table(header, rows):
+    widths = [max(len(str(x)) for x in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print('  '.join(str(x).rjust(w) for x, w in zip(row, widths)))
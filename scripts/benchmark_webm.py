@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+WebM encode speed: the legacy VP8 path vs VP9 with row-mt / tiling
+(flags mirror CommandGenerate._codec/_passes/_tuning for a webm profile)
+
+Usage:
+    python scripts/benchmark_webm.py --duration 60 --threads 8
+"""
+
+import argparse
+import os
+import sys
+
+from benchmark_utils import synthetic_source, run_timed, best_of, megabytes, print_table
+
+
+def variants(bitrate, threads):
+    rate = ['-b:v', '{0}k'.format(bitrate), '-minrate', '10k',
+            '-maxrate', '{0}k'.format(int(bitrate * 1.25)), '-bufsize', '{0}k'.format(bitrate - 24)]
+    return [
+        # what the webm profile emitted before: libvpx (VP8), bitrate only
+        ('vp8 (current)', ['-c:v', 'libvpx'] + rate),
+        ('vp9 good cpu-used=4', ['-c:v', 'libvpx-vp9'] + rate +
+         ['-deadline', 'good', '-cpu-used', '4', '-threads', str(threads)]),
+        ('vp9 good cpu-used=4 row-mt tiles=2', ['-c:v', 'libvpx-vp9'] + rate +
+         ['-deadline', 'good', '-cpu-used', '4', '-threads', str(threads), '-row-mt', '1', '-tile-columns', '2']),
+        ('vp9 realtime cpu-used=8 row-mt tiles=2', ['-c:v', 'libvpx-vp9'] + rate +
+         ['-deadline', 'realtime', '-cpu-used', '8', '-threads', str(threads), '-row-mt', '1', '-tile-columns', '2']),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=int, default=30, help='source seconds')
+    parser.add_argument('--size', default='1280x720')
+    parser.add_argument('--bitrate', type=int, default=1000, help='webm rate_factor, kb/s')
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--workdir', default=os.getcwd())
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--ffmpeg', default='ffmpeg')
+    args = parser.parse_args()
+
+    source = synthetic_source(
+        os.path.join(args.workdir, 'bench_source_{0}s.mp4'.format(args.duration)),
+        args.duration, size=args.size, ffmpeg=args.ffmpeg
+    )
+    output = os.path.join(args.workdir, 'bench_output.webm')
+
+    rows = []
+    baseline = None
+    for name, flags in variants(args.bitrate, args.threads):
+        command = [args.ffmpeg, '-hide_banner', '-y', '-i', source] + flags + ['-c:a', 'libvorbis', output]
+        result = best_of(args.repeat, run_timed, command)
+        baseline = baseline or result['wall']
+        rows.append([
+            name,
+            '%.2f' % result['wall'],
+            '%.2f' % (args.duration / result['wall']),
+            '%.2f' % (baseline / result['wall']),
+            '%.1f' % (result['cpu'] / result['wall']),
+            '%.1f' % megabytes(os.stat(output).st_size),
+        ])
+        os.remove(output)
+
+    print_table(['variant', 'wall_s', 'x_realtime', 'speedup_vs_vp8', 'cores_used', 'output_MB'], rows)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,10 +4,13 @@ Generate a serial transcode stream from a VEDA instance via Celery.
 
 
 import boto
+import json
 import logging
 import os
+import resource
 import subprocess
 import shutil
+import time
 
 from boto.s3.connection import S3Connection
 from boto.exception import S3ResponseError
@@ -15,20 +18,35 @@ from chunkey import Chunkey
 
 from video_worker.abstractions import Video, Encode
 from video_worker.api_communicate import UpdateAPIStatus
+from video_worker.engines import get_engine
 from .celeryapp import deliverable_route
 from video_worker.generate_encode import CommandGenerate
 from video_worker.generate_delivery import Deliverable
+from video_worker.prediction import EncodeHistory, history_key, predict_encode_time
+from video_worker.priority import apply_priority
+from video_worker.probe import probe_file, stats as probe_stats
+from video_worker.quality import QualityScore
 
 from video_worker.global_vars import (
     HOME_DIR,
     ENCODE_WORK_DIR,
+    MOOV_TOO_SMALL,
     VAL_TRANSCODE_STATUS,
     NODE_TRANSCODE_STATUS,
-    BOTO_TIMEOUT
+    VAL_TRANSCODE_FAILED_STATUS,
+    NODE_TRANSCODE_FAILED_STATUS,
+    BOTO_TIMEOUT,
+    ENCODE_STALL_TIMEOUT,
+    ENCODE_TIME_LIMIT_FACTOR,
+    ENCODE_TIME_LIMIT_MIN,
+    PROGRESS_LOG_INTERVAL,
+    ENCODE_HISTORY_FILE
 )
-from video_worker.reporting import Output
+from video_worker.limits import ResourceLimits
+from video_worker.progress import ProgressParser, ProgressLog
 from video_worker.validate import ValidateVideo
 from video_worker.video_images import VideoImages
+from video_worker.watchdog import EncodeWatchdog
 from video_worker.utils import get_config
 
 try:
@@ -53,6 +71,10 @@ class VideoWorker(object):
         self.jobid = kwargs.get('jobid', None)
         self.update_val_status = kwargs.get('update_val_status')
         self.encode_profile = kwargs.get('encode_profile', None)
+        # Deliver a fast stand-in rendition first, then replace it with the full encode
+        self.preview = kwargs.get('preview', False)
+        # CPU / IO priority class for this job and its ffmpeg children (see priority.py)
+        self.priority_class = kwargs.get('priority_class', None)
         self.VideoObject = kwargs.get('VideoObject', None)
 
         self.instance_yaml = kwargs.get(
@@ -64,9 +86,17 @@ class VideoWorker(object):
         )
         self.workdir = kwargs.get('workdir', self.determine_workdir())
         self.ffcommand = None
+        self.encoding = None
         self.source_file = kwargs.get('source_file', None)
         self.output_file = None
         self.endpoint_url = None
+        # ProgressParser / exit status of the last encode, and per job metrics (logged at the end of the run)
+        self.progress = None
+        self.encode_returncode = None
+        self.metrics = {}
+        self.predicted_encode_time = None
+        # why the last encode failed (watchdog / resource limit), None otherwise
+        self.failure_reason = None
         # Pipeline Steps
         self.encoded = False
         self.delivered = False
@@ -86,6 +116,10 @@ class VideoWorker(object):
             logger.error('No Encode Profile Specified')
             return
 
+        if self.priority_class is not None:
+            apply_priority(self.priority_class, settings=self.settings)
+            self.metrics['priority_class'] = self.priority_class
+
         self.VideoObject = Video(
             veda_id=self.veda_id,
         )
@@ -148,17 +182,24 @@ class VideoWorker(object):
             id=self.VideoObject.veda_id,
             encoding=self.encode_profile
         ))
+        # endpoint_url is only set by a successful full quality delivery (never by the preview)
         if self.endpoint_url is not None and self.VideoObject.veda_id is not None:
             # Integrate with main
-            veda_id = self.veda_id
-            encode_profile = self.encode_profile
-            deliverable_route.apply_async(
-                (veda_id, encode_profile),
-                queue=self.settings['celery_deliver_queue']
-            )
-        logger.info('{id} | {encoding} : encoded file queued for delivery'.format(
+            self._route_deliverable()
+            logger.info('{id} | {encoding} : encoded file queued for delivery'.format(
+                id=self.VideoObject.veda_id,
+                encoding=self.encode_profile
+            ))
+        else:
+            logger.error(': {id} | {encoding} Encoded file not delivered'.format(
+                id=self.VideoObject.veda_id,
+                encoding=self.encode_profile
+            ))
+        self.metrics.update(probe_stats.metrics())
+        logger.info('{id} | {encoding} : Job metrics {metrics}'.format(
             id=self.VideoObject.veda_id,
-            encoding=self.encode_profile
+            encoding=self.encode_profile,
+            metrics=json.dumps(self.metrics, sort_keys=True)
         ))
         # Clean up workdir
         if self.jobid is not None:
@@ -171,18 +212,123 @@ class VideoWorker(object):
         if self.ffcommand is None:
             return
 
-        logger.info('ffcommand is written as %s', self.ffcommand)
+        preview_delivered = False
+        if self.preview and self.VideoObject.veda_id is not None:
+            preview_delivered = self._preview_pipeline()
+
+        # Nothing counts as delivered until the full encode's own delivery succeeds
+        self.delivered = False
+        self.endpoint_url = None
+
+        logger.info('ffcommand is written as %s', ' '.join(self.ffcommand))
 
+        self._predict_encode()
         self._execute_encode()
+        self._moov_retry()
 
         if self.encode_profile == 'audio_mp3':
             self.encoded = True
         else:
             self._validate_encode()
+            if self.encoded and self.settings and self.settings.get('quality_check', False):
+                self._score_quality()
 
         if self.encoded and self.VideoObject.veda_id is not None:
             self._deliver_file()
 
+        if preview_delivered and not self.delivered:
+            # the stand-in must not quietly become the product
+            self._preview_not_replaced()
+
+    def _moov_retry(self):
+        """
+        The reserved moov space (estimated from mezz_duration) was too small and the mux failed:
+        encode again with faststart
+        """
+        if self.progress is None or not self.ffcommand or '-moov_size' not in self.ffcommand:
+            return
+        if not any(MOOV_TOO_SMALL in line for line in self.progress.errors):
+            return
+        logger.warning(': {id} | {encoding} Reserved moov too small, encoding again with faststart'.format(
+            id=self.VideoObject.veda_id,
+            encoding=self.encode_profile
+        ))
+        moov_size = self.ffcommand.index('-moov_size')
+        self.ffcommand[moov_size:moov_size + 2] = ['-movflags', 'faststart']
+        self.metrics['moov_retry'] = True
+        self._execute_encode()
+
+    def _preview_not_replaced(self):
+        """
+        The full encode did not replace a delivered preview: report the transcode as failed
+        """
+        logger.error(': {id} | {encoding} Full encode not delivered, only the preview is in place'.format(
+            id=self.VideoObject.veda_id,
+            encoding=self.encode_profile
+        ))
+        self.metrics['preview_replaced'] = False
+        UpdateAPIStatus(
+            val_video_status=VAL_TRANSCODE_FAILED_STATUS,
+            veda_video_status=NODE_TRANSCODE_FAILED_STATUS,
+            send_val=self.update_val_status,
+            VideoObject=self.VideoObject,
+        ).run()
+
+    def _preview_pipeline(self):
+        """
+        Preview-first: encode, deliver and route a fast stand-in rendition (same output file),
+        so something is playable well before the full encode replaces it. True if it was delivered.
+        """
+        if '-c:v copy' in ' '.join(self.ffcommand):
+            # The full encode is already a remux
+            return False
+
+        preview = self.encoding.preview()
+        if preview is None:
+            return False
+
+        ffcommand = CommandGenerate(
+            VideoObject=self.VideoObject,
+            EncodeObject=preview,
+            jobid=self.jobid,
+            workdir=self.workdir,
+            settings=self.settings
+        ).generate()
+        if ffcommand is None:
+            return False
+
+        logger.info('{id} | {encoding} : Preview encode, ffcommand is written as {command}'.format(
+            id=self.VideoObject.veda_id,
+            encoding=self.encode_profile,
+            command=' '.join(ffcommand)
+        ))
+        preview_start = time.time()
+        self._execute_encode(ffcommand=ffcommand, history_profile=self.encode_profile + '_preview')
+        self.metrics.pop('encode_time', None)
+        self._validate_encode()
+        if self.encoded:
+            self._deliver_file()
+
+        delivered = self.delivered and self.endpoint_url is not None
+        if delivered:
+            # flagged, so VEDA knows the full quality product is still to come
+            self._route_deliverable(preview=True)
+            self.metrics['preview_time'] = time.time() - preview_start
+            logger.info('{id} | {encoding} : Preview delivered, continuing with the full encode'.format(
+                id=self.VideoObject.veda_id,
+                encoding=self.encode_profile
+            ))
+        else:
+            logger.error(': {id} Preview encode failed, continuing with the full encode'.format(
+                id=self.VideoObject.veda_id
+            ))
+        # The full encode starts over
+        self.failure_reason = None
+        self.metrics.pop('failure_reason', None)
+        self.output_file = None
+        self.encoded = False
+        return delivered
+
     def _hls_pipeline(self):
         """
         Activate HLS, use hls lib to upload
@@ -284,10 +430,15 @@ class VideoWorker(object):
             profile_name=self.encode_profile
         )
         encoding.pull_data()
+        self.encoding = encoding
 
         if encoding.filetype is None:
             return
 
+        if self.source_file is not None and os.path.exists(os.path.join(self.workdir, self.source_file)):
+            # codec / pixel format, to allow stream copy when the source already fits
+            self.VideoObject.probe_streams(os.path.join(self.workdir, self.source_file))
+
         self.ffcommand = CommandGenerate(
             VideoObject=self.VideoObject,
             EncodeObject=encoding,
@@ -296,46 +447,238 @@ class VideoWorker(object):
             settings=self.settings
         ).generate()
 
-    def _execute_encode(self):
+    def _execute_encode(self, ffcommand=None, history_profile=None):
         """
         if this is just a filepath, this should just work
         --no need to move the source--
         """
+        ffcommand = ffcommand or self.ffcommand
+        self.progress = None
+        self.encode_returncode = None
         if not os.path.exists(os.path.join(self.workdir, self.source_file)):
             logger.error(': {id} Encode input file not found'.format(
                 id=self.VideoObject.veda_id
             ))
             return
 
-        process = subprocess.Popen(
-            self.ffcommand,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            shell=True,
-            universal_newlines=True
+        limits = ResourceLimits.for_encode(
+            mezz_resolution=self.VideoObject.mezz_resolution,
+            mezz_duration=self.VideoObject.mezz_duration,
+            settings=self.settings,
+            job=self.jobid
+        )
+        usage_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        encode_start = time.time()
+        try:
+            # argv, no shell: ffmpeg itself leads the session the watchdog signals
+            process = subprocess.Popen(
+                ffcommand,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+                start_new_session=True,
+                **limits.popen_kwargs()
+            )
+        except OSError as exc:
+            logger.error(': {id} Encode failed: {error}'.format(
+                id=self.VideoObject.veda_id,
+                error=exc
+            ))
+            limits.release()
+            self.output_file = None
+            return
+        watchdog = EncodeWatchdog(
+            process,
+            stall_timeout=ENCODE_STALL_TIMEOUT,
+            time_limit=max(ENCODE_TIME_LIMIT_MIN, (self.VideoObject.mezz_duration or 0) * ENCODE_TIME_LIMIT_FACTOR)
+        ).start()
+        self.progress = ProgressParser(duration=self.VideoObject.mezz_duration)
+        self.progress.subscribe(ProgressLog(
+            label='{id} | {encoding} : Transcode'.format(id=self.VideoObject.veda_id, encoding=self.encode_profile),
+            interval=PROGRESS_LOG_INTERVAL
+        ))
+        self.progress.subscribe(lambda parser, event: watchdog.progress(event.marker))
+        self.progress.subscribe(self._encode_metrics)
+        try:
+            self.progress.run(process.stdout)
+            process.wait()
+        finally:
+            watchdog.stop()
+
+        self.encode_returncode = process.returncode
+        usage_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.metrics['encode_cpu_time'] = (
+            (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
         )
-        Output.status_bar(process=process)
+        limit_hit = limits.failure_reason(process.returncode, self.progress.errors, self.metrics['encode_cpu_time'])
+        limits.release()
+
+        self.output_file = os.path.basename(ffcommand[-1])
+        if watchdog.tripped is not None or limit_hit is not None:
+            self.failure_reason = watchdog.tripped or limit_hit
+            self.metrics['failure_reason'] = self.failure_reason
+            if watchdog.tripped is not None:
+                logger.error(': {id} Encode failed: ffmpeg {reason}, killed'.format(
+                    id=self.VideoObject.veda_id,
+                    reason=watchdog.tripped
+                ))
+            else:
+                logger.error(': {id} Encode failed: ffmpeg hit its {reason}'.format(
+                    id=self.VideoObject.veda_id,
+                    reason=limit_hit
+                ))
+            # never validate / deliver a partial output
+            if os.path.exists(os.path.join(self.workdir, self.output_file)):
+                os.remove(os.path.join(self.workdir, self.output_file))
+            self.output_file = None
+            return
 
-        self.output_file = self.ffcommand.split('/')[-1]
         if not os.path.exists(os.path.join(self.workdir, self.output_file)):
             logger.error(': {id} Encode output file not found'.format(
                 id=self.VideoObject.veda_id
             ))
+            return
+
+        self.metrics['encode_time'] = time.time() - encode_start
+        if process.returncode == 0:
+            EncodeHistory(ENCODE_HISTORY_FILE).record(
+                profile=history_profile or history_key(self.encode_profile, ffcommand),
+                mezz_duration=self.VideoObject.mezz_duration,
+                mezz_resolution=self.VideoObject.mezz_resolution,
+                mezz_bitrate=self.VideoObject.mezz_bitrate,
+                encode_time=self.metrics['encode_time']
+            )
+
+    def _predict_encode(self):
+        """
+        Predicted encode wall time from this node's encode history (None until there is some)
+        """
+        self.predicted_encode_time = predict_encode_time(
+            ENCODE_HISTORY_FILE,
+            history_key(self.encode_profile, self.ffcommand),
+            self.VideoObject.mezz_duration,
+            self.VideoObject.mezz_resolution,
+            self.VideoObject.mezz_bitrate
+        )
+        if self.predicted_encode_time is None:
+            return
+        self.metrics['predicted_encode_time'] = self.predicted_encode_time
+        logger.info('{id} | {encoding} : Predicted encode time {seconds}s'.format(
+            id=self.VideoObject.veda_id,
+            encoding=self.encode_profile,
+            seconds=int(self.predicted_encode_time)
+        ))
+
+    def _encode_metrics(self, parser, event):
+        """
+        Progress listener: keep the final encode stats in the job metrics
+        """
+        if not event.end:
+            return
+        self.metrics.update({
+            'encode_frames': event.frame,
+            'encode_fps': event.fps,
+            'encode_speed': event.speed,
+            'encode_out_time': event.out_time,
+            'encode_bitrate': event.bitrate,
+            'encode_errors': len(parser.errors),
+        })
+
+    def _route_deliverable(self, preview=False):
+        """
+        Tell VEDA the encode is delivered (preview: a stand-in, to be replaced by the full encode)
+        """
+        if not preview:
+            deliverable_route.apply_async(
+                (self.veda_id, self.encode_profile),
+                queue=self.settings['celery_deliver_queue']
+            )
+            return
+        # only previews carry the kwarg: VEDA nodes without preview support keep getting the plain call
+        deliverable_route.apply_async(
+            (self.veda_id, self.encode_profile),
+            {'preview': True},
+            queue=self.settings['celery_deliver_queue']
+        )
 
     def _validate_encode(self):
         """
         Validate encode by matching (w/in 5 sec) encode duration,
-        as well as standard validation tests
+        as well as standard validation tests; from the progress stream when that is conclusive
         """
         if self.output_file is None:
             self.encoded = False
             return
-        else:
-            self.encoded = ValidateVideo(
-                filepath=os.path.join(self.workdir, self.output_file),
-                product_file=True,
-                VideoObject=self.VideoObject
-            ).valid
+
+        if self._progress_valid():
+            # the encode's own progress stream vouches for the output, no probe needed
+            self.encoded = True
+            self.metrics['validated_by'] = 'progress'
+            return
+
+        self.metrics['validated_by'] = 'probe'
+        validator = ValidateVideo(
+            filepath=os.path.join(self.workdir, self.output_file),
+            product_file=True,
+            VideoObject=self.VideoObject,
+            deep=self.settings.get('decode_check', False) if self.settings else False
+        )
+        self.encoded = validator.valid
+        if validator.decode_check is not None:
+            self.metrics.update(validator.decode_check.metrics())
+
+    def _progress_valid(self):
+        """
+        True if the last encode exited cleanly and its progress stream shows a complete output
+        (see ProgressParser.incomplete); the probe based validation confirms anything else
+        """
+        if not self.settings or not self.settings.get('progress_validation', False):
+            return False
+        if self.settings.get('decode_check', False):
+            return False
+        if self.progress is None or self.encode_returncode != 0:
+            return False
+        output_path = os.path.join(self.workdir, self.output_file)
+        if not os.path.exists(output_path) or os.stat(output_path).st_size == 0:
+            return False
+        reason = self.progress.incomplete(duration=self.VideoObject.mezz_duration)
+        if reason is not None:
+            logger.info('{id} | {encoding} : Progress stream inconclusive ({reason}), probing output'.format(
+                id=self.VideoObject.veda_id,
+                encoding=self.encode_profile,
+                reason=reason
+            ))
+            return False
+        return True
+
+    def _score_quality(self):
+        """
+        Sampled PSNR / SSIM of the product against the mezzanine, into the job metrics
+        """
+        engine = get_engine(settings=self.settings)
+        product = probe_file(os.path.join(self.workdir, self.output_file), engine)
+        reference = probe_file(os.path.join(self.workdir, self.source_file), engine)
+        if product is None or reference is None:
+            return
+
+        encode_time = self.metrics.get('encode_time', None)
+        budget = None
+        if encode_time is not None and self.settings.get('quality_budget_percent', None) is not None:
+            budget = encode_time * float(self.settings['quality_budget_percent']) / 100
+        quality = QualityScore(
+            product,
+            reference,
+            self.settings,
+            budget=budget,
+            encode_ratio=encode_time / reference.duration if encode_time and reference.duration else None
+        )
+        quality.run()
+        self.metrics.update(quality.metrics())
+        logger.info('{id} | {encoding} : Quality {metrics}'.format(
+            id=self.VideoObject.veda_id,
+            encoding=self.encode_profile,
+            metrics=json.dumps(quality.metrics(), sort_keys=True)
+        ))
 
     def _deliver_file(self):
         """
@@ -354,5 +697,6 @@ class VideoWorker(object):
             workdir=self.workdir
         )
         D1.run()
+        self.metrics.update(D1.metrics)
         self.delivered = D1.delivered
         self.endpoint_url = D1.endpoint_url
@@ -46,6 +46,13 @@ class Video(object):
         self.mezz_filesize = None
         self.mezz_resolution = None
         self.mezz_duration = None
+        # probed stream info, only known once a local copy exists
+        self.mezz_video_codec = None
+        self.mezz_audio_codec = None
+        self.mezz_audio_bitrate = None
+        self.mezz_pix_fmt = None
+        # ProbeResult of the local mezzanine (see probe.py)
+        self.probe = None
         self.mezz_filepath = kwargs.get('mezz_filepath', None)
         # optional
         self.course_url = kwargs.get('course_url', [])
@@ -118,21 +125,44 @@ class Video(object):
                 self.mezz_filepath += '.' + self.mezz_extension
             self.valid = True
         else:
-            VV = ValidateVideo(
+            probe = ValidateVideo(
                 filepath=self.mezz_filepath,
                 VideoObject=self
-            )
-            video_dict = VV.get_video_attributes()
+            ).probe
+            if probe is None:
+                logger.error(': {filepath} Unreadable local video'.format(filepath=self.mezz_filepath))
+                return
             self.mezz_extension = str(os.path.splitext(self.mezz_filepath)[1]).replace('.', '')
-            self.mezz_bitrate = 0
             self.mezz_title = self.mezz_filepath.split('/')[-1]
-            self.mezz_filesize = video_dict['filesize']
-            self.mezz_resolution = video_dict['resolution']
-            self.mezz_duration = video_dict['duration']
-            self.mezz_filepath = self.mezz_filepath
-            self.mezz_bitrate = 'Unparsed'
+            self.mezz_filesize = probe.filesize
+            self.mezz_resolution = probe.resolution
+            self.mezz_duration = probe.duration
+            self.mezz_bitrate = probe.bitrate or 'Unparsed'
+            self._apply_probe(probe)
             self.valid = True
 
+    def probe_streams(self, filepath):
+        """
+        Fill in codec / pixel format / bitrate from a local copy of the mezzanine
+        (VEDA API videos only carry resolution, bitrate and duration)
+        """
+        probe = ValidateVideo(
+            filepath=filepath,
+            VideoObject=self
+        ).probe
+        if probe is None or probe.duration is None:
+            return
+        self._apply_probe(probe)
+        if Output.kbps_from_string(self.mezz_bitrate) is None:
+            self.mezz_bitrate = probe.bitrate or 'Unparsed'
+
+    def _apply_probe(self, probe):
+        self.probe = probe
+        self.mezz_video_codec = probe.video_codec
+        self.mezz_audio_codec = probe.audio_codec
+        self.mezz_audio_bitrate = probe.audio_bitrate
+        self.mezz_pix_fmt = probe.pix_fmt
+
 
 class Encode(object):
     """
@@ -146,6 +176,22 @@ class Encode(object):
         self.filetype = None
         self.resolution = None
         self.rate_factor = None
+        # optional encoder library override (e.g. libvpx-vp9 for webm)
+        self.codec = None
+        # optional encoder speed / tuning controls
+        self.preset = None
+        self.tune = None
+        self.keyint = None
+        self.threads = None
+        self.lookahead = None
+        # libvpx(-vp9) only
+        self.cpu_used = None
+        self.row_mt = None
+        self.tile_columns = None
+        # max source bitrate (kb/s) at which a matching h264/aac source is remuxed, not encoded
+        self.passthrough_max_bitrate = None
+        # mp4 moov placement: faststart (rewrite), reserved (moov_size up front), fragmented
+        self.mp4_mode = None
         self.encode_pk = None
         self.output_file = None
         self.upload_filesize = None
@@ -209,6 +255,17 @@ class Encode(object):
                 self.rate_factor = e['encode_bitdepth']
                 self.filetype = e['encode_filetype']
                 self.encode_suffix = e['encode_suffix']
+                self.codec = e.get('encode_codec', None)
+                self.preset = e.get('encode_preset', None)
+                self.tune = e.get('encode_tune', None)
+                self.keyint = e.get('encode_keyint', None)
+                self.threads = e.get('encode_threads', None)
+                self.lookahead = e.get('encode_lookahead', None)
+                self.cpu_used = e.get('encode_cpu_used', None)
+                self.row_mt = e.get('encode_row_mt', None)
+                self.tile_columns = e.get('encode_tile_columns', None)
+                self.passthrough_max_bitrate = e.get('encode_passthrough_max_bitrate', None)
+                self.mp4_mode = e.get('encode_mp4_mode', None)
                 self.encode_pk = e['id']
 
                 if self.encode_suffix is None:
@@ -224,8 +281,43 @@ class Encode(object):
         self.rate_factor = encode_data[self.profile_name]['rate_factor']
         self.filetype = encode_data[self.profile_name]['filetype']
         self.encode_suffix = encode_data[self.profile_name]['encode_suffix']
+        self.codec = encode_data[self.profile_name].get('codec', None)
+        self.preset = encode_data[self.profile_name].get('preset', None)
+        self.tune = encode_data[self.profile_name].get('tune', None)
+        self.keyint = encode_data[self.profile_name].get('keyint', None)
+        self.threads = encode_data[self.profile_name].get('threads', None)
+        self.lookahead = encode_data[self.profile_name].get('lookahead', None)
+        self.cpu_used = encode_data[self.profile_name].get('cpu_used', None)
+        self.row_mt = encode_data[self.profile_name].get('row_mt', None)
+        self.tile_columns = encode_data[self.profile_name].get('tile_columns', None)
+        self.passthrough_max_bitrate = encode_data[self.profile_name].get('passthrough_max_bitrate', None)
+        self.mp4_mode = encode_data[self.profile_name].get('mp4_mode', None)
         self.encode_pk = None
 
+    def preview(self):
+        """
+        Fast, low cost stand-in for this encode, for preview-first delivery
+
+        Same filetype / suffix (so the same output file, which the full encode then replaces),
+        at most PREVIEW_RESOLUTION, h264 at PREVIEW_PRESET. None for non-mp4 profiles.
+        """
+        if self.filetype != 'mp4':
+            return None
+        preview = Encode(
+            video_object=self.VideoObject,
+            profile_name=self.profile_name
+        )
+        preview.filetype = self.filetype
+        preview.encode_suffix = self.encode_suffix
+        preview.encode_pk = self.encode_pk
+        preview.mp4_mode = self.mp4_mode
+        preview.resolution = PREVIEW_RESOLUTION
+        if self.resolution:
+            preview.resolution = min(int(self.resolution), PREVIEW_RESOLUTION)
+        preview.rate_factor = PREVIEW_RATE_FACTOR
+        preview.preset = PREVIEW_PRESET
+        return preview
+
     def _read_encodes(self):
         if self.encode_library is None:
             self.encode_library = os.path.join(
@@ -9,7 +9,9 @@ import os
 import shutil
 
 from video_worker.utils import get_config
-from video_worker.global_vars import ENCODE_WORK_DIR
+from video_worker.global_vars import ENCODE_WORK_DIR, ENCODE_HISTORY_FILE
+from video_worker.prediction import history_key, predict_encode_time
+from video_worker.priority import priority_for_queue
 
 
 settings = get_config()
@@ -19,13 +21,20 @@ def cel_start():
     app = Celery(
         settings.setdefault('celery_app_name', ''),
         broker='redis://:' + '@' + settings.setdefault('redis_broker', '') + ':6379/0',
+        # results: encode time predictions only, every other task ignores its result
+        backend='redis://:' + '@' + settings.setdefault('redis_broker', '') + ':6379/0',
         include=['celeryapp']
     )
 
     app.conf.update(
         BROKER_CONNECTION_TIMEOUT=60,
         CELERY_IGNORE_RESULT=True,
-        CELERY_TASK_RESULT_EXPIRES=10,
+        # only encode time predictions store a result: kept until the central node reads it
+        CELERY_TASK_RESULT_EXPIRES=settings.get('prediction_result_expires', 3600),
+        # predictions have a queue (and worker) of their own, never behind an encode
+        CELERY_ROUTES={
+            'predict_encode_time': {'queue': settings.get('celery_prediction_queue', 'prediction_worker')},
+        },
         CELERYD_PREFETCH_MULTIPLIER=1,
         CELERY_ACCEPT_CONTENT=['json'],
         CELERY_TASK_PUBLISH_RETRY=True,
@@ -43,8 +52,9 @@ def cel_start():
 app = cel_start()
 
 
-@app.task(name='worker_encode')
-def worker_task_fire(veda_id, encode_profile, jobid, update_val_status=True):
+@app.task(name='worker_encode', bind=True)
+def worker_task_fire(self, veda_id, encode_profile, jobid, update_val_status=True, preview=False,
+                     priority_class=None):
     task_command = os.path.join(
         os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
         'bin',
@@ -61,6 +71,19 @@ def worker_task_fire(veda_id, encode_profile, jobid, update_val_status=True):
         task_command += '-uvs '
         task_command += ' '
 
+    # Preview-first: a fast rendition is delivered (and routed) before the full encode replaces it
+    if preview:
+        task_command += '-p '
+        task_command += ' '
+
+    # CPU / IO priority class: explicit, else from the queue the task came in on
+    if priority_class is None:
+        delivery_info = self.request.delivery_info or {}
+        priority_class = priority_for_queue(delivery_info.get('routing_key', None), settings=settings)
+    if priority_class is not None:
+        task_command += '--priority ' + priority_class
+        task_command += ' '
+
     task_command += '-e ' + encode_profile
     task_command += ' '
     task_command += '-j ' + jobid
@@ -84,10 +107,27 @@ def worker_task_fire(veda_id, encode_profile, jobid, update_val_status=True):
         )
 
 
+@app.task(name='predict_encode_time', ignore_result=False, expires=settings.get('prediction_expires', 60))
+def encode_time_prediction(encode_profile, mezz_duration, mezz_resolution=None, mezz_bitrate=None, remux=False):
+    """
+    Predicted encode wall time (seconds) of a job before it is queued, from the history of the
+    node answering (None until it has some); remux: the source would be stream copied
+    """
+    return predict_encode_time(
+        ENCODE_HISTORY_FILE,
+        history_key(encode_profile, remux=remux),
+        mezz_duration,
+        mezz_resolution,
+        mezz_bitrate
+    )
+
+
 @app.task(name='supervisor_deliver')
-def deliverable_route(veda_id, encode_profile):
+def deliverable_route(veda_id, encode_profile, preview=False):
     """
     Just register this task with big veda
+
+    preview: the delivered file is a preview-first stand-in, the full encode replaces it and is routed again
     """
     pass
 
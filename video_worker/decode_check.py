@@ -0,0 +1,149 @@
+"""
+Sampled decode check of an encoded product
+
+The container duration check in ValidateVideo misses mid-file corruption, and decoding
+the whole product serially costs about as much as the encode. Instead, K evenly spaced
+windows (the first at the start, the last at the end of the file) of `window` seconds are
+decoded (`ffmpeg -v error -ss start -t window -f null -`) in parallel ffmpeg processes;
+anything ffmpeg logs at error level is a decode error for that window.
+
+K / window length set the cost, the time budget caps it: windows that have not started
+when the budget runs out are skipped (and reported as such), not failed.
+
+"""
+
+import logging
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .limits import ResourceLimits
+
+logger = logging.getLogger(__name__)
+
+
+class DecodeWindow(object):
+    """
+    One decoded window: start / duration (seconds), error lines, ffmpeg exit status
+    """
+    def __init__(self, start, duration, **kwargs):
+        self.start = start
+        self.duration = duration
+        self.errors = kwargs.get('errors', [])
+        self.returncode = kwargs.get('returncode', None)
+        # not decoded: the time budget ran out first
+        self.skipped = kwargs.get('skipped', False)
+
+    @property
+    def ok(self):
+        return self.skipped or (self.returncode == 0 and not self.errors)
+
+    def as_dict(self):
+        return {
+            'start': self.start,
+            'duration': self.duration,
+            'errors': self.errors,
+            'returncode': self.returncode,
+            'skipped': self.skipped,
+        }
+
+
+def window_starts(duration, windows, window):
+    """
+    Start of each of `windows` evenly spaced windows of `window` seconds, first and last at the file ends
+    """
+    if not duration or windows < 1:
+        return []
+    if duration <= window:
+        return [0.0]
+    if windows == 1:
+        return [round((duration - window) / 2.0, 3)]
+    step = (duration - window) / float(windows - 1)
+    return [round(index * step, 3) for index in range(windows)]
+
+
+class DecodeCheck(object):
+    """
+    Parallel sampled decode of a media file
+    """
+    def __init__(self, filepath, duration, settings, **kwargs):
+        self.filepath = filepath
+        self.duration = duration
+        self.ffmpeg = settings.get('ffmpeg_compiled', 'ffmpeg')
+        self.windows = kwargs.get('windows', None) or settings.get('decode_check_windows', 4)
+        self.window = kwargs.get('window', None) or settings.get('decode_check_window', 2)
+        self.workers = kwargs.get('workers', None) or settings.get('decode_check_workers', 2)
+        # seconds; None: no budget
+        self.budget = kwargs.get('budget', settings.get('decode_check_budget', None))
+        self.limits = kwargs.get('limits', None) or ResourceLimits.for_probe(settings=settings)
+        self.results = []
+        self.elapsed = None
+
+    def run(self):
+        """
+        Decode every window, returns the DecodeWindow list (in file order)
+        """
+        start_time = time.time()
+        deadline = start_time + self.budget if self.budget else None
+        starts = window_starts(self.duration, self.windows, self.window)
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            self.results = list(executor.map(lambda start: self._decode(start, deadline), starts))
+        self.elapsed = time.time() - start_time
+
+        for result in self.results:
+            if not result.ok:
+                logger.error(': {filepath} decode errors at {start}s: {errors}'.format(
+                    filepath=self.filepath,
+                    start=result.start,
+                    errors=' | '.join(result.errors[:5]) or 'ffmpeg exited {}'.format(result.returncode)
+                ))
+        return self.results
+
+    @property
+    def valid(self):
+        return all(result.ok for result in self.results)
+
+    def metrics(self):
+        return {
+            'decode_check_windows': len([result for result in self.results if not result.skipped]),
+            'decode_check_skipped': len([result for result in self.results if result.skipped]),
+            'decode_check_errors': sum(len(result.errors) for result in self.results),
+            'decode_check_failed_windows': [result.start for result in self.results if not result.ok],
+            'decode_check_time': self.elapsed,
+        }
+
+    def _decode(self, start, deadline):
+        if deadline is not None and time.time() >= deadline:
+            return DecodeWindow(start, self.window, skipped=True)
+        command = [
+            self.ffmpeg, '-hide_banner', '-nostdin', '-v', 'error',
+            '-ss', str(start), '-t', str(self.window), '-i', self.filepath,
+            '-map', '0', '-f', 'null', '-'
+        ]
+        try:
+            # no preexec_fn from a worker thread: the limits are applied once the child is started
+            process = subprocess.Popen(
+                command,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                universal_newlines=True
+            )
+        except OSError as exc:
+            return DecodeWindow(start, self.window, errors=[str(exc)])
+        if self.limits:
+            try:
+                self.limits.apply_to(process.pid)
+            except ProcessLookupError:
+                # already done
+                pass
+            except (OSError, ValueError) as exc:
+                process.kill()
+                process.communicate()
+                return DecodeWindow(start, self.window, errors=['limits not applied: {}'.format(exc)])
+        _, stderrdata = process.communicate()
+        return DecodeWindow(
+            start,
+            self.window,
+            errors=[line.strip() for line in stderrdata.splitlines() if line.strip()],
+            returncode=process.returncode
+        )
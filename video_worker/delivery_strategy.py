@@ -0,0 +1,165 @@
+"""
+Single part vs multipart delivery, from measured throughput
+
+Every finished delivery is appended to a (per node) history file:
+    strategy, file size, concurrency, wall time, throughput (bytes / second)
+
+Products at or above the multipart barrier (S3's single PUT limit territory) always go
+multipart, products too small to split into two parts always go single. In between, the
+strategy with the higher median throughput over recent deliveries of that size range (within
+a factor 2 ** SIZE_BAND of the product's size, below the barrier) wins; until each strategy
+has MIN_RECORDS deliveries in the range (and every EXPLORE_EVERY deliveries after that) the
+other one is tried, so both stay measured as the link changes.
+
+Part size: enough parts to keep every worker busy (PARTS_PER_WORKER each), but no part taking
+longer than PART_SECONDS on one stream at the measured rate (a retried part stays cheap),
+within S3's minimum and the configured part size.
+
+"""
+
+import json
+import logging
+import math
+import os
+import time
+
+import numpy
+
+from .multipart import MIN_PART_SIZE
+
+logger = logging.getLogger(__name__)
+
+SINGLE = 'single'
+MULTIPART = 'multipart'
+# throughput medians over the most recent records per strategy
+HISTORY_WINDOW = 100
+# measurements each strategy needs before they are compared
+MIN_RECORDS = 3
+# every EXPLORE_EVERY eligible deliveries the slower strategy is measured again
+EXPLORE_EVERY = 20
+# deliveries compared: within this many powers of two of the product size
+SIZE_BAND = 1.0
+PARTS_PER_WORKER = 4
+PART_SECONDS = 5.0
+
+
+class DeliveryHistory(object):
+    """
+    Append only JSON lines file of finished deliveries
+    """
+    def __init__(self, history_file):
+        self.history_file = history_file
+
+    def record(self, strategy, filesize, delivery_time, **kwargs):
+        if not delivery_time or delivery_time <= 0:
+            return None
+        record = {
+            'strategy': strategy,
+            'filesize': int(filesize),
+            'concurrency': kwargs.get('concurrency', 1),
+            'delivery_time': float(delivery_time),
+            'throughput': float(filesize) / delivery_time,
+            'recorded': int(time.time()),
+        }
+        try:
+            with open(self.history_file, 'a') as history:
+                history.write(json.dumps(record, sort_keys=True) + '\n')
+        except (IOError, OSError) as exc:
+            logger.error(': {file} Delivery history not written: {error}'.format(
+                file=self.history_file,
+                error=exc
+            ))
+            return None
+        return record
+
+    def records(self, min_filesize=0):
+        if not os.path.exists(self.history_file):
+            return []
+        records = []
+        with open(self.history_file) as history:
+            for line in history:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('throughput') and record.get('filesize', 0) >= min_filesize:
+                    records.append(record)
+        return records
+
+
+class DeliveryPlan(object):
+    """
+    strategy, part_size / concurrency (multipart), and why
+    """
+    def __init__(self, strategy, reason, part_size=None, concurrency=1):
+        self.strategy = strategy
+        self.reason = reason
+        self.part_size = part_size
+        self.concurrency = concurrency
+
+
+def median_throughput(records, strategy):
+    throughputs = [r['throughput'] for r in records if r.get('strategy') == strategy][-HISTORY_WINDOW:]
+    if not throughputs:
+        return None, 0
+    return float(numpy.median(throughputs)), len(throughputs)
+
+
+def size_band(records, filesize, barrier):
+    """
+    Records of deliveries of about filesize bytes; deliveries forced multipart by the barrier
+    say nothing about the choice below it
+    """
+    return [
+        r for r in records
+        if r['filesize'] < barrier and abs(math.log(float(r['filesize']) / filesize, 2)) <= SIZE_BAND
+    ]
+
+
+def part_size(filesize, concurrency, max_part_size, stream_throughput=None):
+    """
+    Part size keeping concurrency workers busy, each part at most PART_SECONDS on one stream
+    """
+    size = float(filesize) / (max(1, concurrency) * PARTS_PER_WORKER)
+    if stream_throughput:
+        size = min(size, stream_throughput * PART_SECONDS)
+    return int(max(MIN_PART_SIZE, min(size, max_part_size)))
+
+
+def plan_delivery(filesize, history_file, barrier, max_part_size, concurrency):
+    """
+    DeliveryPlan for a product of filesize bytes
+    """
+    min_multipart = 2 * MIN_PART_SIZE
+    records = DeliveryHistory(history_file).records(min_filesize=min_multipart) if history_file else []
+    records = size_band(records, filesize, barrier)
+    single, single_count = median_throughput(records, SINGLE)
+    multipart, multipart_count = median_throughput(records, MULTIPART)
+    # what one connection moves: a single part upload, or a share of a multipart one
+    stream_throughput = single or (multipart / concurrency if multipart else None)
+
+    def multipart_plan(reason):
+        return DeliveryPlan(
+            MULTIPART, reason,
+            part_size=part_size(filesize, concurrency, max_part_size, stream_throughput),
+            concurrency=concurrency
+        )
+
+    if filesize >= barrier:
+        return multipart_plan('barrier')
+    if filesize < min_multipart or concurrency < 2:
+        return DeliveryPlan(SINGLE, 'small')
+    if multipart_count < MIN_RECORDS:
+        return multipart_plan('explore')
+    if single_count < MIN_RECORDS:
+        return DeliveryPlan(SINGLE, 'explore')
+
+    faster = MULTIPART if multipart > single else SINGLE
+    if len(records) % EXPLORE_EVERY == 0:
+        faster = SINGLE if faster == MULTIPART else MULTIPART
+        reason = 'explore'
+    else:
+        reason = 'throughput'
+    if faster == MULTIPART:
+        return multipart_plan(reason)
+    return DeliveryPlan(SINGLE, reason)
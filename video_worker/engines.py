@@ -0,0 +1,230 @@
+"""
+Media engines: how the worker probes / decodes / encodes media
+
+    CLIEngine  - ffprobe / ffmpeg subprocesses (default)
+    PyAVEngine - in process libav via PyAV (optional: pip install av), no process spawn
+                 and no text parsing for probes and frame grabs
+
+Selected with the `media_engine` setting (cli | pyav). The transcode proper
+(CommandGenerate / VideoWorker._execute_encode) stays on the ffmpeg CLI.
+
+probe() returns a probe.ProbeResult (or None if the file is unreadable); callers go through
+probe.probe_file, which caches it per file
+
+"""
+
+import logging
+import subprocess
+import time
+
+try:
+    import av
+    import av.logging
+except ImportError:
+    av = None
+
+from .limits import ResourceLimits
+from .probe import DESYNC_WARNING, ProbeResult, fast_probe, ffprobe, stats as probe_stats
+from video_worker.utils import get_config
+
+logger = logging.getLogger(__name__)
+
+CLI_ENGINE = 'cli'
+PYAV_ENGINE = 'pyav'
+
+
+def get_engine(name=None, settings=None):
+    """
+    Engine instance by name (default: the `media_engine` setting), CLIEngine if PyAV is unavailable
+    """
+    settings = settings or get_config()
+    name = name or settings.get('media_engine', CLI_ENGINE)
+    if name == PYAV_ENGINE:
+        if av is not None:
+            return PyAVEngine(settings=settings)
+        logger.warning('media_engine pyav requested, but PyAV is not installed: using ffmpeg cli')
+    return CLIEngine(settings=settings)
+
+
+class CLIEngine(object):
+    """
+    ffprobe / ffmpeg subprocess engine
+    """
+    name = CLI_ENGINE
+
+    def __init__(self, **kwargs):
+        self.settings = kwargs.get('settings', None) or get_config()
+        self.ffmpeg = self.settings.get('ffmpeg_compiled', 'ffmpeg')
+        self.ffprobe = self.settings.get('ffprobe_compiled', 'ffprobe')
+        # rlimits for the probe / thumbnail children
+        self.limits = kwargs.get('limits', None) or ResourceLimits.for_probe(settings=self.settings)
+
+    def probe(self, filepath):
+        if self.settings.get('fast_probe', False):
+            return fast_probe(
+                filepath,
+                ffprobe_path=self.ffprobe,
+                popen_kwargs=self.limits.popen_kwargs(),
+                probesize=self.settings.get('fast_probe_size', 1048576),
+                analyzeduration=self.settings.get('fast_probe_analyzeduration', 1000000),
+                calibrate_every=self.settings.get('fast_probe_calibrate_every', None)
+            )
+        start = time.time()
+        result = ffprobe(filepath, ffprobe_path=self.ffprobe, popen_kwargs=self.limits.popen_kwargs())
+        probe_stats.record(full_time=time.time() - start)
+        return result
+
+    def extract_frame(self, filepath, position, output_file, width, height):
+        """
+        Single frame at `position` seconds, scaled to width x height, as an image file
+        """
+        command = ('{ffmpeg} -ss {position} -i {video_file} -y -vf scale={width}:{height}'
+                   ' -vsync 2 -vframes 1 {output_file}'.format(
+                       ffmpeg=self.ffmpeg,
+                       position=position,
+                       video_file=filepath,
+                       width=width,
+                       height=height,
+                       output_file=output_file))
+
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            shell=True,
+            universal_newlines=True,
+            **self.limits.popen_kwargs()
+        )
+        stdoutdata, stderrdata = process.communicate()
+        logger.info('executing command >> %s', command)
+        logger.info('command output >> out=%s -- err=%s', stdoutdata, stderrdata)
+        return process.returncode == 0
+
+    def encode_clip(self, filepath, output_file, duration, height, rate_factor, preset):
+        """
+        Video only h264 encode of the first `duration` seconds
+        """
+        command = ('{ffmpeg} -y -t {duration} -i {video_file} -an -c:v libx264 -vf scale=-2:{height}'
+                   ' -crf {rate_factor} -preset {preset} {output_file}'.format(
+                       ffmpeg=self.ffmpeg,
+                       duration=duration,
+                       video_file=filepath,
+                       height=height,
+                       rate_factor=rate_factor,
+                       preset=preset,
+                       output_file=output_file))
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            shell=True,
+            **self.limits.popen_kwargs()
+        )
+        return process.wait() == 0
+
+
+class PyAVEngine(object):
+    """
+    In process libav engine (PyAV)
+    """
+    name = PYAV_ENGINE
+
+    def __init__(self, **kwargs):
+        if av is None:
+            raise ImportError('PyAVEngine needs PyAV (pip install av)')
+        self.settings = kwargs.get('settings', None)
+
+    def probe(self, filepath):
+        previous_level = av.logging.get_level()
+        av.logging.set_level(av.logging.WARNING)
+        try:
+            with av.logging.Capture() as logs:
+                container = av.open(filepath)
+        except (av.error.FFmpegError, OSError) as exc:
+            logger.info(': {filepath} probe failed: {error}'.format(filepath=filepath, error=exc))
+            return None
+        finally:
+            av.logging.set_level(previous_level)
+
+        with container:
+            duration = None
+            if container.duration and container.duration > 0:
+                duration = float(container.duration) / av.time_base
+            result = ProbeResult(
+                filepath,
+                format_name=container.format.name,
+                duration=duration,
+                bit_rate=container.bit_rate or None,
+                desync=any(DESYNC_WARNING in message for _, _, message in logs)
+            )
+            if container.streams.video:
+                video = container.streams.video[0].codec_context
+                result.video_codec = video.name
+                if video.format is not None:
+                    result.pix_fmt = video.format.name
+                result.width = video.width or None
+                result.height = video.height or None
+            if container.streams.audio:
+                audio = container.streams.audio[0]
+                result.audio_codec = audio.codec_context.name
+                result.audio_bit_rate = audio.bit_rate or None
+        return result
+
+    def extract_frame(self, filepath, position, output_file, width, height):
+        """
+        Single frame at `position` seconds, scaled to width x height, as an image file
+        """
+        try:
+            with av.open(filepath) as container:
+                stream = container.streams.video[0]
+                # seek lands on the keyframe at or before position, decode forward from there
+                container.seek(int(position * av.time_base))
+                frame = None
+                for frame in container.decode(stream):
+                    if frame.time is not None and frame.time >= position:
+                        break
+                if frame is None:
+                    return False
+                image = frame.reformat(width=width, height=height, format='rgb24')
+
+            with av.open(output_file, 'w', format='image2') as output:
+                output_stream = output.add_stream('png')
+                output_stream.width = width
+                output_stream.height = height
+                output_stream.pix_fmt = 'rgb24'
+                output.mux(output_stream.encode(image))
+                output.mux(output_stream.encode(None))
+        except (av.error.FFmpegError, OSError, IndexError) as exc:
+            logger.error(': {filepath} frame extraction failed: {error}'.format(filepath=filepath, error=exc))
+            return False
+        return True
+
+    def encode_clip(self, filepath, output_file, duration, height, rate_factor, preset):
+        """
+        Video only h264 encode of the first `duration` seconds
+        """
+        try:
+            with av.open(filepath) as container, av.open(output_file, 'w') as output:
+                stream = container.streams.video[0]
+                stream.thread_type = 'AUTO'
+                width = int(round(stream.codec_context.width * height / float(stream.codec_context.height) / 2)) * 2
+                output_stream = output.add_stream('libx264', rate=stream.average_rate)
+                output_stream.width = width
+                output_stream.height = height
+                output_stream.pix_fmt = 'yuv420p'
+                output_stream.options = {'crf': str(rate_factor), 'preset': str(preset)}
+                time_base = 1 / stream.average_rate
+                output_stream.codec_context.time_base = time_base
+                for index, frame in enumerate(container.decode(stream)):
+                    if frame.time is not None and frame.time >= duration:
+                        break
+                    frame = frame.reformat(width=width, height=height, format='yuv420p')
+                    # constant frame rate output, one tick of 1 / rate per frame
+                    frame.pts = index
+                    frame.time_base = time_base
+                    output.mux(output_stream.encode(frame))
+                output.mux(output_stream.encode(None))
+        except (av.error.FFmpegError, OSError, IndexError) as exc:
+            logger.error(': {filepath} clip encode failed: {error}'.format(filepath=filepath, error=exc))
+            return False
+        return True
@@ -5,22 +5,69 @@ from VEDA_WORK_DIR, retrieves and checks URL, and passes info to objects
 """
 
 
+import base64
 import boto
 import boto.s3
 from boto.s3.key import Key
 import hashlib
 import logging
 import os
+import resource
 import sys
-import shutil
-
-from .global_vars import MULTI_UPLOAD_BARRIER, ENCODE_WORK_DIR
+import time
+
+from .delivery_strategy import MULTIPART, SINGLE, DeliveryHistory, DeliveryPlan, plan_delivery
+from .global_vars import DELIVERY_HISTORY_FILE, MULTI_UPLOAD_BARRIER, ENCODE_WORK_DIR, UPLOAD_STATE_DIR
+from .multipart import (
+    MEGABYTE,
+    UPLOAD_STATE_SUFFIX,
+    MultipartUpload,
+    abort_abandoned_states,
+    persisted_part_size
+)
 from video_worker.utils import get_config
 
 
 settings = get_config()
 logger = logging.getLogger(__name__)
 
+# read buffer for hashing; never the whole file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def stream_md5(fp, chunk_size=HASH_CHUNK_SIZE):
+    """
+    md5 of a file object read in chunk_size blocks, as boto's (hex digest, base64 digest) pair
+    """
+    md5 = hashlib.md5()
+    for chunk in iter(lambda: fp.read(chunk_size), b''):
+        md5.update(chunk)
+    return md5.hexdigest(), base64.b64encode(md5.digest()).decode('ascii')
+
+
+class MemoryPeak(object):
+    """
+    Growth (bytes) of the process's peak resident set over a with block: how far the block pushed
+    the high water mark, 0 if it stayed below an earlier peak. Nothing is traced, so it costs
+    nothing during the upload.
+    """
+    def __init__(self):
+        self.peak = 0
+        self._baseline = 0
+
+    @staticmethod
+    def max_rss():
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+    def __enter__(self):
+        self._baseline = self.max_rss()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.peak = max(0, self.max_rss() - self._baseline)
+
 
 class Deliverable(object):
 
@@ -30,10 +77,15 @@ class Deliverable(object):
         self.output_file = output_file
         self.jobid = kwargs.get('jobid', None)
         self.workdir = kwargs.get('workdir', None)
+        self.history_file = kwargs.get('history_file', DELIVERY_HISTORY_FILE)
+        self.state_dir = kwargs.get('state_dir', UPLOAD_STATE_DIR)
         self.endpoint_url = None
         self.hash_sum = 0
         self.upload_filesize = 0
         self.delivered = False
+        # delivery_strategy (reason), delivery_time, delivery_throughput (bytes/s), delivery_peak_memory (bytes),
+        # delivery_parts (resumed, retries)
+        self.metrics = {}
 
     def run(self):
         """
@@ -52,26 +104,37 @@ class Deliverable(object):
         self.upload_filesize = os.stat(
             os.path.join(self.workdir, self.output_file)
         ).st_size
-        # hash sum
-        self.hash_sum = hashlib.md5(
-            open(
-                os.path.join(
-                    self.workdir,
-                    self.output_file
-                ), 'rb'
-            ).read()
-        ).hexdigest()
-
-        if self.upload_filesize < MULTI_UPLOAD_BARRIER:
-            # Upload single part
-            self.delivered = self._s3_upload()
-        else:
-            # Upload multipart
-            self.delivered = self._boto_multipart()
+
+        plan = self._plan()
+        self.metrics['delivery_strategy'] = plan.strategy
+        self.metrics['delivery_strategy_reason'] = plan.reason
+
+        # the hash sum is computed in bounded chunks: by the part reader (multipart), or in a
+        # pass of its own ahead of a single part upload, which sends it as Content-MD5
+        delivery_start = time.time()
+        with MemoryPeak() as memory:
+            if plan.strategy == SINGLE:
+                # Upload single part
+                self.delivered = self._s3_upload()
+            else:
+                # Upload multipart
+                self.delivered = self._boto_multipart(plan)
+        self.metrics['delivery_time'] = time.time() - delivery_start
+        self.metrics['delivery_peak_memory'] = memory.peak
 
         if self.delivered is False:
             return None
 
+        self.metrics['delivery_throughput'] = self.upload_filesize / max(self.metrics['delivery_time'], 1e-6)
+        # a resumed upload's throughput says nothing about the link
+        if not self.metrics.get('delivery_resumed_parts'):
+            DeliveryHistory(self.history_file).record(
+                plan.strategy,
+                self.upload_filesize,
+                self.metrics['delivery_time'],
+                concurrency=plan.concurrency
+            )
+
         self.endpoint_url = '/'.join((
             'https://s3.amazonaws.com',
             settings['veda_deliverable_bucket'],
@@ -79,91 +142,106 @@ class Deliverable(object):
         ))
         return True
 
-    def _s3_upload(self):
+    def _plan(self):
         """
-        Upload single part (under threshold in node_config)
-        node_config MULTI_UPLOAD_BARRIER
+        Single part or multipart (part size, concurrency) for this product
+        """
+        max_part_size = settings.get('multipart_part_size_mb', 16) * MEGABYTE
+        concurrency = settings.get('multipart_concurrency', 4)
+        # a retried job resumes its multipart upload, with the part size it started with
+        state_path = self._state_path()
+        resume_part_size = persisted_part_size(state_path) if state_path else None
+        if resume_part_size is not None:
+            return DeliveryPlan(MULTIPART, 'resume', part_size=resume_part_size, concurrency=concurrency)
+        if not settings.get('adaptive_delivery', True):
+            if self.upload_filesize < MULTI_UPLOAD_BARRIER:
+                return DeliveryPlan(SINGLE, 'barrier')
+            return DeliveryPlan(MULTIPART, 'barrier', part_size=max_part_size, concurrency=concurrency)
+        return plan_delivery(
+            self.upload_filesize,
+            self.history_file,
+            MULTI_UPLOAD_BARRIER,
+            max_part_size,
+            concurrency
+        )
+
+    def _state_path(self):
         """
+        Upload state of this product (the output file name is per video and profile), None if
+        it can not be kept
+        """
+        try:
+            if not os.path.isdir(self.state_dir):
+                os.makedirs(self.state_dir)
+        except OSError as exc:
+            logger.error(': {file} Upload state dir not created: {error}'.format(file=self.output_file, error=exc))
+            return None
+        return os.path.join(self.state_dir, self.output_file + UPLOAD_STATE_SUFFIX)
+
+    def _connection(self):
         if settings['onsite_worker'] is True:
-            conn = boto.connect_s3(
+            return boto.connect_s3(
                 settings['veda_access_key_id'],
                 settings['veda_secret_access_key']
             )
-        else:
-            conn = boto.connect_s3()
+        return boto.connect_s3()
+
+    def _s3_upload(self):
+        """
+        Upload single part
+        """
+        conn = self._connection()
         delv_bucket = conn.get_bucket(settings['veda_deliverable_bucket'])
 
         upload_key = Key(delv_bucket)
         upload_key.key = self.output_file
-        upload_key.set_contents_from_filename(
-            os.path.join(self.workdir, self.output_file)
-        )
+        with open(os.path.join(self.workdir, self.output_file), 'rb') as upload_file:
+            # hashed once here (boto sends it as Content-MD5 instead of hashing again), then streamed
+            md5 = stream_md5(upload_file)
+            self.hash_sum = md5[0]
+            upload_file.seek(0)
+            upload_key.set_contents_from_file(upload_file, md5=md5)
         return True
 
-    def _boto_multipart(self):
+    def _deliverable_bucket(self):
         """
-        Split file into chunks, upload chunks
-
-        NOTE: this should never happen, as your files should be much
-        smaller than this, but one never knows
+        A fresh connection's deliverable bucket, None if it can not be reached
         """
-        if not os.path.exists(
-            os.path.join(
-                self.workdir,
-                self.output_file.split('.')[0]
-            )
-        ):
-            os.mkdir(os.path.join(
-                self.workdir,
-                self.output_file.split('.')[0]
-            ))
-
-        os.chdir(
-            os.path.join(self.workdir, self.output_file.split('.')[0])
-        )
-
-        # Split File into chunks
-        split_command = 'split -b10m -a5'  # 5 part names of 5mb
-        sys.stdout.write('%s : %s\n' % (self.output_file, 'Generating Multipart'))
-        os.system(' '.join((split_command, os.path.join(self.workdir, self.output_file))))
-        sys.stdout.flush()
-
-        # Connect to s3
-        if settings['onsite_worker'] is True:
-            conn = boto.connect_s3(
-                settings['veda_access_key_id'],
-                settings['veda_secret_access_key']
-            )
-        else:
-            conn = boto.connect_s3()
-        b = conn.lookup(settings['veda_deliverable_bucket'])
-
+        b = self._connection().lookup(settings['veda_deliverable_bucket'])
         if b is None:
             logger.error(
                 ': {file} Deliverable Fail: s3 Bucket Connection Error'.format(
                     file=self.output_file
                 )
             )
-            return False
-
-        # Upload and stitch parts
-        mp = b.initiate_multipart_upload(self.output_file)
+        return b
 
-        x = 1
-        for fle in sorted(os.listdir(
-            os.path.join(
-                self.workdir,
-                self.output_file.split('.')[0]
-            )
-        )):
-            sys.stdout.write('%s : %s\r' % (fle, 'uploading part'))
-            fp = open(fle, 'rb')
-            mp.upload_part_from_file(fp, x)
-            fp.close()
-            sys.stdout.flush()
-            x += 1
-        sys.stdout.write('\n')
-        mp.complete_upload()
-        # Clean up multipart
-        shutil.rmtree(os.path.join(self.workdir, self.output_file.split('.')[0]))
+    def _boto_multipart(self, plan):
+        """
+        Upload parts read from their offsets in the file, plan.concurrency at a time
+        """
+        abandon_after = settings.get('multipart_abandon_hours', 24) * 3600
+        # uploads whose jobs were never retried
+        abort_abandoned_states(self.state_dir, self._deliverable_bucket, abandon_after)
+        upload = MultipartUpload(
+            os.path.join(self.workdir, self.output_file),
+            self.output_file,
+            self._deliverable_bucket,
+            part_size=plan.part_size,
+            concurrency=plan.concurrency,
+            retries=settings.get('multipart_retries', 3),
+            backoff=settings.get('multipart_retry_backoff', 1),
+            abandon_after=abandon_after,
+            # a failed upload is resumed by the retried job, from the state kept outside the workdir
+            state_path=self._state_path()
+        )
+        delivered = upload.run()
+        self.metrics.update({
+            'delivery_parts': upload.parts,
+            'delivery_resumed_parts': upload.resumed_parts,
+            'delivery_part_retries': upload.part_retries,
+        })
+        if not delivered:
+            return False
+        self.hash_sum = upload.hash_sum
         return True
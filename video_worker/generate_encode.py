@@ -10,19 +10,105 @@ endpoints the edX platform provides
 
 input, via two classes, encode and video, which can be generated either via the node independently
 or via celery connection to VEDA (VEDA will send video_id and encode_profile via Celery queue)
+
+The profile level part of each command is compiled once per process into a CommandTemplate,
+jobs only fill in the per-video slots (input, scale/pad filter, source capped rate, output)
 """
 
 
 import logging
 import os
 import sys
+import threading
 
 from video_worker.utils import get_config
-from .global_vars import ENCODE_WORK_DIR, TARGET_ASPECT_RATIO, ENFORCE_TARGET_ASPECT
+from .global_vars import (
+    ENCODE_WORK_DIR,
+    TARGET_ASPECT_RATIO,
+    ENFORCE_TARGET_ASPECT,
+    MOOV_SAMPLES_PER_SECOND,
+    MOOV_BYTES_PER_SAMPLE,
+    MOOV_HEADROOM
+)
+from .reporting import Output
 
 logger = logging.getLogger(__name__)
 
 
+class Slot(object):
+    """
+    Per-video placeholder in a CommandTemplate
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return '<{}>'.format(self.name)
+
+
+INPUT = Slot('input')
+FILTER = Slot('filter')
+RATE = Slot('rate')
+OUTPUT = Slot('output')
+
+
+class CommandTemplate(object):
+    """
+    Immutable, per-profile ffmpeg argv with per-video slots:
+        INPUT (source path), FILTER (-vf scale/pad), RATE (source capped rate controls),
+        OUTPUT (container options + output path)
+
+    head() is everything up to and including the input, body() everything after it,
+    so several profiles' bodies can share one input / decode (multi_output)
+    """
+    __slots__ = ('_argv',)
+
+    def __init__(self, argv):
+        object.__setattr__(self, '_argv', tuple(argv))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('CommandTemplate is immutable')
+
+    @property
+    def argv(self):
+        return self._argv
+
+    def head(self, source):
+        end = self._argv.index(INPUT)
+        return list(self._argv[:end]) + [source]
+
+    def body(self, filter=(), rate=(), output=()):
+        fills = {FILTER: filter, RATE: rate, OUTPUT: output}
+        argv = []
+        for token in self._argv[self._argv.index(INPUT) + 1:]:
+            if isinstance(token, Slot):
+                argv.extend(fills[token])
+            else:
+                argv.append(token)
+        return argv
+
+    def render(self, source, filter=(), rate=(), output=()):
+        return self.head(source) + self.body(filter, rate, output)
+
+
+def multi_output(source, renders):
+    """
+    One ffmpeg argv for several outputs of the same source:
+        renders -> [(template, filter, rate, output), ...]
+    """
+    argv = renders[0][0].head(source)
+    for template, filter, rate, output in renders:
+        argv.extend(template.body(filter, rate, output))
+    return argv
+
+
+# Compiled CommandTemplates (per process), keyed by everything profile level that shapes the argv
+_TEMPLATES = {}
+_TEMPLATES_LOCK = threading.Lock()
+
+
 class CommandGenerate:
 
     def __init__(self, VideoObject, EncodeObject, **kwargs):
@@ -38,7 +124,7 @@ class CommandGenerate:
 
     def generate(self):
         """
-        Generate command for ffmpeg lib
+        Generate command (argv list) for ffmpeg lib
         """
         if self.VideoObject is None:
             logger.error('Command generation: No Video object')
@@ -54,52 +140,180 @@ class CommandGenerate:
             else:
                 self.workdir = os.path.join(ENCODE_WORK_DIR, self.jobid)
 
-        # These build the command, and, unfortunately, must be in order
-        self._call()
-        self._codec()
+        passthrough = self._passthrough()
+        template = self.template(passthrough)
+        if passthrough:
+            # Source already satisfies the profile, remux only
+            filter_args, rate_args = [], []
+        else:
+            filter_args = self._collect(self._scalar) if ENFORCE_TARGET_ASPECT else []
+            rate_args = self._rate()
+
+        self.ffcommand = template.render(
+            self._source(),
+            filter=filter_args,
+            rate=rate_args,
+            output=self._collect(self._destination)
+        )
+        return self.ffcommand
+
+    def template(self, passthrough=False):
+        """
+        This profile's CommandTemplate, compiled on first use and then shared by every job in the process
+        """
+        key = (passthrough, self.settings['ffmpeg_compiled']) + tuple(
+            getattr(self.EncodeObject, field, None) for field in (
+                'filetype', 'codec', 'rate_factor', 'preset', 'tune', 'keyint',
+                'threads', 'lookahead', 'cpu_used', 'row_mt', 'tile_columns'
+            )
+        )
+        template = _TEMPLATES.get(key)
+        if template is None:
+            with _TEMPLATES_LOCK:
+                template = _TEMPLATES.setdefault(key, self._compile(passthrough))
+        return template
+
+    def _compile(self, passthrough):
+        """
+        Build the template from the profile level steps, in command order:
+            head, INPUT, stream selection, codec, FILTER, rate (profile CRF or RATE), tuning, OUTPUT
+        """
+        argv = self._collect(self._head) + [INPUT] + self._collect(self._select)
+        if passthrough:
+            argv += self._collect(self._copy)
+        elif self.EncodeObject.filetype == 'mp3':
+            # codec (copy / libmp3lame) and bitrate both follow the source audio
+            argv += [RATE]
+        else:
+            argv += self._collect(self._codec) + [FILTER]
+            argv += self._collect(self._passes) if self.EncodeObject.filetype == 'mp4' else [RATE]
+            argv += self._collect(self._tuning)
+        return CommandTemplate(argv + [OUTPUT])
 
-        if ENFORCE_TARGET_ASPECT:
-            self._scalar()
+    def _rate(self):
+        """
+        RATE slot: the rate controls that depend on the source
+        """
+        if self.EncodeObject.filetype == 'mp3':
+            return self._collect(self._codec) + self._collect(self._passes)
+        if self.EncodeObject.filetype == 'webm':
+            return self._collect(self._passes)
+        return []
 
-        self._bitdepth()
-        self._passes()
-        self._destination()
-        return ' '.join(self.ffcommand)
+    def _collect(self, step):
+        """
+        Arguments a single build step appends
+        """
+        ffcommand = self.ffcommand
+        self.ffcommand = []
+        try:
+            step()
+            return self.ffcommand
+        finally:
+            self.ffcommand = ffcommand
 
     def _call(self):
         """
         Begin Command Proper
         """
+        self._head()
+        self.ffcommand.append(self._source())
+        self._select()
+
+    def _head(self):
         self.ffcommand.append(self.settings['ffmpeg_compiled'])
         self.ffcommand.append('-hide_banner')
+        # machine readable progress on stdout instead of the stderr stats line, see progress.py
+        self.ffcommand.append('-nostats')
+        self.ffcommand.append('-progress')
+        self.ffcommand.append('pipe:1')
         self.ffcommand.append('-y')
         self.ffcommand.append('-i')
+
+    def _source(self):
         if self.VideoObject.veda_id is not None and len(self.VideoObject.mezz_extension) > 0:
-            self.ffcommand.append(os.path.join(
+            return os.path.join(
                 self.workdir,
                 '.'.join((
                     self.VideoObject.veda_id,
                     self.VideoObject.mezz_extension
                 ))
-            ))
+            )
         elif len(self.VideoObject.mezz_extension) > 0:
-            self.ffcommand.append(os.path.join(
+            return os.path.join(
                 self.workdir,
                 '.'.join((
                     os.path.basename(self.VideoObject.mezz_filepath).split('.')[0],
                     self.VideoObject.mezz_extension
                 ))
-            ))
-        else:
-            self.ffcommand.append(os.path.join(
-                self.workdir,
-                os.path.basename(self.VideoObject.mezz_filepath)
-            ))
+            )
+        return os.path.join(
+            self.workdir,
+            os.path.basename(self.VideoObject.mezz_filepath)
+        )
+
+    def _select(self):
         if self.EncodeObject.filetype != 'mp3':
             self.ffcommand.append('-c:v')
         else:
+            # Audio only: drop video/subtitle/data, read only the first audio stream
+            self.ffcommand.append('-vn')
+            self.ffcommand.append('-sn')
+            self.ffcommand.append('-dn')
+            self.ffcommand.append('-map')
+            self.ffcommand.append('0:a:0')
             self.ffcommand.append('-c:a')
 
+    def _passthrough(self):
+        """
+        True if the (probed) mezzanine can be delivered for this profile by stream copy:
+        h264/aac (or no audio), yuv420p, at the target resolution/aspect, and
+        at or under the profile's passthrough bitrate ceiling
+        """
+        if self.EncodeObject.filetype != 'mp4':
+            return False
+        if (self.EncodeObject.codec or 'libx264') != 'libx264':
+            return False
+        if self.EncodeObject.passthrough_max_bitrate is None:
+            return False
+
+        if self.VideoObject.mezz_video_codec != 'h264':
+            return False
+        if self.VideoObject.mezz_audio_codec not in (None, 'aac'):
+            return False
+        if self.VideoObject.mezz_pix_fmt != 'yuv420p':
+            return False
+
+        mezz_kbps = Output.kbps_from_string(self.VideoObject.mezz_bitrate)
+        if mezz_kbps is None or mezz_kbps > int(self.EncodeObject.passthrough_max_bitrate):
+            return False
+
+        if not self.VideoObject.mezz_resolution or 'x' not in self.VideoObject.mezz_resolution:
+            return False
+        mezz_horiz_resolution, mezz_vert_resolution = [
+            int(r) for r in self.VideoObject.mezz_resolution.strip().split('x')[:2]
+        ]
+        if mezz_vert_resolution != int(self.EncodeObject.resolution):
+            return False
+        if ENFORCE_TARGET_ASPECT:
+            mezz_aspect_ratio = float(mezz_horiz_resolution) / float(mezz_vert_resolution)
+            if abs(mezz_aspect_ratio - TARGET_ASPECT_RATIO) > 0.01:
+                return False
+
+        logger.info('{id} | {encoding} : Source meets profile, stream copy'.format(
+            id=self.VideoObject.veda_id,
+            encoding=self.EncodeObject.profile_name
+        ))
+        return True
+
+    def _copy(self):
+        """
+        Remux, no re-encode ('-c:v' already appended by _call)
+        """
+        self.ffcommand.append('copy')
+        self.ffcommand.append('-c:a')
+        self.ffcommand.append('copy')
+
     def _codec(self):
         """
         This, as an addendum to the relatively simple deliverables to edX, is only intended to
@@ -109,11 +323,25 @@ class CommandGenerate:
             return
 
         if self.EncodeObject.filetype == 'mp4':
-            self.ffcommand.append('libx264')
+            # libx264 unless the profile asks for an efficiency codec (libx265 / libsvtav1)
+            self.ffcommand.append(self.EncodeObject.codec or 'libx264')
         elif self.EncodeObject.filetype == 'webm':
-            self.ffcommand.append('libvpx')
+            # VP8 unless the profile asks for libvpx-vp9
+            self.ffcommand.append(self.EncodeObject.codec or 'libvpx')
         elif self.EncodeObject.filetype == 'mp3':
-            self.ffcommand.append('libmp3lame')
+            if self._audio_passthrough():
+                self.ffcommand.append('copy')
+            else:
+                self.ffcommand.append('libmp3lame')
+
+    def _audio_passthrough(self):
+        """
+        mp3 source audio at or under the target bitrate can be copied as is
+        """
+        if self.VideoObject.mezz_audio_codec != 'mp3':
+            return False
+        mezz_audio_kbps = Output.kbps_from_string(self.VideoObject.mezz_audio_bitrate)
+        return mezz_audio_kbps is not None and mezz_audio_kbps <= int(self.EncodeObject.rate_factor)
 
     def _scalar(self):
         if self.ffcommand is None:
@@ -135,8 +363,12 @@ class CommandGenerate:
         else:
             mezz_parse_bitrate = None
 
-        # RESOLUTION as int
-        if self.VideoObject.mezz_resolution != 'Unparsed' and len(self.VideoObject.mezz_resolution) > 0:
+        # RESOLUTION as int, from the probed local mezzanine when there is one
+        probe = getattr(self.VideoObject, 'probe', None)
+        if probe is not None and probe.width and probe.height:
+            mezz_vert_resolution = probe.height
+            mezz_horiz_resolution = probe.width
+        elif self.VideoObject.mezz_resolution != 'Unparsed' and len(self.VideoObject.mezz_resolution) > 0:
             mezz_vert_resolution = int(self.VideoObject.mezz_resolution.strip().split('x')[1])
             mezz_horiz_resolution = int(self.VideoObject.mezz_resolution.strip().split('x')[0])
         else:
@@ -217,42 +449,137 @@ class CommandGenerate:
         1 for WEBM
         """
         if self.EncodeObject.filetype == 'webm':
+            # never target more than the source has, compared as kb/s numbers
+            target_bitrate = int(self.EncodeObject.rate_factor)
+            mezz_kbps = Output.kbps_from_string(self.VideoObject.mezz_bitrate)
+            if mezz_kbps is not None and target_bitrate > mezz_kbps:
+                target_bitrate = mezz_kbps
+
             self.ffcommand.append('-b:v')
-            if self.EncodeObject.rate_factor > self.VideoObject.mezz_bitrate:
-                self.ffcommand.append(str(self.VideoObject.mezz_bitrate) + 'k')
-                self.ffcommand.append('-minrate')
-                self.ffcommand.append('10k')
-                self.ffcommand.append('-maxrate')
-                self.ffcommand.append(str(int(float(self.VideoObject.mezz_bitrate) * 1.25)) + 'k')
-                self.ffcommand.append('-bufsize')
-                self.ffcommand.append(str(int(self.VideoObject.mezz_bitrate) - 24) + 'k')
-            else:
-                self.ffcommand.append(str(self.EncodeObject.rate_factor) + 'k')
-                self.ffcommand.append('-minrate')
-                self.ffcommand.append('10k')
-                self.ffcommand.append('-maxrate')
-                self.ffcommand.append(str(int(float(self.EncodeObject.rate_factor) * 1.25)) + 'k')
-                self.ffcommand.append('-bufsize')
-                self.ffcommand.append(str(int(self.EncodeObject.rate_factor) - 24) + 'k')
+            self.ffcommand.append(str(target_bitrate) + 'k')
+            self.ffcommand.append('-minrate')
+            self.ffcommand.append('10k')
+            self.ffcommand.append('-maxrate')
+            self.ffcommand.append(str(int(float(target_bitrate) * 1.25)) + 'k')
+            self.ffcommand.append('-bufsize')
+            self.ffcommand.append(str(target_bitrate - 24) + 'k')
 
         elif self.EncodeObject.filetype == 'mp4':
+            # CRF for x264, x265 and svt-av1 alike (scales differ, set per profile)
             crf = str(self.EncodeObject.rate_factor)
             self.ffcommand.append('-crf')
             self.ffcommand.append(crf)
+            if self.EncodeObject.codec == 'libx265':
+                # hvc1 sample entry, so Apple players will open it
+                self.ffcommand.append('-tag:v')
+                self.ffcommand.append('hvc1')
+            elif self.EncodeObject.codec == 'libsvtav1':
+                self.ffcommand.append('-pix_fmt')
+                self.ffcommand.append('yuv420p')
 
         elif self.EncodeObject.filetype == 'mp3':
+            if self._audio_passthrough():
+                return
+            # never spend more bits than the source audio has
+            audio_kbps = int(self.EncodeObject.rate_factor)
+            mezz_audio_kbps = Output.kbps_from_string(self.VideoObject.mezz_audio_bitrate)
+            if mezz_audio_kbps is not None and mezz_audio_kbps < audio_kbps:
+                audio_kbps = mezz_audio_kbps
             self.ffcommand.append('-b:a')
-            self.ffcommand.append(str(self.EncodeObject.rate_factor) + 'k')
+            self.ffcommand.append(str(audio_kbps) + 'k')
 
         # for a possible two-pass encodes state:
         # need: two-pass global bool
         #     ffmpeg -y -i -pass 1 -c:a libfdk_aac -b:a 128k -passlogfile ${LOGFILE} \
         #     -f mp4 /dev/null && ${FFCOMMAND} -pass 2 -c:a libfdk_aac -b:a 128k ${DESTINATION}
 
+    def _tuning(self):
+        """
+        Optional per-profile speed / tuning controls (trade CPU for size)
+            preset -> x264/x265/svt-av1 '-preset', libvpx '-deadline'
+            lookahead -> x264 '-rc-lookahead', libvpx '-lag-in-frames',
+                x265/svt-av1 through their -x265-params / -svtav1-params
+            cpu_used, row_mt, tile_columns -> libvpx(-vp9) only
+        """
+        if self.EncodeObject.filetype not in ('mp4', 'webm'):
+            return
+
+        if self.EncodeObject.preset is not None:
+            if self.EncodeObject.filetype == 'mp4':
+                self.ffcommand.append('-preset')
+            else:
+                self.ffcommand.append('-deadline')
+            self.ffcommand.append(str(self.EncodeObject.preset))
+
+        if self.EncodeObject.tune is not None:
+            self.ffcommand.append('-tune')
+            self.ffcommand.append(str(self.EncodeObject.tune))
+
+        if self.EncodeObject.keyint is not None:
+            self.ffcommand.append('-g')
+            self.ffcommand.append(str(self.EncodeObject.keyint))
+
+        if self.EncodeObject.threads is not None:
+            self.ffcommand.append('-threads')
+            self.ffcommand.append(str(self.EncodeObject.threads))
+
+        if self.EncodeObject.lookahead is not None:
+            if self.EncodeObject.codec == 'libx265':
+                self.ffcommand.append('-x265-params')
+                self.ffcommand.append('rc-lookahead=' + str(self.EncodeObject.lookahead))
+            elif self.EncodeObject.codec == 'libsvtav1':
+                self.ffcommand.append('-svtav1-params')
+                self.ffcommand.append('lookahead=' + str(self.EncodeObject.lookahead))
+            elif self.EncodeObject.filetype == 'mp4':
+                self.ffcommand.append('-rc-lookahead')
+                self.ffcommand.append(str(self.EncodeObject.lookahead))
+            else:
+                self.ffcommand.append('-lag-in-frames')
+                self.ffcommand.append(str(self.EncodeObject.lookahead))
+
+        if self.EncodeObject.filetype != 'webm':
+            return
+
+        # libvpx speed / threading, row-mt and tiling are what let VP9 use more than one core
+        if self.EncodeObject.cpu_used is not None:
+            self.ffcommand.append('-cpu-used')
+            self.ffcommand.append(str(self.EncodeObject.cpu_used))
+
+        if self.EncodeObject.row_mt is not None:
+            self.ffcommand.append('-row-mt')
+            self.ffcommand.append(str(self.EncodeObject.row_mt))
+
+        if self.EncodeObject.tile_columns is not None:
+            self.ffcommand.append('-tile-columns')
+            self.ffcommand.append(str(self.EncodeObject.tile_columns))
+
+    def _moov(self):
+        """
+        Get the moov atom in front of mdat without faststart's second (full file) pass where possible:
+            reserved -> reserve moov space up front, sized from duration (needs mezz_duration);
+                        an encode that outgrows it is redone with faststart (VideoWorker._moov_retry)
+            fragmented -> fragmented mp4, moov is written empty up front
+            faststart -> moov written last, then the file is rewritten
+        """
+        mp4_mode = self.EncodeObject.mp4_mode or self.settings.get('mp4_output_mode', 'faststart')
+
+        if mp4_mode == 'fragmented':
+            self.ffcommand.append('-movflags')
+            self.ffcommand.append('frag_keyframe+empty_moov+default_base_moof')
+            return
+
+        if mp4_mode == 'reserved' and self.VideoObject.mezz_duration:
+            moov_size = int(float(self.VideoObject.mezz_duration) * MOOV_SAMPLES_PER_SECOND * MOOV_BYTES_PER_SAMPLE)
+            self.ffcommand.append('-moov_size')
+            self.ffcommand.append(str(moov_size + MOOV_HEADROOM))
+            return
+
+        self.ffcommand.append('-movflags')
+        self.ffcommand.append('faststart')
+
     def _destination(self):
         if self.EncodeObject.filetype == 'mp4':
-            self.ffcommand.append('-movflags')
-            self.ffcommand.append('faststart')
+            self._moov()
             self.ffcommand.append('-write_tmcd')
             self.ffcommand.append('off')
         elif self.EncodeObject.filetype == 'webm':
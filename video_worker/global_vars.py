@@ -15,6 +15,8 @@ ENCODE_WORK_DIR = WORKER_CONFIG.get('ENCODE_WORK_DIR', DEFAULT_ENCODE_WORK_DIR)
 
 NODE_TRANSCODE_STATUS = 'Active Transcode'
 VAL_TRANSCODE_STATUS = 'transcode_active'
+NODE_TRANSCODE_FAILED_STATUS = 'Transcode Error'
+VAL_TRANSCODE_FAILED_STATUS = 'transcode_failed'
 
 # Initially set to 16:9, can be changed
 # We can also just ignore this,
@@ -24,11 +26,56 @@ VAL_TRANSCODE_STATUS = 'transcode_active'
 ENFORCE_TARGET_ASPECT = True
 TARGET_ASPECT_RATIO = float(1920) / float(1080)
 
+# Reserved mp4 moov estimate: (video + audio) samples/sec * worst case table bytes/sample, plus headroom
+MOOV_SAMPLES_PER_SECOND = 60 + 50
+MOOV_BYTES_PER_SAMPLE = 24
+MOOV_HEADROOM = 65536
+# ffmpeg's error when the reserved moov space is exceeded; the encode is redone with faststart
+MOOV_TOO_SMALL = 'reserved_moov_size is too small'
+
+# Encode watchdog: kill ffmpeg if progress stalls for ENCODE_STALL_TIMEOUT seconds, or the encode runs
+# longer than max(ENCODE_TIME_LIMIT_MIN, mezz_duration * ENCODE_TIME_LIMIT_FACTOR) seconds
+ENCODE_STALL_TIMEOUT = WORKER_CONFIG.get('encode_stall_timeout', 300)
+ENCODE_TIME_LIMIT_FACTOR = WORKER_CONFIG.get('encode_time_limit_factor', 10)
+ENCODE_TIME_LIMIT_MIN = WORKER_CONFIG.get('encode_time_limit_min', 1800)
+
+# Encode progress is logged at most once per PROGRESS_LOG_INTERVAL seconds
+PROGRESS_LOG_INTERVAL = WORKER_CONFIG.get('progress_log_interval', 30)
+
+# Finished encode features / wall times, for encode time prediction (see prediction.py)
+ENCODE_HISTORY_FILE = WORKER_CONFIG.get(
+    'encode_history_file',
+    os.path.join(ENCODE_WORK_DIR, 'encode_history.jsonl')
+)
+
+# Bounded vs full probe times of the same files, for the fast probe time saved (see probe.py)
+PROBE_HISTORY_FILE = WORKER_CONFIG.get(
+    'probe_history_file',
+    os.path.join(ENCODE_WORK_DIR, 'probe_history.jsonl')
+)
+
+# Preview-first mode: a fast stand-in rendition is delivered before the full encode replaces it
+PREVIEW_RESOLUTION = WORKER_CONFIG.get('preview_resolution', 360)
+PREVIEW_RATE_FACTOR = WORKER_CONFIG.get('preview_rate_factor', 30)
+PREVIEW_PRESET = WORKER_CONFIG.get('preview_preset', 'ultrafast')
+
 # The subbed out profile for HLS
 HLS_SUBSTITUTE = 'mobile_low'
 
-# For BOTO Multipart uploader
-MULTI_UPLOAD_BARRIER = 2000000000
+# For BOTO Multipart uploader: products this size and up always go multipart, smaller ones
+# single part unless delivery history shows multipart is faster (see delivery_strategy.py)
+MULTI_UPLOAD_BARRIER = WORKER_CONFIG.get('multi_upload_barrier', 2000000000)
+# Finished delivery sizes / wall times, per strategy
+DELIVERY_HISTORY_FILE = WORKER_CONFIG.get(
+    'delivery_history_file',
+    os.path.join(ENCODE_WORK_DIR, 'delivery_history.jsonl')
+)
+# Open multipart uploads (<product>.upload.json), outside the per job workdirs the job and its
+# Celery task remove, for the retried job to resume them
+UPLOAD_STATE_DIR = WORKER_CONFIG.get(
+    'upload_state_dir',
+    os.path.join(ENCODE_WORK_DIR, 'upload_state')
+)
 BOTO_TIMEOUT = '60'
 
 # Settings for testing
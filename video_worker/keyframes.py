@@ -0,0 +1,103 @@
+"""
+Keyframes around thumbnail positions
+
+A thumbnail-only optimisation: thumbnails are taken at keyframes where one is close enough (a
+seek lands on them, nothing is decoded forward from the seek point). An ffprobe packet scan of
+the first video stream (no decoding), bounded with -read_intervals to the windows around the
+thumbnail positions, finds them: ffprobe seeks to each window and reads only its packets
+instead of demuxing the whole file. Nothing is stored; thumbnails are taken once per job and
+no other step reads keyframes.
+
+"""
+
+import logging
+import subprocess
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+def merge_intervals(intervals):
+    """
+    Sorted, non overlapping (start, end) windows, starts clamped to 0
+    """
+    merged = []
+    for start, end in sorted((max(0.0, float(start)), float(end)) for start, end in intervals):
+        if end <= start:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class KeyframeIndex(object):
+    """
+    Sorted keyframe times (seconds) of the scanned windows of one source
+    """
+    def __init__(self, times):
+        self.times = numpy.sort(numpy.asarray(times, dtype=numpy.float64))
+
+    def __len__(self):
+        return len(self.times)
+
+    @classmethod
+    def scan(cls, filepath, ffprobe_path='ffprobe', popen_kwargs=None, intervals=None):
+        """
+        Index from a single ffprobe packet scan (of the (start, end) windows in intervals only,
+        when given), None if the file can not be read
+        """
+        command = [
+            ffprobe_path, '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0'
+        ]
+        if intervals:
+            command += ['-read_intervals', ','.join(
+                '{start:.3f}%{end:.3f}'.format(start=start, end=end) for start, end in intervals
+            )]
+        command.append(filepath)
+        try:
+            process = subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+                **(popen_kwargs or {})
+            )
+        except OSError as exc:
+            logger.error(': {filepath} keyframe scan failed: {error}'.format(filepath=filepath, error=exc))
+            return None
+        times = set()
+        for line in process.stdout:
+            fields = line.strip().split(',')
+            if len(fields) < 2 or 'K' not in fields[1]:
+                continue
+            try:
+                times.add(float(fields[0]))
+            except ValueError:
+                # no pts
+                continue
+        process.wait()
+        if process.returncode != 0:
+            return None
+        return cls(sorted(times))
+
+    def before(self, position):
+        """
+        Index of the last keyframe at or before position (the first keyframe if none)
+        """
+        return max(0, int(numpy.searchsorted(self.times, position, side='right')) - 1)
+
+    def nearest(self, position):
+        """
+        Time of the keyframe closest to position, None for an empty index
+        """
+        if not len(self):
+            return None
+        after = min(int(numpy.searchsorted(self.times, position, side='left')), len(self) - 1)
+        before = self.before(position)
+        if abs(self.times[after] - position) < abs(position - self.times[before]):
+            return float(self.times[after])
+        return float(self.times[before])
@@ -0,0 +1,241 @@
+"""
+Resource limits for ffmpeg / ffprobe children
+
+One pathological source must not take the whole node down (OOM killer), so every
+encode, probe and thumbnail child is started with:
+    - rlimits, applied in the child before exec:
+        RLIMIT_AS (address space), RLIMIT_CPU (cpu seconds), RLIMIT_NOFILE (open files)
+    - optionally a per-job cgroup v2 (memory.max, pids.max) when `ffmpeg_cgroup_root`
+      names a writable, delegated cgroup directory
+
+Encode limits are sized from the job's estimated footprint (source frame size, node threads,
+source duration); probes / thumbnails get small fixed limits. Hitting a limit is reported as
+its own failure reason (see failure_reason).
+
+Note RLIMIT_AS counts virtual memory: thread stacks and malloc arenas count in full,
+hence the per thread allowance.
+
+"""
+
+import logging
+import os
+import resource
+import signal
+
+from video_worker.utils import get_config
+
+logger = logging.getLogger(__name__)
+
+# failure reasons
+MEMORY_LIMIT = 'memory_limit'
+CPU_LIMIT = 'cpu_limit'
+OPEN_FILES_LIMIT = 'open_files_limit'
+
+MEMORY_ERRORS = ('cannot allocate memory', 'out of memory', 'enomem')
+OPEN_FILES_ERRORS = ('too many open files',)
+
+MEGABYTE = 1024 * 1024
+# seconds between the RLIMIT_CPU soft limit (SIGXCPU, ffmpeg exits cleanly) and the hard limit (SIGKILL)
+CPU_GRACE = 30
+
+
+class ResourceLimits(object):
+    """
+    rlimits (+ optional cgroup) for one child process; None for a limit leaves it as inherited
+    """
+    def __init__(self, address_space=None, cpu_time=None, open_files=None, **kwargs):
+        self.address_space = address_space
+        self.cpu_time = cpu_time
+        self.open_files = open_files
+        self.cgroup = kwargs.get('cgroup', None)
+
+    @classmethod
+    def for_encode(cls, mezz_resolution=None, mezz_duration=None, settings=None, **kwargs):
+        """
+        Limits from the job's estimated footprint:
+            memory: base + per source megapixel + per encoder thread
+            cpu: source seconds * cpu seconds per source second (at least the configured minimum)
+        """
+        settings = settings or get_config()
+        if not settings.get('ffmpeg_limits', False):
+            return cls()
+
+        megapixels = 2.1
+        if mezz_resolution and 'x' in str(mezz_resolution):
+            try:
+                width, height = [int(r) for r in str(mezz_resolution).strip().split('x')[:2]]
+                megapixels = width * height / 1e6
+            except ValueError:
+                pass
+        threads = kwargs.get('threads', None) or os.cpu_count() or 1
+        memory_mb = (
+            settings.get('ffmpeg_memory_base_mb', 1024) +
+            megapixels * settings.get('ffmpeg_memory_per_megapixel_mb', 512) +
+            threads * settings.get('ffmpeg_memory_per_thread_mb', 80)
+        )
+        cpu_time = max(
+            settings.get('ffmpeg_cpu_time_min', 3600),
+            (mezz_duration or 0) * settings.get('ffmpeg_cpu_seconds_per_second', 40)
+        )
+        cgroup = None
+        if settings.get('ffmpeg_cgroup_root', None):
+            cgroup = JobCgroup.create(
+                settings['ffmpeg_cgroup_root'],
+                kwargs.get('job', None) or str(os.getpid()),
+                memory_max=int(memory_mb * MEGABYTE),
+                pids_max=settings.get('ffmpeg_pids_max', 512)
+            )
+        return cls(
+            # with a cgroup, memory is held to memory.max (resident) instead of address space
+            address_space=None if cgroup is not None else int(memory_mb * MEGABYTE),
+            cpu_time=int(cpu_time),
+            open_files=settings.get('ffmpeg_open_files', 256),
+            cgroup=cgroup
+        )
+
+    @classmethod
+    def for_probe(cls, settings=None):
+        """
+        Probe / thumbnail children: small fixed limits
+        """
+        settings = settings or get_config()
+        if not settings.get('ffmpeg_limits', False):
+            return cls()
+        return cls(
+            address_space=int(settings.get('probe_memory_mb', 1024) * MEGABYTE),
+            cpu_time=settings.get('probe_cpu_time', 120),
+            open_files=settings.get('ffmpeg_open_files', 256)
+        )
+
+    def __bool__(self):
+        return any(limit is not None for limit in (self.address_space, self.cpu_time, self.open_files, self.cgroup))
+
+    def _rlimits(self):
+        """
+        (rlimit, soft, hard) to set; hard None: keep the current hard limit
+        """
+        for limit, soft, hard in (
+            (resource.RLIMIT_AS, self.address_space, self.address_space),
+            (resource.RLIMIT_CPU, self.cpu_time, self.cpu_time and self.cpu_time + CPU_GRACE),
+            (resource.RLIMIT_NOFILE, self.open_files, None),
+        ):
+            if soft is not None:
+                yield limit, soft, hard
+
+    @staticmethod
+    def _bounded(soft, hard, current_hard):
+        if hard is None or (current_hard != resource.RLIM_INFINITY and hard > current_hard):
+            # an unprivileged process can only lower its hard limit
+            hard = current_hard
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        return soft, hard
+
+    def apply(self):
+        """
+        Runs in the child between fork and exec (preexec_fn): keep it to syscalls
+        """
+        if self.cgroup is not None:
+            self.cgroup.attach(os.getpid())
+        for limit, soft, hard in self._rlimits():
+            resource.setrlimit(limit, self._bounded(soft, hard, resource.getrlimit(limit)[1]))
+
+    def apply_to(self, pid):
+        """
+        Limit an already started child (prlimit): for children started from threads, where a
+        preexec_fn can deadlock the child before exec
+        """
+        if self.cgroup is not None:
+            self.cgroup.attach(pid)
+        for limit, soft, hard in self._rlimits():
+            resource.prlimit(pid, limit, self._bounded(soft, hard, resource.prlimit(pid, limit)[1]))
+
+    def popen_kwargs(self):
+        """
+        Extra subprocess.Popen kwargs for a limited child
+        """
+        if not self:
+            return {}
+        return {'preexec_fn': self.apply}
+
+    def failure_reason(self, returncode, errors=(), cpu_time=None):
+        """
+        Limit the child ran into, from its exit status, error output and cpu seconds used, or None
+        """
+        if returncode == 0 or returncode is None:
+            return None
+        if self.cgroup is not None and self.cgroup.oom_killed():
+            return MEMORY_LIMIT
+        if returncode == -signal.SIGXCPU:
+            return CPU_LIMIT
+        if self.cpu_time is not None and cpu_time is not None and cpu_time >= self.cpu_time - 1:
+            # ffmpeg traps SIGXCPU and exits through its normal error path
+            return CPU_LIMIT
+        lowered = [line.lower() for line in errors]
+        if any(message in line for line in lowered for message in MEMORY_ERRORS):
+            return MEMORY_LIMIT
+        if any(message in line for line in lowered for message in OPEN_FILES_ERRORS):
+            return OPEN_FILES_LIMIT
+        return None
+
+    def release(self):
+        if self.cgroup is not None:
+            self.cgroup.remove()
+
+
+class JobCgroup(object):
+    """
+    Per job cgroup v2 directory under a delegated root
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def create(cls, root, name, memory_max=None, pids_max=None):
+        """
+        JobCgroup, or None (logged) if cgroups are not usable here
+        """
+        path = os.path.join(root, 'job-' + str(name))
+        try:
+            if not os.path.isdir(path):
+                os.mkdir(path)
+            cgroup = cls(path)
+            if memory_max is not None:
+                cgroup._write('memory.max', memory_max)
+                # no swapping around the limit
+                if os.path.exists(os.path.join(path, 'memory.swap.max')):
+                    cgroup._write('memory.swap.max', 0)
+            if pids_max is not None:
+                cgroup._write('pids.max', pids_max)
+        except (IOError, OSError) as exc:
+            logger.warning('ffmpeg cgroup unavailable ({path}): {error}, using rlimits'.format(
+                path=path,
+                error=exc
+            ))
+            return None
+        return cgroup
+
+    def attach(self, pid):
+        self._write('cgroup.procs', pid)
+
+    def oom_killed(self):
+        try:
+            with open(os.path.join(self.path, 'memory.events')) as events:
+                for line in events:
+                    key, value = line.split()
+                    if key == 'oom_kill':
+                        return int(value) > 0
+        except (IOError, OSError, ValueError):
+            pass
+        return False
+
+    def remove(self):
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            # still populated / already gone, the next job with this name reuses it
+            pass
+
+    def _write(self, name, value):
+        with open(os.path.join(self.path, name), 'w') as control:
+            control.write(str(value))
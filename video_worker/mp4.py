@@ -0,0 +1,194 @@
+"""
+Minimal MP4 / ISO BMFF box reader
+
+Answers what product validation needs from an mp4 / m4a (duration, tracks, moov placement,
+multi entry edit lists) by reading box headers with a few seeks and parsing only
+ftyp / moov (mvhd, mvex/mehd, trak/tkhd, mdia/mdhd, hdlr, edts/elst); no process is spawned
+and mdat is never read.
+
+read_mp4() returns None for anything it does not fully understand (no moov, truncated or
+inconsistent boxes, zero duration): callers fall back to ffprobe.
+
+"""
+
+import os
+import struct
+
+# containers walked on the way to the boxes read
+CONTAINERS = (b'moov', b'trak', b'mdia', b'edts', b'mvex')
+# moov is read whole; anything larger is not a layout this reader is for
+MAX_MOOV_SIZE = 256 * 1024 * 1024
+
+
+class Mp4Track(object):
+    def __init__(self):
+        self.track_id = None
+        # 'vide', 'soun', ...
+        self.handler = None
+        self.timescale = None
+        self.media_duration = None
+        # non empty edit list entries (media_time != -1)
+        self.edits = 0
+
+    @property
+    def duration(self):
+        if not self.timescale:
+            return None
+        return float(self.media_duration or 0) / self.timescale
+
+
+class Mp4Info(object):
+    """
+    What the boxes say: major_brand, duration (seconds), tracks, moov_first, fragmented
+    """
+    def __init__(self):
+        self.major_brand = None
+        self.timescale = None
+        self.movie_duration = None
+        self.fragment_duration = None
+        self.tracks = []
+        # moov ahead of the (first) mdat: progressive playback without a range request to the end
+        self.moov_first = None
+        self.fragmented = False
+
+    @property
+    def duration(self):
+        if not self.timescale:
+            return None
+        duration = self.fragment_duration if self.fragmented and self.fragment_duration else self.movie_duration
+        if duration:
+            return float(duration) / self.timescale
+        track_durations = [track.duration for track in self.tracks if track.duration]
+        return max(track_durations) if track_durations else None
+
+    @property
+    def desync(self):
+        """
+        ffprobe's 'multiple edit list entries, a/v desync might occur' case
+        """
+        return any(track.edits > 1 for track in self.tracks)
+
+
+def read_mp4(filepath):
+    """
+    Mp4Info for an mp4 / m4a file, None if the layout is not understood
+    """
+    try:
+        filesize = os.path.getsize(filepath)
+        with open(filepath, 'rb') as mp4_file:
+            return _read(mp4_file, filesize)
+    except (IOError, OSError, IndexError, struct.error, ValueError):
+        return None
+
+
+def _box_header(data, offset, end):
+    """
+    (box type, payload start, box end) of the box at offset
+    """
+    size, box_type = struct.unpack_from('>I4s', data, offset)
+    header = 8
+    if size == 1:
+        size = struct.unpack_from('>Q', data, offset + 8)[0]
+        header = 16
+    elif size == 0:
+        size = end - offset
+    if size < header or offset + size > end:
+        raise ValueError('bad box size')
+    return box_type, offset + header, offset + size
+
+
+def _read(mp4_file, filesize):
+    info = Mp4Info()
+    moov = None
+    mdat_seen = False
+    offset = 0
+    # every top level box header, so a truncated last box (killed encode) is noticed
+    while offset < filesize:
+        mp4_file.seek(offset)
+        header = mp4_file.read(16)
+        if len(header) < 8:
+            return None
+        size, box_type = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = filesize - offset
+        if size < header_size or offset + size > filesize:
+            return None
+
+        if box_type == b'ftyp':
+            info.major_brand = header[8:12].decode('ascii', 'replace')
+        elif box_type == b'moov':
+            if moov is not None or size > MAX_MOOV_SIZE:
+                return None
+            mp4_file.seek(offset + header_size)
+            moov = mp4_file.read(size - header_size)
+            info.moov_first = not mdat_seen
+        elif box_type == b'mdat':
+            mdat_seen = True
+        elif box_type == b'moof':
+            info.fragmented = True
+        offset += size
+
+    if moov is None:
+        return None
+    _parse(moov, 0, len(moov), info, None)
+    if info.timescale is None or not info.tracks or info.duration is None:
+        return None
+    return info
+
+
+def _parse(data, offset, end, info, track):
+    while offset + 8 <= end:
+        box_type, payload, box_end = _box_header(data, offset, end)
+        if box_type == b'trak':
+            track = Mp4Track()
+            info.tracks.append(track)
+            _parse(data, payload, box_end, info, track)
+            track = None
+        elif box_type in CONTAINERS:
+            if box_type == b'mvex':
+                info.fragmented = True
+            _parse(data, payload, box_end, info, track)
+        elif box_type == b'mvhd':
+            info.timescale, info.movie_duration = _timescale_duration(data, payload)
+        elif box_type == b'mehd':
+            version = data[payload]
+            info.fragment_duration = struct.unpack_from('>Q' if version == 1 else '>I', data, payload + 4)[0]
+        elif track is not None and box_type == b'tkhd':
+            version = data[payload]
+            track.track_id = struct.unpack_from('>I', data, payload + (20 if version == 1 else 12))[0]
+        elif track is not None and box_type == b'mdhd':
+            track.timescale, track.media_duration = _timescale_duration(data, payload)
+        elif track is not None and box_type == b'hdlr':
+            track.handler = data[payload + 8:payload + 12].decode('ascii', 'replace')
+        elif track is not None and box_type == b'elst':
+            track.edits = _edits(data, payload)
+        offset = box_end
+
+
+def _timescale_duration(data, payload):
+    """
+    (timescale, duration) of an mvhd / mdhd box
+    """
+    if data[payload] == 1:
+        return struct.unpack_from('>IQ', data, payload + 20)
+    return struct.unpack_from('>II', data, payload + 12)
+
+
+def _edits(data, payload):
+    version = data[payload]
+    count = struct.unpack_from('>I', data, payload + 4)[0]
+    # segment_duration, media_time, media_rate
+    if version == 1:
+        entry_size, media_time_offset, media_time_format = 20, 8, '>q'
+    else:
+        entry_size, media_time_offset, media_time_format = 12, 4, '>i'
+    edits = 0
+    for index in range(count):
+        entry = payload + 8 + index * entry_size
+        if struct.unpack_from(media_time_format, data, entry + media_time_offset)[0] != -1:
+            edits += 1
+    return edits
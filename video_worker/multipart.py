@@ -0,0 +1,325 @@
+"""
+Concurrent, resumable S3 multipart upload straight from a file
+
+Parts are read at their offsets in the product itself (no split copy on disk, no chdir) by one
+sequential reader, which also feeds the whole file md5, and uploaded by a bounded pool of
+`concurrency` workers, each with its own S3 connection. At most `concurrency` parts are in
+flight, so memory stays around concurrency x part_size whatever the file size.
+
+A failed part is retried `retries` times with exponential backoff. The upload id and the
+completed parts are kept in a JSON state file (<product>.upload.json, in a state dir that
+outlives the per job workdir): an upload that still fails is left open, and the retried job
+resumes it, skipping every part S3 already holds with the same md5. Without a stored state the
+failed upload is aborted. Uploads that can not be resumed (product size / part size changed),
+other uploads of the key and those of state files older than `abandon_after` seconds
+(abort_abandoned_states) are aborted.
+
+"""
+
+import base64
+import datetime
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from boto.exception import BotoClientError, BotoServerError, S3ResponseError
+from boto.s3.multipart import MultiPartUpload
+from boto.utils import parse_ts
+from six.moves import http_client
+
+logger = logging.getLogger(__name__)
+
+MEGABYTE = 1024 * 1024
+# S3: every part but the last at least 5 MB, at most 10000 parts
+MIN_PART_SIZE = 5 * MEGABYTE
+MAX_PARTS = 10000
+DEFAULT_PART_SIZE = 16 * MEGABYTE
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+DEFAULT_ABANDON_AFTER = 24 * 3600
+UPLOAD_STATE_SUFFIX = '.upload.json'
+
+UPLOAD_ERRORS = (BotoClientError, BotoServerError, http_client.HTTPException, IOError, OSError)
+
+
+def part_size_for(filesize, part_size=DEFAULT_PART_SIZE):
+    """
+    part_size raised to S3's minimum, and to what keeps filesize within MAX_PARTS parts
+    """
+    return max(int(part_size), MIN_PART_SIZE, int(math.ceil(float(filesize) / MAX_PARTS)))
+
+
+def persisted_part_size(state_path):
+    """
+    Part size of the upload a state file records, None without one
+    """
+    if not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path) as state_file:
+            return json.load(state_file).get('part_size')
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+
+def abort_abandoned_states(state_dir, connect, abandon_after=DEFAULT_ABANDON_AFTER):
+    """
+    Abort the uploads of state files not touched for abandon_after seconds (their jobs were never
+    retried) and remove the files; connect() is only called when there is one
+    """
+    if not os.path.isdir(state_dir):
+        return 0
+    cutoff = time.time() - abandon_after
+    bucket = None
+    aborted = 0
+    for entry in os.listdir(state_dir):
+        state_path = os.path.join(state_dir, entry)
+        if not entry.endswith(UPLOAD_STATE_SUFFIX) or os.path.getmtime(state_path) >= cutoff:
+            continue
+        try:
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+        except (IOError, OSError, ValueError):
+            state = {}
+        if state.get('upload_id') and state.get('key_name'):
+            bucket = bucket or connect()
+            if bucket is None:
+                return aborted
+            upload = MultiPartUpload(bucket)
+            upload.key_name = state['key_name']
+            upload.id = state['upload_id']
+            logger.info(': {file} Aborting abandoned multipart upload {upload_id}'.format(
+                file=upload.key_name, upload_id=upload.id
+            ))
+            try:
+                upload.cancel_upload()
+            except S3ResponseError as exc:
+                # completed or aborted already
+                if exc.status != 404:
+                    continue
+            except UPLOAD_ERRORS:
+                continue
+            aborted += 1
+        os.remove(state_path)
+    return aborted
+
+
+class MultipartUpload(object):
+    """
+    Upload filepath to key_name of the bucket connect() returns (None: no bucket)
+    """
+    def __init__(self, filepath, key_name, connect, **kwargs):
+        self.filepath = filepath
+        self.key_name = key_name
+        self.connect = connect
+        self.filesize = os.path.getsize(filepath)
+        self.part_size = part_size_for(self.filesize, kwargs.get('part_size', DEFAULT_PART_SIZE))
+        self.concurrency = max(1, int(kwargs.get('concurrency', DEFAULT_CONCURRENCY)))
+        self.retries = kwargs.get('retries', DEFAULT_RETRIES)
+        self.backoff = kwargs.get('backoff', DEFAULT_BACKOFF)
+        self.abandon_after = kwargs.get('abandon_after', DEFAULT_ABANDON_AFTER)
+        # None: nothing persisted, no resume
+        self.state_path = kwargs.get('state_path', None)
+        self.hash_sum = None
+        self.parts = 0
+        # parts S3 already had from an earlier attempt, part upload retries
+        self.resumed_parts = 0
+        self.part_retries = 0
+        self._state = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _bucket(self):
+        """
+        This thread's bucket (boto connections are not shared between threads)
+        """
+        if getattr(self._local, 'bucket', None) is None:
+            self._local.bucket = self.connect()
+        return self._local.bucket
+
+    def _handle(self, upload_id):
+        upload = MultiPartUpload(self._bucket())
+        upload.key_name = self.key_name
+        upload.id = upload_id
+        return upload
+
+    def _save_state(self):
+        if self.state_path is None:
+            return
+        with open(self.state_path + '.tmp', 'w') as state_file:
+            json.dump(self._state, state_file)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def _clear_state(self):
+        if self.state_path is not None and os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def _resume(self):
+        """
+        (upload, {part number: md5 S3 holds}) of the persisted upload, None if there is none to resume
+        """
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return None
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+        except (IOError, OSError, ValueError):
+            return None
+        upload = self._handle(state.get('upload_id'))
+        if (state.get('key_name'), state.get('filesize'), state.get('part_size')) != \
+                (self.key_name, self.filesize, self.part_size):
+            logger.info(': {file} Aborting multipart upload {upload_id}: product changed'.format(
+                file=self.key_name, upload_id=upload.id
+            ))
+            self._abort(upload)
+            return None
+        try:
+            # what S3 has is authoritative, the state file may lag a part or two behind
+            uploaded = dict((part.part_number, part.etag.strip('"')) for part in upload)
+        except S3ResponseError:
+            # completed or aborted since
+            return None
+        self._state = state
+        return upload, uploaded
+
+    def _abort(self, upload):
+        try:
+            upload.cancel_upload()
+        except UPLOAD_ERRORS as exc:
+            logger.warning(': {file} Multipart upload {upload_id} not aborted: {error}'.format(
+                file=self.key_name, upload_id=upload.id, error=exc
+            ))
+
+    def _abort_abandoned(self, bucket, keep):
+        """
+        Abort other uploads of this key started more than abandon_after seconds ago
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.abandon_after)
+        try:
+            uploads = bucket.get_all_multipart_uploads(prefix=self.key_name)
+        except UPLOAD_ERRORS:
+            return
+        for upload in uploads:
+            if upload.key_name != self.key_name or upload.id == keep:
+                continue
+            try:
+                initiated = parse_ts(upload.initiated)
+            except (TypeError, ValueError):
+                continue
+            if initiated < cutoff:
+                logger.info(': {file} Aborting abandoned multipart upload {upload_id}'.format(
+                    file=self.key_name, upload_id=upload.id
+                ))
+                self._abort(upload)
+
+    def _upload_part(self, upload_id, part_number, data, md5):
+        """
+        Upload one part, retrying with exponential backoff; the part is recorded as completed
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                self._handle(upload_id).upload_part_from_file(
+                    io.BytesIO(data), part_number,
+                    md5=(md5.hexdigest(), base64.b64encode(md5.digest()).decode('ascii'))
+                )
+                break
+            except UPLOAD_ERRORS as exc:
+                if attempt == self.retries:
+                    raise
+                logger.warning(': {file} Part {part} failed ({error}), retry {attempt}'.format(
+                    file=self.key_name, part=part_number, error=exc, attempt=attempt + 1
+                ))
+                with self._lock:
+                    self.part_retries += 1
+                time.sleep(self.backoff * 2 ** attempt)
+        self._part_done(part_number, md5.hexdigest())
+
+    def _part_done(self, part_number, etag):
+        with self._lock:
+            self._state['parts'][str(part_number)] = etag
+            self._save_state()
+
+    def run(self):
+        """
+        Upload (or resume) every part and complete the upload. True when complete; a failed
+        upload is left open to be resumed when there is a state file, aborted otherwise.
+        """
+        bucket = self._bucket()
+        if bucket is None:
+            return False
+        uploaded = {}
+        try:
+            resumed = self._resume()
+            if resumed is not None:
+                upload, uploaded = resumed
+            else:
+                upload = bucket.initiate_multipart_upload(self.key_name)
+        except UPLOAD_ERRORS as exc:
+            logger.error(': {file} Multipart upload not started: {error}'.format(file=self.key_name, error=exc))
+            return False
+        if resumed is None:
+            self._state = {
+                'key_name': self.key_name,
+                'upload_id': upload.id,
+                'filesize': self.filesize,
+                'part_size': self.part_size,
+                'parts': {},
+            }
+            try:
+                self._save_state()
+            except (IOError, OSError) as exc:
+                # nothing could ever resume it
+                logger.error(': {file} Multipart upload state not stored: {error}'.format(
+                    file=self.key_name, error=exc
+                ))
+                self._abort(upload)
+                return False
+        self._abort_abandoned(bucket, upload.id)
+
+        file_md5 = hashlib.md5()
+        in_flight = threading.BoundedSemaphore(self.concurrency)
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            with open(self.filepath, 'rb') as upload_file:
+                for part_number, offset in enumerate(range(0, self.filesize, self.part_size), 1):
+                    in_flight.acquire()
+                    if any(future.done() and future.exception() for future in futures):
+                        in_flight.release()
+                        break
+                    upload_file.seek(offset)
+                    data = upload_file.read(self.part_size)
+                    file_md5.update(data)
+                    md5 = hashlib.md5(data)
+                    if uploaded.get(part_number) == md5.hexdigest():
+                        self.resumed_parts += 1
+                        self._part_done(part_number, md5.hexdigest())
+                        in_flight.release()
+                        continue
+                    future = pool.submit(self._upload_part, upload.id, part_number, data, md5)
+                    future.add_done_callback(lambda _: in_flight.release())
+                    futures.append(future)
+                    del data
+        errors = [future.exception() for future in futures if future.exception()]
+        self.parts = len(self._state['parts'])
+
+        try:
+            if errors:
+                logger.error(': {file} Multipart upload failed: {error}'.format(file=self.key_name, error=errors[0]))
+                if self.state_path is None or not os.path.exists(self.state_path):
+                    # no state survives this attempt: nothing would resume the upload
+                    self._abort(upload)
+                return False
+            upload.complete_upload()
+        except UPLOAD_ERRORS as exc:
+            logger.error(': {file} Multipart upload not completed: {error}'.format(file=self.key_name, error=exc))
+            return False
+        self._clear_state()
+        self.hash_sum = file_md5.hexdigest()
+        return True
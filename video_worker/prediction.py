@@ -0,0 +1,188 @@
+"""
+Encode time prediction
+
+Every finished encode is appended to a (per node) history file:
+    profile, mezz_duration, source resolution / bitrate, node cpu count, encode wall time
+
+A small least squares model is fit per profile from that history:
+
+    encode_time ~ b0 + b1 * duration + b2 * duration * megapixels
+                + b3 * duration * source_mbps + b4 * duration / cpus
+
+With too little history to fit, the profile's median (encode_time / duration) is used.
+Stream copy remuxes take a fraction of an encode's time, they are kept under their own
+'<profile>_remux' key (history_key) so they do not drag the profile's predictions down.
+
+"""
+
+import json
+import logging
+import os
+import time
+
+import numpy
+
+from .reporting import Output
+
+logger = logging.getLogger(__name__)
+
+# fit only on the most recent records per profile
+HISTORY_WINDOW = 500
+# below this many records the median seconds-per-second ratio is used instead
+MIN_FIT_RECORDS = 10
+REMUX_SUFFIX = '_remux'
+
+
+class EncodeHistory(object):
+    """
+    Append only JSON lines file of finished encodes
+    """
+    def __init__(self, history_file):
+        self.history_file = history_file
+
+    def record(self, profile, mezz_duration, mezz_resolution, mezz_bitrate, encode_time, **kwargs):
+        record = dict(
+            features(mezz_duration, mezz_resolution, mezz_bitrate, kwargs.get('cpu_count', None)),
+            profile=profile,
+            encode_time=float(encode_time),
+            recorded=int(time.time())
+        )
+        try:
+            with open(self.history_file, 'a') as history:
+                history.write(json.dumps(record, sort_keys=True) + '\n')
+        except (IOError, OSError) as exc:
+            logger.error(': {file} Encode history not written: {error}'.format(
+                file=self.history_file,
+                error=exc
+            ))
+            return None
+        return record
+
+    def records(self, profile):
+        if not os.path.exists(self.history_file):
+            return []
+        profile_records = []
+        with open(self.history_file) as history:
+            for line in history:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('profile') == profile:
+                    profile_records.append(record)
+        return profile_records[-HISTORY_WINDOW:]
+
+
+class EncodeTimeModel(object):
+    """
+    Per profile encode wall time model
+    """
+    def __init__(self, records):
+        self.records = [r for r in records if r.get('mezz_duration') and r.get('encode_time') is not None]
+        self.coefficients = None
+        self.fill = None
+        self.ratio = None
+        self._fit()
+
+    def _fit(self):
+        if len(self.records) == 0:
+            return
+
+        durations = numpy.array([r['mezz_duration'] for r in self.records], dtype=float)
+        encode_times = numpy.array([r['encode_time'] for r in self.records], dtype=float)
+        self.ratio = float(numpy.median(encode_times / durations))
+
+        if len(self.records) < MIN_FIT_RECORDS:
+            return
+
+        # minimum norm solution, so constant columns (e.g. one node's cpu count) are harmless
+        design, self.fill = _design_matrix(self.records)
+        self.coefficients = numpy.linalg.lstsq(design, encode_times, rcond=None)[0]
+
+    def predict(self, mezz_duration, mezz_resolution=None, mezz_bitrate=None, cpu_count=None):
+        """
+        Predicted encode wall time in seconds, None without any history
+        """
+        if not mezz_duration:
+            return None
+        record = features(mezz_duration, mezz_resolution, mezz_bitrate, cpu_count)
+        if self.coefficients is not None:
+            design, _ = _design_matrix([record], self.fill)
+            prediction = float(design.dot(self.coefficients)[0])
+            if prediction > 0:
+                return prediction
+        if self.ratio is not None:
+            return self.ratio * float(mezz_duration)
+        return None
+
+
+def features(mezz_duration, mezz_resolution, mezz_bitrate, cpu_count=None):
+    """
+    Model inputs from the Video object's mezz_* fields
+    """
+    width, height = None, None
+    if mezz_resolution and 'x' in str(mezz_resolution):
+        try:
+            width, height = [int(r) for r in str(mezz_resolution).strip().split('x')[:2]]
+        except ValueError:
+            pass
+    return {
+        'mezz_duration': float(mezz_duration) if mezz_duration else None,
+        'source_width': width,
+        'source_height': height,
+        'source_kbps': Output.kbps_from_string(mezz_bitrate),
+        'cpu_count': cpu_count or os.cpu_count(),
+    }
+
+
+def history_key(profile, ffcommand=None, remux=False):
+    """
+    History / model key of an encode: its profile, or '<profile>_remux' for a stream copy
+    """
+    if remux or (ffcommand and '-c:v copy' in ' '.join(ffcommand)):
+        return profile + REMUX_SUFFIX
+    return profile
+
+
+def predict_encode_time(history_file, profile, mezz_duration, mezz_resolution=None, mezz_bitrate=None):
+    """
+    Predicted encode wall time (seconds) for a job before it starts, None without history
+    """
+    model = EncodeTimeModel(EncodeHistory(history_file).records(profile))
+    return model.predict(mezz_duration, mezz_resolution, mezz_bitrate)
+
+
+def _design_matrix(records, fill=None):
+    """
+    [1, d, d * megapixels, d * source_mbps, d / cpus] per record
+
+    Unknown inputs are filled with the column median (of the training records, when fill is given)
+    """
+    fill = fill or {}
+    durations = numpy.array([r['mezz_duration'] for r in records], dtype=float)
+    megapixels, megapixels_fill = _column(records, fill.get('megapixels'), lambda r: (
+        (r['source_width'] * r['source_height']) / 1e6 if r.get('source_width') and r.get('source_height') else None
+    ))
+    mbps, mbps_fill = _column(records, fill.get('mbps'), lambda r: (
+        r['source_kbps'] / 1000.0 if r.get('source_kbps') else None
+    ))
+    cpus, cpus_fill = _column(records, fill.get('cpus'), lambda r: (
+        float(r['cpu_count']) if r.get('cpu_count') else None
+    ))
+    design = numpy.column_stack((
+        numpy.ones_like(durations),
+        durations,
+        durations * megapixels,
+        durations * mbps,
+        durations / cpus,
+    ))
+    return design, {'megapixels': megapixels_fill, 'mbps': mbps_fill, 'cpus': cpus_fill}
+
+
+def _column(records, fill, getter):
+    values = numpy.array([numpy.nan if getter(r) is None else getter(r) for r in records], dtype=float)
+    if fill is None:
+        known = values[~numpy.isnan(values)]
+        fill = float(numpy.median(known)) if len(known) else 1.0
+    values[numpy.isnan(values)] = fill
+    return values, fill
@@ -0,0 +1,121 @@
+"""
+CPU / IO priority classes for encode jobs
+
+Each queue (or task) carries a priority class; the job process takes its nice value and
+ionice class / level, and every ffmpeg / ffprobe child it spawns inherits them. Interactive
+uploads keep their latency while bulk re-encode campaigns (e.g. the HLS backfill) run on
+what the node has to spare:
+
+    interactive - nice 0, best-effort io level 0
+    normal      - nice 5, best-effort io level 4
+    bulk        - nice 19, idle io (disk time only when nobody else wants it)
+
+Classes can be redefined / added with the `priority_classes` setting; queues map to classes
+with `queue_priority_classes`. Without a class the job keeps the priority it was started with.
+
+Note an unprivileged worker can only lower its priority (raise nice), so a job process that
+already runs at nice 5 can not go back to the interactive nice 0.
+
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+
+from video_worker.utils import get_config
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+NORMAL = 'normal'
+BULK = 'bulk'
+
+# ionice scheduling classes
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+PRIORITY_CLASSES = {
+    INTERACTIVE: {'nice': 0, 'ionice_class': 'best-effort', 'ionice_level': 0},
+    NORMAL: {'nice': 5, 'ionice_class': 'best-effort', 'ionice_level': 4},
+    BULK: {'nice': 19, 'ionice_class': 'idle'},
+}
+
+
+def priority_classes(settings=None):
+    """
+    Known priority classes: the defaults, updated with the `priority_classes` setting
+    """
+    settings = settings or get_config()
+    classes = dict(PRIORITY_CLASSES)
+    classes.update(settings.get('priority_classes', None) or {})
+    return classes
+
+
+def priority_for_queue(queue, settings=None):
+    """
+    Priority class for a celery queue / routing key (`queue_priority_classes`), or None
+    """
+    settings = settings or get_config()
+    queue_classes = settings.get('queue_priority_classes', None) or {}
+    return queue_classes.get(queue, settings.get('default_priority_class', None))
+
+
+def apply_priority(priority_class, settings=None, pid=0):
+    """
+    Set the nice value and io priority of process `pid` (0: this process) for a priority class;
+    processes started afterwards inherit both. Returns True if the class was applied in full.
+    """
+    if priority_class is None:
+        return False
+    classes = priority_classes(settings=settings)
+    if priority_class not in classes:
+        logger.error('Unknown priority class {priority_class}, expected one of {classes}'.format(
+            priority_class=priority_class,
+            classes=', '.join(sorted(classes))
+        ))
+        return False
+
+    priority = classes[priority_class]
+    applied = True
+    if priority.get('nice', None) is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, int(priority['nice']))
+        except OSError as exc:
+            logger.warning('{priority_class} priority: could not set nice {nice}: {error}'.format(
+                priority_class=priority_class,
+                nice=priority['nice'],
+                error=exc
+            ))
+            applied = False
+
+    if priority.get('ionice_class', None) is not None:
+        applied = _ionice(
+            pid or os.getpid(),
+            IONICE_CLASSES.get(priority['ionice_class'], priority['ionice_class']),
+            priority.get('ionice_level', None)
+        ) and applied
+
+    logger.info('{priority_class} priority: nice {nice}, io {ionice_class} {ionice_level}'.format(
+        priority_class=priority_class,
+        nice=priority.get('nice', None),
+        ionice_class=priority.get('ionice_class', None),
+        ionice_level=priority.get('ionice_level', '')
+    ))
+    return applied
+
+
+def _ionice(pid, ionice_class, ionice_level=None):
+    ionice = shutil.which('ionice')
+    if ionice is None:
+        logger.warning('ionice not found, io priority left unchanged')
+        return False
+    command = [ionice, '-c', str(ionice_class)]
+    if ionice_level is not None:
+        command += ['-n', str(ionice_level)]
+    command += ['-p', str(pid)]
+    try:
+        subprocess.check_call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (subprocess.CalledProcessError, OSError) as exc:
+        logger.warning('ionice failed: {error}'.format(error=exc))
+        return False
+    return True
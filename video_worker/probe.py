@@ -0,0 +1,364 @@
+"""
+One probe per media file
+
+ffprobe is run once per file (`-print_format json -show_format -show_streams`, no text
+scraping) into a typed ProbeResult, cached by (path, size, mtime): the intake check, the
+Video attributes, the stream copy / scaling decisions and thumbnail positions all read the
+same result instead of each spawning ffprobe. A rewritten file (size / mtime change) is
+probed again.
+
+Fast probe (`fast_probe` setting): ffprobe first runs with a bounded probesize /
+analyzeduration, so huge or oddly muxed files are not scanned deep into the file, and is
+re-run unbounded only when that result is ambiguous (no duration, duration estimated from
+bitrate, incomplete video stream parameters). Escalations and the probe time saved are kept in
+`stats` and reported with the job metrics.
+
+The time saved is measured, not guessed from escalations (those are the slowest, ambiguous
+files): one in `calibrate_every` conclusive bounded probes is also run unbounded, and the
+bounded / full times are appended to a per node history (PROBE_HISTORY_FILE). The saving is
+the mean difference over that history; without any calibration yet it is reported as None.
+
+"""
+
+import json
+import logging
+import os
+import random
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+
+from .global_vars import PROBE_HISTORY_FILE
+
+logger = logging.getLogger(__name__)
+
+DESYNC_WARNING = 'multiple edit list entries, a/v desync might occur'
+# ffprobe warnings meaning a bounded probe did not see enough of the file
+AMBIGUOUS_WARNINGS = (
+    'estimating duration from bitrate',
+    'could not find codec parameters',
+    "consider increasing the value for the 'analyzeduration'",
+)
+# probe results kept (least recently used dropped first)
+CACHE_SIZE = 128
+# calibrations the mean time saved is taken over
+CALIBRATION_WINDOW = 100
+
+_CACHE = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _kbps(bit_rate):
+    if not bit_rate:
+        return None
+    return '{} kb/s'.format(bit_rate // 1000)
+
+
+class ProbeResult(object):
+    """
+    Probed container / first video and audio stream attributes of a media file
+        duration (seconds, None if zero/unknown), bit_rate / audio_bit_rate (bits/s),
+        width / height, video_codec, pix_fmt, audio_codec,
+        desync (True for the 'multiple edit list entries' a/v desync warning)
+    """
+    def __init__(self, filepath, **kwargs):
+        self.filepath = filepath
+        self.filesize = kwargs.get('filesize', None)
+        self.format_name = kwargs.get('format_name', None)
+        self.duration = kwargs.get('duration', None)
+        self.bit_rate = kwargs.get('bit_rate', None)
+        self.width = kwargs.get('width', None)
+        self.height = kwargs.get('height', None)
+        self.video_codec = kwargs.get('video_codec', None)
+        self.pix_fmt = kwargs.get('pix_fmt', None)
+        self.audio_codec = kwargs.get('audio_codec', None)
+        self.audio_bit_rate = kwargs.get('audio_bit_rate', None)
+        self.desync = kwargs.get('desync', False)
+        # raw ffprobe stream dicts / warning lines
+        self.streams = kwargs.get('streams', [])
+        self.warnings = kwargs.get('warnings', [])
+
+    @classmethod
+    def from_ffprobe(cls, filepath, probe_data, warnings=''):
+        """
+        ProbeResult from ffprobe's json output (-show_format -show_streams)
+        """
+        container = probe_data.get('format', {})
+        streams = probe_data.get('streams', [])
+        duration = _float(container.get('duration', None))
+        result = cls(
+            filepath,
+            filesize=_int(container.get('size', None)),
+            format_name=container.get('format_name', None),
+            duration=duration if duration is not None and duration > 0 else None,
+            bit_rate=_int(container.get('bit_rate', None)),
+            desync=DESYNC_WARNING in warnings,
+            streams=streams,
+            warnings=[line for line in warnings.splitlines() if line.strip()]
+        )
+        video_streams = [
+            stream for stream in streams
+            if stream.get('codec_type') == 'video' and not stream.get('disposition', {}).get('attached_pic', 0)
+        ]
+        if video_streams:
+            result.video_codec = video_streams[0].get('codec_name', None)
+            result.pix_fmt = video_streams[0].get('pix_fmt', None)
+            result.width = _int(video_streams[0].get('width', None)) or None
+            result.height = _int(video_streams[0].get('height', None)) or None
+        audio_streams = [stream for stream in streams if stream.get('codec_type') == 'audio']
+        if audio_streams:
+            result.audio_codec = audio_streams[0].get('codec_name', None)
+            result.audio_bit_rate = _int(audio_streams[0].get('bit_rate', None))
+        return result
+
+    @property
+    def resolution(self):
+        """
+        'WxH', as VEDA stores it
+        """
+        if not self.width or not self.height:
+            return None
+        return '{}x{}'.format(self.width, self.height)
+
+    @property
+    def bitrate(self):
+        """
+        'N kb/s', as VEDA stores it
+        """
+        return _kbps(self.bit_rate)
+
+    @property
+    def audio_bitrate(self):
+        return _kbps(self.audio_bit_rate)
+
+    def ambiguous(self):
+        """
+        True if a bounded (fast) probe left something a full probe could settle
+        """
+        if self.duration is None:
+            return True
+        has_video = any(stream.get('codec_type') == 'video' for stream in self.streams)
+        if has_video and not (self.video_codec and self.pix_fmt and self.width and self.height):
+            return True
+        return any(message in line.lower() for line in self.warnings for message in AMBIGUOUS_WARNINGS)
+
+    def attributes(self):
+        """
+        Non empty attributes as a dict (see ValidateVideo.get_video_attributes)
+        """
+        attributes = {'duration': self.duration}
+        for key in ('filesize', 'bitrate', 'resolution', 'video_codec', 'pix_fmt', 'audio_codec', 'audio_bitrate'):
+            value = getattr(self, key)
+            if value is not None:
+                attributes[key] = value
+        return attributes
+
+
+def ffprobe(filepath, ffprobe_path='ffprobe', popen_kwargs=None, probesize=None, analyzeduration=None):
+    """
+    ProbeResult from a single json ffprobe run, None if the file is missing / unreadable;
+    probesize (bytes) / analyzeduration (microseconds) bound how much of the file is read
+    """
+    command = [ffprobe_path, '-hide_banner', '-v', 'warning']
+    if probesize is not None:
+        command += ['-probesize', str(int(probesize))]
+    if analyzeduration is not None:
+        command += ['-analyzeduration', str(int(analyzeduration))]
+    command += ['-print_format', 'json', '-show_format', '-show_streams', filepath]
+    try:
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **(popen_kwargs or {})
+        )
+    except OSError as exc:
+        logger.error(': {filepath} probe failed: {error}'.format(filepath=filepath, error=exc))
+        return None
+    stdoutdata, stderrdata = process.communicate()
+    if process.returncode != 0:
+        return None
+    try:
+        probe_data = json.loads(stdoutdata.decode('utf-8', 'replace'))
+    except ValueError:
+        return None
+    if 'format' not in probe_data:
+        return None
+    return ProbeResult.from_ffprobe(filepath, probe_data, stderrdata.decode('utf-8', 'replace'))
+
+
+def fast_probe(filepath, ffprobe_path='ffprobe', popen_kwargs=None, probesize=None, analyzeduration=None,
+               calibrate_every=None):
+    """
+    Bounded ffprobe, escalated to a full probe when the bounded result is ambiguous / unreadable;
+    a conclusive one is also timed unbounded with 1 / calibrate_every probability
+    """
+    start = time.time()
+    result = ffprobe(
+        filepath,
+        ffprobe_path=ffprobe_path,
+        popen_kwargs=popen_kwargs,
+        probesize=probesize,
+        analyzeduration=analyzeduration
+    )
+    fast_time = time.time() - start
+    if result is not None and not result.ambiguous():
+        if calibrate_every and random.random() * calibrate_every < 1:
+            start = time.time()
+            ffprobe(filepath, ffprobe_path=ffprobe_path, popen_kwargs=popen_kwargs)
+            stats.record(fast_time=fast_time, full_time=time.time() - start, calibration=True)
+        else:
+            stats.record(fast_time=fast_time)
+        return result
+
+    logger.info(': {filepath} bounded probe inconclusive, full probe'.format(filepath=filepath))
+    start = time.time()
+    result = ffprobe(filepath, ffprobe_path=ffprobe_path, popen_kwargs=popen_kwargs)
+    stats.record(fast_time=fast_time, full_time=time.time() - start)
+    return result
+
+
+class ProbeStats(object):
+    """
+    Probe counters for the job metrics: fast probes, escalations, time spent, and time saved,
+    from the calibrations (bounded and full time of the same file) in history_file
+    """
+    def __init__(self, history_file=None):
+        self.history_file = history_file
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.probes = 0
+        self.fast_probes = 0
+        self.escalations = 0
+        self.fast_time = 0.0
+        self.full_probes = 0
+        self.full_time = 0.0
+        # seconds spent on bounded probes that had to be escalated anyway
+        self.wasted_time = 0.0
+        # full probes run only to measure the saving
+        self.calibrations = 0
+        self.calibration_time = 0.0
+
+    def record(self, fast_time=None, full_time=None, calibration=False):
+        with self.lock:
+            self.probes += 1
+            if calibration:
+                self.fast_probes += 1
+                self.fast_time += fast_time
+                self.calibrations += 1
+                self.calibration_time += full_time
+                self._record_calibration(fast_time, full_time)
+                return
+            if full_time is not None:
+                self.full_probes += 1
+                self.full_time += full_time
+            if fast_time is None:
+                return
+            if full_time is None:
+                self.fast_probes += 1
+                self.fast_time += fast_time
+            else:
+                self.escalations += 1
+                self.wasted_time += fast_time
+
+    def _record_calibration(self, fast_time, full_time):
+        if self.history_file is None:
+            return
+        try:
+            with open(self.history_file, 'a') as history:
+                history.write(json.dumps({
+                    'fast_time': fast_time, 'full_time': full_time, 'recorded': int(time.time())
+                }, sort_keys=True) + '\n')
+        except (IOError, OSError) as exc:
+            logger.error(': {file} Probe history not written: {error}'.format(file=self.history_file, error=exc))
+
+    def mean_saving(self):
+        """
+        Mean seconds a conclusive bounded probe saves over a full one on this node, None unmeasured
+        """
+        if self.history_file is None or not os.path.exists(self.history_file):
+            return None
+        savings = []
+        with open(self.history_file) as history:
+            for line in history:
+                try:
+                    record = json.loads(line)
+                    savings.append(float(record['full_time']) - float(record['fast_time']))
+                except (ValueError, KeyError, TypeError):
+                    continue
+        savings = savings[-CALIBRATION_WINDOW:]
+        if not savings:
+            return None
+        return sum(savings) / len(savings)
+
+    def metrics(self):
+        with self.lock:
+            if not self.probes:
+                return {}
+            metrics = {
+                'probe_count': self.probes,
+                'probe_escalations': self.escalations,
+                'probe_time': self.fast_time + self.full_time + self.wasted_time + self.calibration_time,
+            }
+            if not (self.fast_probes or self.escalations):
+                return metrics
+            metrics['probe_escalation_rate'] = float(self.escalations) / (self.fast_probes + self.escalations)
+            mean_saving = self.mean_saving()
+            if mean_saving is None:
+                # unmeasured on this node: reported as unavailable, not as zero
+                metrics['probe_time_saved'] = None
+                metrics['probe_time_saved_per_probe'] = None
+                return metrics
+            time_saved = mean_saving * self.fast_probes - self.wasted_time - self.calibration_time
+            metrics['probe_time_saved'] = time_saved
+            metrics['probe_time_saved_per_probe'] = time_saved / (self.fast_probes + self.escalations)
+            return metrics
+
+
+stats = ProbeStats(PROBE_HISTORY_FILE)
+
+
+def probe_file(filepath, engine):
+    """
+    Cached `engine.probe(filepath)`, keyed by path, size and mtime; None if unreadable
+    """
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+    with _CACHE_LOCK:
+        if key in _CACHE:
+            _CACHE.move_to_end(key)
+            return _CACHE[key]
+
+    result = engine.probe(filepath)
+    if result is not None:
+        result.filesize = stat.st_size
+        with _CACHE_LOCK:
+            _CACHE[key] = result
+            while len(_CACHE) > CACHE_SIZE:
+                _CACHE.popitem(last=False)
+    return result
+
+
+def clear_cache():
+    with _CACHE_LOCK:
+        _CACHE.clear()
@@ -0,0 +1,162 @@
+"""
+ffmpeg structured progress
+
+Commands are generated with '-nostats -progress pipe:1', so ffmpeg writes blocks of
+key=value lines ending in 'progress=continue|end' on stdout. stderr (header, warnings,
+errors) shares the same pipe; those lines are kept for the duration and error lines.
+
+One ProgressParser per encode; logs, job metrics and the stall watchdog subscribe to its events.
+
+"""
+
+import logging
+import re
+import time
+
+from .reporting import Output
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_LINE = re.compile(r'^([a-z0-9_]+)=\s*(\S*)\s*$')
+ERROR_LINE = re.compile(
+    r'error|invalid|corrupt|non-existing|missing|cannot allocate|out of memory|too many open files'
+    r'|reserved_moov_size is too small',
+    re.IGNORECASE
+)
+
+
+class ProgressEvent(object):
+    """
+    One '-progress' block
+    """
+    def __init__(self, block):
+        self.frame = _number(block.get('frame'), int)
+        self.fps = _number(block.get('fps'), float)
+        self.bitrate = _number(block.get('bitrate', '').replace('kbits/s', ''), float)
+        self.total_size = _number(block.get('total_size'), int)
+        out_time_us = _number(block.get('out_time_us'), int)
+        # ffmpeg reports INT64_MIN (or N/A) before the first packet
+        self.out_time = out_time_us / 1000000.0 if out_time_us is not None and out_time_us >= 0 else None
+        self.speed = _number(block.get('speed', '').replace('x', ''), float)
+        self.end = block.get('progress') == 'end'
+
+    @property
+    def marker(self):
+        """
+        What counts as 'moving' for the stall watchdog
+        """
+        return self.out_time if self.out_time is not None else self.frame
+
+
+class ProgressParser(object):
+    """
+    Parse a merged ffmpeg stdout/stderr stream into ProgressEvents
+    """
+    def __init__(self, duration=None):
+        self.duration = duration
+        self.listeners = []
+        self.events = 0
+        self.last_event = None
+        self.errors = []
+        self._block = {}
+
+    def subscribe(self, listener):
+        """
+        listener(parser, event) is called for every progress block
+        """
+        self.listeners.append(listener)
+        return self
+
+    def run(self, stream):
+        """
+        Consume the stream until EOF
+        """
+        for line in iter(stream.readline, ''):
+            self.feed(line)
+        return self
+
+    def feed(self, line):
+        line = line.strip()
+        if not line:
+            return
+
+        match = PROGRESS_LINE.match(line)
+        if match is not None:
+            key, value = match.groups()
+            self._block[key] = value
+            if key == 'progress':
+                self._emit(ProgressEvent(self._block))
+                self._block = {}
+            return
+
+        if self.duration is None and 'Duration: ' in line:
+            duration = line.split('Duration: ')[1].split(',')[0].strip()
+            if ':' in duration:
+                self.duration = Output.seconds_from_string(duration=duration)
+        elif ERROR_LINE.search(line):
+            self.errors.append(line)
+
+    def incomplete(self, duration=None, tolerance=5):
+        """
+        Why the stream does not vouch for a complete, clean output (None if it does):
+        it must have ended, with frames, no error lines, and out_time within tolerance of the duration
+        """
+        event = self.last_event
+        duration = duration or self.duration
+        if event is None or not event.end:
+            return 'no end of stream'
+        if self.errors:
+            return '{} error lines'.format(len(self.errors))
+        if not event.frame:
+            return 'no frames'
+        if event.out_time is None or event.out_time < 1.05:
+            return 'out_time {}'.format(event.out_time)
+        if duration and abs(event.out_time - float(duration)) > tolerance:
+            return 'out_time {} for a {}s source'.format(event.out_time, duration)
+        return None
+
+    def percent(self, event=None):
+        event = event or self.last_event
+        if event is None or event.out_time is None or not self.duration:
+            return None
+        if event.end:
+            return 100.0
+        return min(100.0, 100.0 * event.out_time / float(self.duration))
+
+    def _emit(self, event):
+        self.events += 1
+        self.last_event = event
+        for listener in self.listeners:
+            listener(self, event)
+
+
+class ProgressLog(object):
+    """
+    Rate limited progress logging (at most one line per interval, plus the end)
+    """
+    def __init__(self, label, interval=30):
+        self.label = label
+        self.interval = interval
+        self.last_logged = None
+
+    def __call__(self, parser, event):
+        now = time.time()
+        if not event.end and self.last_logged is not None and now - self.last_logged < self.interval:
+            return
+        self.last_logged = now
+        percent = parser.percent(event)
+        logger.info('{label} : {percent} frame={frame} fps={fps} speed={speed}x out_time={out_time}'.format(
+            label=self.label,
+            percent='%d%%' % percent if percent is not None else '--',
+            frame=event.frame,
+            fps=event.fps,
+            speed=event.speed,
+            out_time=event.out_time
+        ))
+
+
+def _number(value, cast):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
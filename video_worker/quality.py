@@ -0,0 +1,158 @@
+"""
+Sampled objective quality (PSNR / SSIM) of a product against its mezzanine
+
+Short, evenly spaced windows of the product are compared with the same windows of the
+mezzanine (scaled to the product's size) through ffmpeg's psnr and ssim filters; the per
+window averages are aggregated into per video scores for the job metrics:
+
+    quality_psnr / quality_psnr_min (dB), quality_ssim / quality_ssim_min (0-1)
+
+Sampling is held to a share of the encode time (`quality_budget_percent`): before each
+window, the expected cost (the mean of the windows scored so far, or for the first one
+the encode's own seconds per source second) must still fit in the budget.
+
+Products with a different aspect ratio (letter / pillarboxed) and audio only products are
+not scored.
+
+"""
+
+import logging
+import re
+import subprocess
+import time
+
+from .decode_check import window_starts
+from .limits import ResourceLimits
+
+logger = logging.getLogger(__name__)
+
+# identical frames score an infinite PSNR
+MAX_PSNR = 100.0
+PSNR_AVERAGE = re.compile(r'PSNR .*average:(\S+)')
+SSIM_ALL = re.compile(r'SSIM .*All:(\S+)')
+
+# reasons a product is not scored
+NO_VIDEO = 'no_video'
+ASPECT_MISMATCH = 'aspect_mismatch'
+OVER_BUDGET = 'over_budget'
+
+
+def _score(value, maximum=None):
+    try:
+        score = float(value)
+    except ValueError:
+        return None
+    if maximum is not None:
+        score = min(score, maximum)
+    return score
+
+
+class QualityScore(object):
+    """
+    PSNR / SSIM of `product` against `reference` (ProbeResults), over sampled windows
+    """
+    def __init__(self, product, reference, settings, **kwargs):
+        self.product = product
+        self.reference = reference
+        self.ffmpeg = settings.get('ffmpeg_compiled', 'ffmpeg')
+        self.windows = kwargs.get('windows', None) or settings.get('quality_windows', 5)
+        self.window = kwargs.get('window', None) or settings.get('quality_window', 1)
+        # seconds of encode per second of source, for the first window's cost estimate
+        self.encode_ratio = kwargs.get('encode_ratio', None)
+        # seconds; None: no budget
+        self.budget = kwargs.get('budget', None)
+        self.limits = kwargs.get('limits', None) or ResourceLimits.for_probe(settings=settings)
+        self.scores = []
+        self.skipped = None
+        self.elapsed = 0.0
+
+    def run(self):
+        """
+        Score the sampled windows, returns the per window (psnr, ssim) list
+        """
+        self.skipped = self._unscorable()
+        if self.skipped is not None:
+            return self.scores
+
+        start_time = time.time()
+        for start in window_starts(self.product.duration, self.windows, self.window):
+            if self.budget is not None:
+                if self.scores:
+                    expected = self.elapsed / len(self.scores)
+                else:
+                    expected = self.window * (self.encode_ratio or 0)
+                if self.elapsed + expected > self.budget:
+                    break
+            score = self._score_window(start)
+            self.elapsed = time.time() - start_time
+            if score is not None:
+                self.scores.append(score)
+        if not self.scores and self.budget is not None:
+            self.skipped = OVER_BUDGET
+        return self.scores
+
+    def metrics(self):
+        if self.skipped is not None:
+            return {'quality_skipped': self.skipped}
+        psnr = [score[0] for score in self.scores if score[0] is not None]
+        ssim = [score[1] for score in self.scores if score[1] is not None]
+        metrics = {'quality_windows': len(self.scores), 'quality_time': self.elapsed}
+        if psnr:
+            metrics['quality_psnr'] = sum(psnr) / len(psnr)
+            metrics['quality_psnr_min'] = min(psnr)
+        if ssim:
+            metrics['quality_ssim'] = sum(ssim) / len(ssim)
+            metrics['quality_ssim_min'] = min(ssim)
+        return metrics
+
+    def _unscorable(self):
+        if not (self.product.width and self.product.height and self.reference.width and self.reference.height):
+            return NO_VIDEO
+        if not self.product.duration:
+            return NO_VIDEO
+        product_aspect = float(self.product.width) / self.product.height
+        reference_aspect = float(self.reference.width) / self.reference.height
+        if abs(product_aspect - reference_aspect) / reference_aspect > 0.01:
+            return ASPECT_MISMATCH
+        return None
+
+    def _score_window(self, start):
+        """
+        (psnr, ssim) averages of one window, None if ffmpeg failed
+        """
+        filter_graph = (
+            '[0:v]setpts=PTS-STARTPTS,format=yuv420p[product];'
+            '[1:v]scale={width}:{height}:flags=bicubic,setpts=PTS-STARTPTS,format=yuv420p[reference];'
+            '[product]split[product_psnr][product_ssim];'
+            '[reference]split[reference_psnr][reference_ssim];'
+            '[product_psnr][reference_psnr]psnr;[product_ssim][reference_ssim]ssim'
+        ).format(width=self.product.width, height=self.product.height)
+        command = [self.ffmpeg, '-hide_banner', '-nostdin']
+        for filepath in (self.product.filepath, self.reference.filepath):
+            command += ['-ss', str(start), '-t', str(self.window), '-i', filepath]
+        command += ['-lavfi', filter_graph, '-an', '-f', 'null', '-']
+        try:
+            process = subprocess.Popen(
+                command,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                **self.limits.popen_kwargs()
+            )
+        except OSError as exc:
+            logger.error(': {filepath} quality scoring failed: {error}'.format(
+                filepath=self.product.filepath,
+                error=exc
+            ))
+            return None
+        _, stderrdata = process.communicate()
+        if process.returncode != 0:
+            return None
+        psnr = PSNR_AVERAGE.search(stderrdata)
+        ssim = SSIM_ALL.search(stderrdata)
+        if psnr is None and ssim is None:
+            return None
+        return (
+            _score(psnr.group(1), MAX_PSNR) if psnr is not None else None,
+            _score(ssim.group(1)) if ssim is not None else None
+        )
@@ -47,40 +47,20 @@ class Output(object):
         return duration_seconds
 
     @staticmethod
-    def status_bar(process):
+    def kbps_from_string(bitrate):
         """
-        This is a little gross, but it'll get us a status bar thingy
-
+        Bitrate as an int (kb/s) from '1205 kb/s', '1.2 Mb/s', '1205' or 1205,
+        None if it cannot be parsed (e.g. 'Unparsed')
         """
-        fps = None
-        duration = None
-        while True:
-            line = process.stdout.readline().strip()
-
-            if line == '' and process.poll() is not None:
-                break
-            if fps is None or duration is None:
-                if "Stream #" in line and " Video: " in line:
-                    fps = [s for s in line.split(',') if "fps" in s][0].strip(' fps')
-
-                if "Duration: " in line:
-                    dur = line.split('Duration: ')[1].split(',')[0].strip()
-                    duration = Output().seconds_from_string(duration=dur)
-
-            else:
-                if 'frame=' in line:
-                    cur_frame = line.split('frame=')[1].split('fps=')[0].strip()
-                    end_frame = float(duration) * float(fps.strip())
-                    pctg = (float(cur_frame) / float(end_frame))
-                    sys.stdout.write('\r')
-                    i = int(pctg * 20.0)
-                    sys.stdout.write("%s : [%-20s] %d%%" % ('Transcode', '=' * i, int(pctg * 100)))
-                    sys.stdout.flush()
-
-        # Just for politeness
-        sys.stdout.write('\r')
-        sys.stdout.write("%s : [%-20s] %d%%" % ('Transcode', '=' * 20, 100))
-        sys.stdout.flush()
+        if bitrate is None:
+            return None
+        try:
+            value = float(str(bitrate).strip().split(' ')[0])
+        except ValueError:
+            return None
+        if 'mb/s' in str(bitrate).lower():
+            value *= 1000
+        return int(value)
 
 
 class EmailAlert(object):
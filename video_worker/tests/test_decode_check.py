@@ -0,0 +1,98 @@
+"""
+Sampled decode check tests.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ddt import ddt, data, unpack
+from mock import patch
+
+from video_worker.decode_check import DecodeCheck, window_starts
+from video_worker.limits import ResourceLimits
+from video_worker.validate import ValidateVideo
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+TEST_VIDEO = os.path.join(TEST_DATA_DIR, 'test.mp4')
+TEST_DURATION = 16.8
+SETTINGS = {'ffmpeg_compiled': 'ffmpeg', 'ffmpeg_limits': False}
+
+
+@ddt
+class DecodeCheckTest(unittest.TestCase):
+    """
+    DecodeCheck tests.
+    """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    @data(
+        (60, 4, 2, [0.0, 19.333, 38.667, 58.0]),
+        (60, 1, 2, [29.0]),
+        (1.5, 4, 2, [0.0]),
+        (None, 4, 2, []),
+    )
+    @unpack
+    def test_window_starts(self, duration, windows, window, expected):
+        self.assertEqual(window_starts(duration, windows, window), expected)
+
+    def test_valid(self):
+        check = DecodeCheck(TEST_VIDEO, TEST_DURATION, SETTINGS, windows=3, window=1, workers=3)
+        results = check.run()
+
+        self.assertTrue(check.valid)
+        self.assertEqual([result.start for result in results], [0.0, 7.9, 15.8])
+        self.assertEqual(check.metrics()['decode_check_windows'], 3)
+        self.assertEqual(check.metrics()['decode_check_errors'], 0)
+
+    def test_corrupt(self):
+        """
+        Garbage in the middle of the file fails the windows that decode across it, not the others
+        """
+        corrupt_video = os.path.join(self.workdir, 'corrupt.mp4')
+        shutil.copy(TEST_VIDEO, corrupt_video)
+        with open(corrupt_video, 'r+b') as video:
+            video.seek(os.path.getsize(corrupt_video) // 2)
+            video.write(b'\xff' * 100000)
+
+        check = DecodeCheck(corrupt_video, TEST_DURATION, SETTINGS, windows=5, window=2)
+        results = check.run()
+
+        self.assertFalse(check.valid)
+        self.assertTrue(results[0].ok)
+        self.assertTrue(any(result.errors for result in results))
+        failed_windows = [result.start for result in results if not result.ok]
+        self.assertEqual(check.metrics()['decode_check_failed_windows'], failed_windows)
+
+    def test_limits(self):
+        """
+        Windows are decoded from worker threads: no preexec_fn, the limits go on each started child
+        """
+        limits = ResourceLimits(cpu_time=300, open_files=64)
+        check = DecodeCheck(TEST_VIDEO, TEST_DURATION, SETTINGS, windows=2, window=1, limits=limits)
+
+        with patch('video_worker.decode_check.subprocess.Popen', side_effect=subprocess.Popen) as mock_popen, \
+                patch.object(limits, 'apply_to', wraps=limits.apply_to) as mock_apply_to:
+            check.run()
+
+        self.assertTrue(check.valid)
+        self.assertTrue(all('preexec_fn' not in call[1] for call in mock_popen.call_args_list))
+        self.assertEqual(mock_apply_to.call_count, 2)
+
+    def test_budget(self):
+        check = DecodeCheck(TEST_VIDEO, TEST_DURATION, SETTINGS, windows=4, window=1, workers=1, budget=0.001)
+        results = check.run()
+
+        self.assertTrue(check.valid)
+        self.assertTrue(results[-1].skipped)
+        self.assertGreater(check.metrics()['decode_check_skipped'], 0)
+
+    def test_deep_validate(self):
+        validator = ValidateVideo(TEST_VIDEO, deep=True)
+
+        self.assertTrue(validator.valid)
+        self.assertTrue(validator.decode_check.valid)
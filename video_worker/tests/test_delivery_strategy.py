@@ -0,0 +1,130 @@
+"""
+Delivery strategy tests.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ddt import ddt, data, unpack
+
+from video_worker.delivery_strategy import (
+    EXPLORE_EVERY,
+    MULTIPART,
+    SINGLE,
+    DeliveryHistory,
+    part_size,
+    plan_delivery,
+    size_band
+)
+from video_worker.multipart import MEGABYTE, MIN_PART_SIZE
+
+BARRIER = 2000000000
+MAX_PART_SIZE = 16 * MEGABYTE
+
+
+@ddt
+class PlanDeliveryTest(unittest.TestCase):
+    """
+    plan_delivery tests.
+    """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.history_file = os.path.join(self.workdir, 'delivery_history.jsonl')
+        self.history = DeliveryHistory(self.history_file)
+
+    def plan(self, filesize, concurrency=4):
+        return plan_delivery(filesize, self.history_file, BARRIER, MAX_PART_SIZE, concurrency)
+
+    def measure(self, strategy, throughput, count=3, filesize=200 * MEGABYTE):
+        for _ in range(count):
+            self.history.record(strategy, filesize, float(filesize) / throughput)
+
+    @data(
+        (BARRIER, MULTIPART, 'barrier'),
+        (MEGABYTE, SINGLE, 'small'),
+        (200 * MEGABYTE, MULTIPART, 'explore'),
+    )
+    @unpack
+    def test_without_history(self, filesize, strategy, reason):
+        plan = self.plan(filesize)
+
+        self.assertEqual((plan.strategy, plan.reason), (strategy, reason))
+
+    def test_single_connection(self):
+        self.assertEqual(self.plan(200 * MEGABYTE, concurrency=1).strategy, SINGLE)
+
+    def test_explores_single(self):
+        self.measure(MULTIPART, 50 * MEGABYTE)
+
+        self.assertEqual((self.plan(200 * MEGABYTE).strategy, self.plan(200 * MEGABYTE).reason), (SINGLE, 'explore'))
+
+    @data(
+        (10 * MEGABYTE, 40 * MEGABYTE, MULTIPART),
+        (40 * MEGABYTE, 10 * MEGABYTE, SINGLE),
+    )
+    @unpack
+    def test_throughput(self, single, multipart, strategy):
+        self.measure(SINGLE, single)
+        self.measure(MULTIPART, multipart, count=4)
+        plan = self.plan(200 * MEGABYTE)
+
+        self.assertEqual((plan.strategy, plan.reason), (strategy, 'throughput'))
+        if strategy == MULTIPART:
+            self.assertEqual(plan.concurrency, 4)
+            self.assertGreaterEqual(plan.part_size, MIN_PART_SIZE)
+
+    def test_periodic_explore(self):
+        self.measure(SINGLE, 10 * MEGABYTE, count=EXPLORE_EVERY - 3)
+        self.measure(MULTIPART, 40 * MEGABYTE)
+
+        self.assertEqual((self.plan(200 * MEGABYTE).strategy, self.plan(200 * MEGABYTE).reason), (SINGLE, 'explore'))
+
+    @data(
+        (20 * MEGABYTE, SINGLE),
+        (1024 * MEGABYTE, MULTIPART),
+    )
+    @unpack
+    def test_size_band(self, filesize, strategy):
+        """
+        Small products are planned from small deliveries, large ones from large deliveries
+        """
+        # pooled, multipart would win both (median 55 vs 25 MB/s)
+        self.measure(SINGLE, 40 * MEGABYTE, filesize=20 * MEGABYTE)
+        self.measure(MULTIPART, 10 * MEGABYTE, filesize=20 * MEGABYTE)
+        self.measure(SINGLE, 10 * MEGABYTE, filesize=1024 * MEGABYTE)
+        self.measure(MULTIPART, 100 * MEGABYTE, filesize=1024 * MEGABYTE)
+        plan = self.plan(filesize)
+
+        self.assertEqual((plan.strategy, plan.reason), (strategy, 'throughput'))
+
+    def test_barrier_excluded(self):
+        self.history.record(MULTIPART, BARRIER, 1.0)
+        self.history.record(SINGLE, BARRIER - MEGABYTE, 1.0)
+
+        self.assertEqual(len(size_band(self.history.records(), BARRIER - MEGABYTE, BARRIER)), 1)
+
+    @data(
+        # enough parts to keep 4 workers busy
+        (64 * MEGABYTE, None, 4, MIN_PART_SIZE),
+        (256 * MEGABYTE, None, 4, MAX_PART_SIZE),
+        # at most PART_SECONDS of one slow stream
+        (1024 * MEGABYTE, 2 * MEGABYTE, 4, 10 * MEGABYTE),
+    )
+    @unpack
+    def test_part_size(self, filesize, stream_throughput, concurrency, expected):
+        self.assertEqual(part_size(filesize, concurrency, MAX_PART_SIZE, stream_throughput), expected)
+
+    def test_history(self):
+        self.assertIsNone(self.history.record(SINGLE, MEGABYTE, 0))
+        self.history.record(SINGLE, MEGABYTE, 0.5)
+        self.history.record(MULTIPART, 100 * MEGABYTE, 2.0, concurrency=4)
+        with open(self.history_file, 'a') as history:
+            history.write('not json\n')
+
+        records = self.history.records()
+        self.assertEqual([record['throughput'] for record in records], [2 * MEGABYTE, 50 * MEGABYTE])
+        self.assertEqual(records[1]['concurrency'], 4)
+        self.assertEqual(len(self.history.records(min_filesize=10 * MEGABYTE)), 1)
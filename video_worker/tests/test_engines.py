@@ -0,0 +1,86 @@
+"""
+Media engine tests.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ddt import ddt, data
+from mock import patch
+from PIL import Image
+
+from video_worker import engines
+from video_worker.engines import CLIEngine, PyAVEngine, get_engine
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+TEST_VIDEO = os.path.join(TEST_DATA_DIR, 'test.mp4')
+SETTINGS = {'ffmpeg_compiled': 'ffmpeg', 'ffprobe_compiled': 'ffprobe'}
+
+ENGINES = [CLIEngine]
+if engines.av is not None:
+    ENGINES.append(PyAVEngine)
+
+
+@ddt
+class EngineTest(unittest.TestCase):
+    """
+    Behaviour every engine shares.
+    """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    @data(*ENGINES)
+    def test_probe(self, engine_class):
+        result = engine_class(settings=SETTINGS).probe(TEST_VIDEO)
+
+        expected = CLIEngine(settings=SETTINGS).probe(TEST_VIDEO)
+        self.assertAlmostEqual(result.duration, expected.duration, delta=0.1)
+        for key in ('resolution', 'video_codec', 'pix_fmt', 'audio_codec'):
+            self.assertEqual(getattr(result, key), getattr(expected, key))
+        self.assertFalse(result.desync)
+
+    @data(*ENGINES)
+    def test_probe_invalid(self, engine_class):
+        invalid_file = os.path.join(self.workdir, 'invalid.mp4')
+        with open(invalid_file, 'w') as invalid:
+            invalid.write('not a video')
+
+        self.assertIsNone(engine_class(settings=SETTINGS).probe(invalid_file))
+        self.assertIsNone(engine_class(settings=SETTINGS).probe(os.path.join(self.workdir, 'missing.mp4')))
+
+    @data(*ENGINES)
+    def test_extract_frame(self, engine_class):
+        output_file = os.path.join(self.workdir, 'frame.png')
+
+        self.assertTrue(engine_class(settings=SETTINGS).extract_frame(TEST_VIDEO, 2, output_file, 320, 180))
+        with Image.open(output_file) as img:
+            self.assertEqual(img.size, (320, 180))
+
+    @data(*ENGINES)
+    def test_encode_clip(self, engine_class):
+        output_file = os.path.join(self.workdir, 'clip.mp4')
+
+        self.assertTrue(engine_class(settings=SETTINGS).encode_clip(TEST_VIDEO, output_file, 2, 144, 30, 'ultrafast'))
+        result = CLIEngine(settings=SETTINGS).probe(output_file)
+        self.assertEqual(result.video_codec, 'h264')
+        self.assertEqual(result.height, 144)
+        self.assertAlmostEqual(result.duration, 2, delta=0.5)
+
+
+class GetEngineTest(unittest.TestCase):
+    """
+    Engine selection tests.
+    """
+    def test_default(self):
+        self.assertIsInstance(get_engine(settings=SETTINGS), CLIEngine)
+
+    @unittest.skipIf(engines.av is None, 'PyAV is not installed')
+    def test_pyav(self):
+        self.assertIsInstance(get_engine(settings=dict(SETTINGS, media_engine='pyav')), PyAVEngine)
+
+    @patch('video_worker.engines.av', None)
+    def test_pyav_missing(self):
+        self.assertIsInstance(get_engine('pyav', settings=SETTINGS), CLIEngine)
@@ -0,0 +1,173 @@
+"""
+Deliverable tests.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+
+import boto
+from boto.exception import S3ResponseError
+from boto.s3.multipart import MultiPartUpload
+from mock import Mock, patch
+from moto import mock_s3_deprecated
+
+from video_worker import generate_delivery
+from video_worker.celeryapp import worker_task_fire
+from video_worker.delivery_strategy import DeliveryHistory
+from video_worker.generate_delivery import Deliverable, MemoryPeak, stream_md5
+
+
+class DeliverableTest(unittest.TestCase):
+    """
+    Deliverable tests.
+    """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        self.content = os.urandom(3 * 1024 * 1024 + 17)
+        self.output_file = 'product_DESKTOP_MP4.mp4'
+        self.history_file = os.path.join(self.workdir, 'delivery_history.jsonl')
+        self.state_dir = os.path.join(self.workdir, 'upload_state')
+        with open(os.path.join(self.workdir, self.output_file), 'wb') as output:
+            output.write(self.content)
+
+    def deliver(self):
+        conn = boto.connect_s3()
+        bucket = conn.create_bucket(generate_delivery.settings['veda_deliverable_bucket'])
+        deliverable = Deliverable(
+            None, 'desktop_mp4', self.output_file,
+            workdir=self.workdir, history_file=self.history_file, state_dir=self.state_dir
+        )
+        self.assertTrue(deliverable.run())
+        self.assertEqual(bucket.get_key(self.output_file).get_contents_as_string(), self.content)
+        return deliverable
+
+    def test_stream_md5(self):
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        with open(os.path.join(self.workdir, self.output_file), 'rb') as output:
+            hex_digest, b64_digest = stream_md5(output, chunk_size=4096)
+        peak = tracemalloc.get_traced_memory()[1]
+
+        self.assertEqual(hex_digest, hashlib.md5(self.content).hexdigest())
+        self.assertEqual(len(b64_digest), 24)
+        # bounded buffers: well below the file size
+        self.assertLess(peak, 1024 * 1024)
+
+    @mock_s3_deprecated
+    def test_single_part(self):
+        deliverable = self.deliver()
+
+        self.assertEqual(deliverable.hash_sum, hashlib.md5(self.content).hexdigest())
+        self.assertEqual(deliverable.metrics['delivery_strategy'], 'single')
+        self.assertEqual(deliverable.metrics['delivery_strategy_reason'], 'small')
+        self.assertGreaterEqual(deliverable.metrics['delivery_peak_memory'], 0)
+        self.assertGreater(deliverable.metrics['delivery_throughput'], 0)
+        # the observed throughput is recorded for the strategy choice
+        self.assertEqual(
+            [record['strategy'] for record in DeliveryHistory(self.history_file).records()], ['single']
+        )
+
+    @mock_s3_deprecated
+    @patch.object(generate_delivery, 'MULTI_UPLOAD_BARRIER', 1024)
+    def test_multipart(self):
+        deliverable = self.deliver()
+
+        self.assertEqual(deliverable.hash_sum, hashlib.md5(self.content).hexdigest())
+        self.assertEqual(deliverable.metrics['delivery_strategy'], 'multipart')
+        self.assertEqual(deliverable.metrics['delivery_strategy_reason'], 'barrier')
+        self.assertGreaterEqual(deliverable.metrics['delivery_peak_memory'], 0)
+
+    def test_resume_plan(self):
+        """
+        A product with an open multipart upload goes multipart again, with the same part size
+        """
+        os.mkdir(self.state_dir)
+        with open(os.path.join(self.state_dir, self.output_file + '.upload.json'), 'w') as state_file:
+            json.dump({'part_size': 8 * 1024 * 1024}, state_file)
+        deliverable = Deliverable(
+            None, 'desktop_mp4', self.output_file,
+            workdir=self.workdir, history_file=self.history_file, state_dir=self.state_dir
+        )
+        deliverable.upload_filesize = len(self.content)
+
+        plan = deliverable._plan()
+
+        self.assertEqual((plan.strategy, plan.reason, plan.part_size), ('multipart', 'resume', 8 * 1024 * 1024))
+
+    @patch('video_worker.generate_delivery.sys.platform', 'linux')
+    @patch('video_worker.generate_delivery.resource.getrusage')
+    def test_memory_peak(self, getrusage):
+        getrusage.side_effect = [Mock(ru_maxrss=100000), Mock(ru_maxrss=104096)]
+        with MemoryPeak() as memory:
+            pass
+        self.assertEqual(memory.peak, 4096 * 1024)
+
+        # below an earlier high water mark: no growth
+        getrusage.side_effect = [Mock(ru_maxrss=100000), Mock(ru_maxrss=100000)]
+        with MemoryPeak() as memory:
+            pass
+        self.assertEqual(memory.peak, 0)
+
+    @mock_s3_deprecated
+    @patch.object(generate_delivery, 'MULTI_UPLOAD_BARRIER', 1024)
+    @patch('video_worker.celeryapp.os.system')
+    def test_retried_job_resumes(self, system):
+        """
+        The upload state of a failed multipart delivery survives the task's workdir cleanup
+        """
+        bucket = boto.connect_s3().create_bucket(generate_delivery.settings['veda_deliverable_bucket'])
+        # three 5 MB parts
+        self.content = os.urandom(11 * 1024 * 1024)
+        jobdir = os.path.join(self.workdir, 'job-id')
+        upload_part = MultiPartUpload.upload_part_from_file
+
+        def failing(upload, fp, part_num, **kwargs):
+            if part_num == 2:
+                raise S3ResponseError(500, 'InternalError')
+            return upload_part(upload, fp, part_num, **kwargs)
+
+        def job(command):
+            # video_worker_cli: encode into the job workdir, deliver
+            if not os.path.exists(jobdir):
+                os.mkdir(jobdir)
+                with open(os.path.join(jobdir, self.output_file), 'wb') as output:
+                    output.write(self.content)
+            deliverable = Deliverable(
+                None, 'desktop_mp4', self.output_file,
+                jobid='job-id', history_file=self.history_file, state_dir=self.state_dir
+            )
+            deliverable.run()
+            return deliverable
+
+        worker_task_fire.push_request(delivery_info={})
+        self.addCleanup(worker_task_fire.pop_request)
+        with patch.object(generate_delivery, 'ENCODE_WORK_DIR', self.workdir), \
+                patch('video_worker.celeryapp.ENCODE_WORK_DIR', self.workdir), \
+                patch.dict(generate_delivery.settings, {
+                    'multipart_part_size_mb': 5, 'multipart_concurrency': 1, 'multipart_retry_backoff': 0
+                }):
+            with patch.object(MultiPartUpload, 'upload_part_from_file', new=failing):
+                system.side_effect = job
+                worker_task_fire('veda-id', 'desktop_mp4', 'job-id')
+
+            self.assertFalse(os.path.exists(jobdir))
+            self.assertEqual(os.listdir(self.state_dir), [self.output_file + '.upload.json'])
+            self.assertEqual(len(bucket.get_all_multipart_uploads()), 1)
+
+            deliverables = []
+            system.side_effect = lambda command: deliverables.append(job(command))
+            worker_task_fire('veda-id', 'desktop_mp4', 'job-id')
+
+        self.assertTrue(deliverables[0].delivered)
+        self.assertEqual(deliverables[0].metrics['delivery_strategy_reason'], 'resume')
+        self.assertEqual(deliverables[0].metrics['delivery_resumed_parts'], 1)
+        self.assertEqual(bucket.get_key(self.output_file).get_contents_as_string(), self.content)
+        self.assertEqual(bucket.get_all_multipart_uploads(), [])
+        self.assertEqual(os.listdir(self.state_dir), [])
@@ -11,7 +11,7 @@ from mock import patch
 
 from video_worker.abstractions import Video, Encode
 from video_worker.global_vars import ENCODE_WORK_DIR, TARGET_ASPECT_RATIO, ENFORCE_TARGET_ASPECT
-from video_worker.generate_encode import CommandGenerate
+from video_worker.generate_encode import _TEMPLATES, CommandGenerate, multi_output
 from video_worker.tests.utils import TEST_INSTANCE_YAML
 
 
@@ -36,6 +36,7 @@ class CommandGenerateTest(unittest.TestCase):
             VideoObject=self.video,
             EncodeObject=self.encode
         )
+        _TEMPLATES.clear()
 
     @data(
         (
@@ -59,26 +60,36 @@ class CommandGenerateTest(unittest.TestCase):
     )
     @patch('video_worker.generate_encode.logger')
     @patch.object(CommandGenerate, '_destination')
+    @patch.object(CommandGenerate, '_tuning')
     @patch.object(CommandGenerate, '_passes')
     @patch.object(CommandGenerate, '_scalar')
     @patch.object(CommandGenerate, '_codec')
-    @patch.object(CommandGenerate, '_call')
-    def test_generate(self, mock_data, mock_call, mock_codec, mock_scalar, mock_passes, mock_destination, mock_logger):
+    @patch.object(CommandGenerate, '_select')
+    @patch.object(CommandGenerate, '_source')
+    @patch.object(CommandGenerate, '_head')
+    def test_generate(self, mock_data, mock_head, mock_source, mock_select, mock_codec, mock_scalar, mock_passes,
+                      mock_tuning, mock_destination, mock_logger):
         """
         Tests `generate` method works correctly.
         """
-        ffcommand = ['dummy-ffcommand-arg']
         job_id = mock_data.get('job_id', None)
         command_generate = CommandGenerate(
             VideoObject=mock_data.get('video_object', self.video),
             EncodeObject=mock_data.get('encode_object', self.encode),
             jobid=job_id
         )
+        self.encode.filetype = 'mp4'
+
+        # every build step appends its own name
+        for name, step in (('head', mock_head), ('select', mock_select), ('codec', mock_codec),
+                           ('scalar', mock_scalar), ('passes', mock_passes), ('tuning', mock_tuning),
+                           ('destination', mock_destination)):
+            step.side_effect = lambda name=name: command_generate.ffcommand.append(name)
+        mock_source.return_value = 'source'
 
         self.assertEqual(command_generate.ffcommand, [])
         self.assertIsNone(command_generate.workdir)
 
-        command_generate.ffcommand = ffcommand
         result_command = command_generate.generate()
 
         if mock_data.get('error_message', ''):
@@ -87,15 +98,75 @@ class CommandGenerateTest(unittest.TestCase):
             self.assertIsNotNone(command_generate.workdir)
             expected_workdir = os.path.join(ENCODE_WORK_DIR, job_id) if job_id else ENCODE_WORK_DIR
             self.assertEqual(command_generate.workdir, expected_workdir)
-            self.assertEqual(result_command, ' '.join(ffcommand))
+            self.assertEqual(
+                result_command,
+                ['head', 'source', 'select', 'codec', 'scalar', 'passes', 'tuning', 'destination']
+            )
 
             if mock_data.get('ENFORCE_TARGET_ASPECT', False):
                 self.assertTrue(mock_scalar.called)
 
-            self.assertTrue(mock_call.called)
-            self.assertTrue(mock_codec.called)
-            self.assertTrue(mock_passes.called)
-            self.assertTrue(mock_destination.called)
+    def test_template_reuse(self):
+        """
+        Tests that a profile compiles once, and only the per-video slots change between jobs.
+        """
+        self.encode.filetype = 'mp4'
+        self.encode.encode_suffix = 'DTH'
+        self.encode.resolution = 720
+        self.encode.rate_factor = 27
+        self.encode.preset = 'slow'
+        self.video.mezz_extension = 'mp4'
+        self.video.mezz_bitrate = '3000 kb/s'
+
+        commands = []
+        for veda_id, mezz_resolution in (('VIDEO-1', '1920x1080'), ('VIDEO-2', '1280x720')):
+            self.video.veda_id = veda_id
+            self.video.mezz_resolution = mezz_resolution
+            with patch.object(CommandGenerate, '_compile', wraps=self.command_generate._compile) as mock_compile:
+                commands.append(CommandGenerate(VideoObject=self.video, EncodeObject=self.encode).generate())
+            self.assertEqual(mock_compile.call_count, 1 if veda_id == 'VIDEO-1' else 0)
+
+        self.assertEqual(commands[0][:6], ['ffmpeg', '-hide_banner', '-nostats', '-progress', 'pipe:1', '-y'])
+        self.assertIn('/VIDEO-1.mp4', commands[0][7])
+        self.assertEqual(commands[0][8:14], ['-c:v', 'libx264', '-vf', 'scale=1280:720', '-crf', '27'])
+        self.assertEqual(commands[1][8:12], ['-c:v', 'libx264', '-crf', '27'])
+        self.assertTrue(commands[1][-1].endswith('/VIDEO-2_DTH.mp4'))
+        self.assertIsInstance(commands[0], list)
+
+    def test_template_immutable(self):
+        """
+        Tests that compiled templates cannot be changed by a job.
+        """
+        self.encode.filetype = 'mp4'
+        template = self.command_generate.template()
+
+        self.assertIsInstance(template.argv, tuple)
+        with self.assertRaises(AttributeError):
+            template.argv = ()
+        rendered = template.render('in.mp4', output=['out.mp4'])
+        rendered.append('-extra')
+        self.assertNotIn('-extra', template.render('in.mp4', output=['out.mp4']))
+
+    def test_multi_output(self):
+        """
+        Tests that several profiles share one input in a multi-output command.
+        """
+        mp4 = Encode(video_object=self.video, profile_name='desktop_mp4')
+        mp4.filetype, mp4.rate_factor = 'mp4', 27
+        mp3 = Encode(video_object=self.video, profile_name='audio_mp3')
+        mp3.filetype, mp3.rate_factor = 'mp3', 192
+
+        argv = multi_output('in.mp4', [
+            (CommandGenerate(VideoObject=self.video, EncodeObject=mp4).template(), [], [], ['out.mp4']),
+            (CommandGenerate(VideoObject=self.video, EncodeObject=mp3).template(), [],
+             ['libmp3lame', '-b:a', '192k'], ['out.mp3']),
+        ])
+
+        self.assertEqual(argv.count('-i'), 1)
+        self.assertEqual(argv[argv.index('-i'):], [
+            '-i', 'in.mp4', '-c:v', 'libx264', '-crf', '27', 'out.mp4',
+            '-vn', '-sn', '-dn', '-map', '0:a:0', '-c:a', 'libmp3lame', '-b:a', '192k', 'out.mp3'
+        ])
 
     @data(
         (
@@ -134,7 +205,9 @@ class CommandGenerateTest(unittest.TestCase):
 
         self.command_generate._call()
 
-        expected_ffcommand = ['dummy-ffcommand-arg', '-ffmpeg_compiled', '-hide_banner', '-y', '-i']
+        expected_ffcommand = [
+            'dummy-ffcommand-arg', '-ffmpeg_compiled', '-hide_banner', '-nostats', '-progress', 'pipe:1', '-y', '-i'
+        ]
         expected_ffcommand.append('{workdir}/{file_name}{file_extension}'.format(
             workdir=ENCODE_WORK_DIR,
             file_name=veda_id if veda_id else mezz_filepath,
@@ -144,7 +217,7 @@ class CommandGenerateTest(unittest.TestCase):
         if file_type != 'mp3':
             expected_ffcommand.append('-c:v')
         else:
-            expected_ffcommand.append('-c:a')
+            expected_ffcommand.extend(['-vn', '-sn', '-dn', '-map', '0:a:0', '-c:a'])
 
         self.assertEqual(self.command_generate.ffcommand, expected_ffcommand)
 
@@ -174,6 +247,22 @@ class CommandGenerateTest(unittest.TestCase):
                 'ffcommand': ['dummy-ffcommand-arg'],
                 'expected_ffcommand': ['dummy-ffcommand-arg', 'libvpx']
             }
+        ),
+        (
+            {
+                'filetype': 'mp4',
+                'codec': 'libx265',
+                'ffcommand': ['dummy-ffcommand-arg'],
+                'expected_ffcommand': ['dummy-ffcommand-arg', 'libx265']
+            }
+        ),
+        (
+            {
+                'filetype': 'webm',
+                'codec': 'libvpx-vp9',
+                'ffcommand': ['dummy-ffcommand-arg'],
+                'expected_ffcommand': ['dummy-ffcommand-arg', 'libvpx-vp9']
+            }
         )
     )
     def test_codec(self, mock_data):
@@ -182,11 +271,90 @@ class CommandGenerateTest(unittest.TestCase):
         """
         self.command_generate.ffcommand = mock_data.get('ffcommand', None)
         self.command_generate.EncodeObject.filetype = mock_data.get('filetype', None)
+        self.command_generate.EncodeObject.codec = mock_data.get('codec', None)
 
         self.command_generate._codec()
 
         self.assertEqual(self.command_generate.ffcommand, mock_data.get('expected_ffcommand', None))
 
+    @data(
+        ({}, True),
+        ({'filetype': 'webm'}, False),
+        ({'passthrough_max_bitrate': None}, False),
+        ({'mezz_video_codec': 'hevc'}, False),
+        ({'mezz_audio_codec': None}, True),
+        ({'mezz_audio_codec': 'pcm_s16le'}, False),
+        ({'mezz_pix_fmt': 'yuv422p'}, False),
+        ({'mezz_bitrate': '3000 kb/s'}, False),
+        ({'mezz_bitrate': 'Unparsed'}, False),
+        ({'mezz_resolution': '1920x1080'}, False),
+        ({'mezz_resolution': '960x720'}, False),
+        ({'codec': 'libx265'}, False),
+    )
+    @unpack
+    def test_passthrough(self, overrides, expected):
+        """
+        Tests that `_passthrough` only allows stream copy for sources that already meet the profile.
+        """
+        fields = {
+            'filetype': 'mp4',
+            'resolution': 720,
+            'passthrough_max_bitrate': 2500,
+            'mezz_video_codec': 'h264',
+            'mezz_audio_codec': 'aac',
+            'mezz_pix_fmt': 'yuv420p',
+            'mezz_bitrate': '2000 kb/s',
+            'mezz_resolution': '1280x720',
+        }
+        fields.update(overrides)
+        for field, value in fields.items():
+            if field.startswith('mezz_'):
+                setattr(self.command_generate.VideoObject, field, value)
+            else:
+                setattr(self.command_generate.EncodeObject, field, value)
+
+        self.assertEqual(self.command_generate._passthrough(), expected)
+
+    @patch.object(CommandGenerate, '_passthrough', return_value=True)
+    def test_generate_passthrough(self, mock_passthrough):
+        """
+        Tests that a passthrough source is remuxed with stream copy and no filters.
+        """
+        self.command_generate.VideoObject.mezz_extension = 'mp4'
+        self.command_generate.EncodeObject.filetype = 'mp4'
+        self.command_generate.EncodeObject.encode_suffix = 'DTH'
+        self.command_generate.EncodeObject.resolution = 720
+
+        command = self.command_generate.generate()
+
+        self.assertIn('-c:v copy -c:a copy', ' '.join(command))
+        self.assertNotIn('libx264', command)
+        self.assertNotIn('-vf', command)
+        self.assertNotIn('-crf', command)
+        self.assertIn('faststart', command)
+
+    @data(
+        (None, None, 192, ['libmp3lame', '-b:a', '192k']),
+        ('aac', '128 kb/s', 192, ['libmp3lame', '-b:a', '128k']),
+        ('aac', '256 kb/s', 192, ['libmp3lame', '-b:a', '192k']),
+        ('mp3', '256 kb/s', 192, ['libmp3lame', '-b:a', '192k']),
+        ('mp3', '128 kb/s', 192, ['copy']),
+    )
+    @unpack
+    def test_audio_only(self, mezz_audio_codec, mezz_audio_bitrate, rate_factor, expected_ffcommand):
+        """
+        Tests that audio only encodes copy or cap their bitrate from the source audio.
+        """
+        self.command_generate.EncodeObject.filetype = 'mp3'
+        self.command_generate.EncodeObject.rate_factor = rate_factor
+        self.command_generate.VideoObject.mezz_audio_codec = mezz_audio_codec
+        self.command_generate.VideoObject.mezz_audio_bitrate = mezz_audio_bitrate
+
+        self.command_generate._codec()
+        self.command_generate._passes()
+
+        self.assertEqual(self.command_generate.ffcommand, expected_ffcommand)
+
     @data(
         (
             {
@@ -231,6 +399,24 @@ class CommandGenerateTest(unittest.TestCase):
 
         self.assertEqual(self.command_generate.ffcommand, mock_data.get('expected_ffcommand', []))
 
+    @data(
+        (None, ['-crf', '27']),
+        ('libx265', ['-crf', '27', '-tag:v', 'hvc1']),
+        ('libsvtav1', ['-crf', '27', '-pix_fmt', 'yuv420p']),
+    )
+    @unpack
+    def test_passes_mp4_codecs(self, codec, expected_ffcommand):
+        """
+        Tests that `_passes` adds the container details efficiency codecs need.
+        """
+        self.command_generate.EncodeObject.filetype = 'mp4'
+        self.command_generate.EncodeObject.codec = codec
+        self.command_generate.EncodeObject.rate_factor = 27
+
+        self.command_generate._passes()
+
+        self.assertEqual(self.command_generate.ffcommand, expected_ffcommand)
+
     @data(
         (
             'mp3',
@@ -255,6 +441,24 @@ class CommandGenerateTest(unittest.TestCase):
             100,
             200,
             ['-b:v', '100k', '-minrate', '10k', '-maxrate', '125k', '-bufsize', '76k']
+        ),
+        (
+            'webm',
+            1000,
+            '950 kb/s',
+            ['-b:v', '950k', '-minrate', '10k', '-maxrate', '1187k', '-bufsize', '926k']
+        ),
+        (
+            'webm',
+            1000,
+            '12000 kb/s',
+            ['-b:v', '1000k', '-minrate', '10k', '-maxrate', '1250k', '-bufsize', '976k']
+        ),
+        (
+            'webm',
+            1000,
+            'Unparsed',
+            ['-b:v', '1000k', '-minrate', '10k', '-maxrate', '1250k', '-bufsize', '976k']
         )
     )
     @unpack
@@ -270,6 +474,81 @@ class CommandGenerateTest(unittest.TestCase):
 
         self.assertEqual(self.command_generate.ffcommand, expected_ffcommand)
 
+    @data(
+        (
+            'mp3',
+            {'preset': 'veryfast', 'threads': 2},
+            []
+        ),
+        (
+            'mp4',
+            {},
+            []
+        ),
+        (
+            'mp4',
+            {'preset': 'veryfast', 'tune': 'film', 'keyint': 120, 'threads': 0, 'lookahead': 20},
+            ['-preset', 'veryfast', '-tune', 'film', '-g', '120', '-threads', '0', '-rc-lookahead', '20']
+        ),
+        (
+            'webm',
+            {'preset': 'good', 'keyint': 240, 'lookahead': 16},
+            ['-deadline', 'good', '-g', '240', '-lag-in-frames', '16']
+        ),
+        (
+            'webm',
+            {'preset': 'good', 'threads': 8, 'cpu_used': 4, 'row_mt': 1, 'tile_columns': 2},
+            ['-deadline', 'good', '-threads', '8', '-cpu-used', '4', '-row-mt', '1', '-tile-columns', '2']
+        ),
+        (
+            'mp4',
+            {'cpu_used': 4, 'row_mt': 1, 'tile_columns': 2},
+            []
+        ),
+        (
+            'mp4',
+            {'codec': 'libx265', 'preset': 'medium', 'lookahead': 20},
+            ['-preset', 'medium', '-x265-params', 'rc-lookahead=20']
+        ),
+        (
+            'mp4',
+            {'codec': 'libsvtav1', 'preset': 8, 'keyint': 240, 'lookahead': 32},
+            ['-preset', '8', '-g', '240', '-svtav1-params', 'lookahead=32']
+        )
+    )
+    @unpack
+    def test_tuning(self, file_type, tuning, expected_ffcommand):
+        """
+        Tests that `_tuning` emits profile speed / tuning fields.
+        """
+        self.command_generate.EncodeObject.filetype = file_type
+        for field, value in tuning.items():
+            setattr(self.command_generate.EncodeObject, field, value)
+
+        self.command_generate._tuning()
+
+        self.assertEqual(self.command_generate.ffcommand, expected_ffcommand)
+
+    @data(
+        (None, 'faststart', 100, ['-movflags', 'faststart']),
+        (None, 'reserved', None, ['-movflags', 'faststart']),
+        (None, 'reserved', 100, ['-moov_size', '329536']),
+        ('faststart', 'reserved', 100, ['-movflags', 'faststart']),
+        ('fragmented', 'reserved', 100, ['-movflags', 'frag_keyframe+empty_moov+default_base_moof']),
+    )
+    @unpack
+    def test_moov(self, mp4_mode, mp4_output_mode, mezz_duration, expected_ffcommand):
+        """
+        Tests that `_moov` picks the profile's mp4 mode, falling back to faststart without a duration.
+        """
+        self.command_generate.settings['mp4_output_mode'] = mp4_output_mode
+        self.command_generate.EncodeObject.mp4_mode = mp4_mode
+        self.command_generate.VideoObject.mezz_duration = mezz_duration
+
+        self.command_generate._moov()
+
+        self.assertEqual(self.command_generate.ffcommand, expected_ffcommand)
+
     @data(
         {
             'file_type': 'mp4',
@@ -311,3 +590,33 @@ class CommandGenerateTest(unittest.TestCase):
         self.command_generate._destination()
 
         self.assertEqual(self.command_generate.ffcommand, expected_ffcommand)
+
+    @data(
+        ('mp4', 720, 360),
+        ('mp4', 240, 240),
+        ('webm', 720, None),
+        ('mp3', 0, None),
+    )
+    @unpack
+    def test_preview(self, file_type, resolution, expected_resolution):
+        """
+        Tests that the preview encode keeps the output name, at low resolution and a fast preset.
+        """
+        self.encode.filetype = file_type
+        self.encode.resolution = resolution
+        self.encode.encode_suffix = 'DTH'
+        self.encode.preset = 'slow'
+        self.encode.codec = 'libx265'
+        self.encode.passthrough_max_bitrate = 2500
+
+        preview = self.encode.preview()
+
+        if expected_resolution is None:
+            self.assertIsNone(preview)
+            return
+        self.assertEqual(preview.resolution, expected_resolution)
+        self.assertEqual(preview.encode_suffix, 'DTH')
+        self.assertEqual(preview.filetype, 'mp4')
+        self.assertEqual(preview.preset, 'ultrafast')
+        self.assertIsNone(preview.codec)
+        self.assertIsNone(preview.passthrough_max_bitrate)
@@ -0,0 +1,85 @@
+"""
+Keyframe index tests.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ddt import ddt, data, unpack
+from mock import patch
+
+from video_worker.keyframes import KeyframeIndex, merge_intervals
+from video_worker.video_images import VideoImages
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+TEST_VIDEO = os.path.join(TEST_DATA_DIR, 'test.mp4')
+SETTINGS = {'ffprobe_compiled': 'ffprobe', 'ffmpeg_limits': False, 'keyframe_snap_tolerance': 2}
+
+
+class MockVideo(object):
+    mezz_duration = 16.8
+
+
+@ddt
+class KeyframeIndexTest(unittest.TestCase):
+    """
+    KeyframeIndex tests.
+    """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        # keyframe every 2s (25 fps, gop 50) over 10s
+        self.source = os.path.join(self.workdir, 'source.mp4')
+        subprocess.check_call([
+            'ffmpeg', '-v', 'error', '-y', '-t', '10', '-i', TEST_VIDEO, '-r', '25', '-c:v', 'libx264',
+            '-preset', 'ultrafast', '-g', '50', '-keyint_min', '50', '-sc_threshold', '0', self.source
+        ])
+
+    def test_scan(self):
+        index = KeyframeIndex.scan(self.source)
+
+        self.assertEqual(len(index), 5)
+        for expected, keyframe in zip((0, 2, 4, 6, 8), index.times):
+            self.assertAlmostEqual(keyframe, expected, delta=0.05)
+        self.assertIsNone(KeyframeIndex.scan(os.path.join(self.workdir, 'missing.mp4')))
+
+    def test_bounded_scan(self):
+        """
+        Only the packets of the windows asked for are read (from the keyframe a seek lands on)
+        """
+        index = KeyframeIndex.scan(self.source, intervals=[(4.5, 5.5)])
+
+        self.assertEqual([round(keyframe) for keyframe in index.times], [4])
+
+    @data(
+        (-1.0, 0.0, 0),
+        (0.9, 0.0, 0),
+        (1.1, 2.0, 0),
+        (5.0, 4.0, 2),
+        (42.0, 8.0, 4),
+    )
+    @unpack
+    def test_queries(self, position, nearest, before):
+        index = KeyframeIndex([0.0, 2.0, 4.0, 6.0, 8.0])
+
+        self.assertEqual(index.nearest(position), nearest)
+        self.assertEqual(index.before(position), before)
+        self.assertIsNone(KeyframeIndex([]).nearest(position))
+
+    def test_merge_intervals(self):
+        self.assertEqual(merge_intervals([(5, 7), (-1, 1), (6, 9), (3, 3)]), [(0.0, 1.0), (5.0, 9.0)])
+
+    def test_thumbnail_snapping(self):
+        images = VideoImages(MockVideo, self.workdir, 'source.mp4', settings=SETTINGS, engine=object())
+
+        with patch.object(KeyframeIndex, 'scan', wraps=KeyframeIndex.scan) as mock_scan:
+            self.assertEqual(images.snap_positions([1, 4, 7]), [0.0, 4.0, 6.0])
+        # only the windows within the tolerance of the positions
+        self.assertEqual(mock_scan.call_args[1]['intervals'], [(0.0, 9.0)])
+        # distinct positions, none moved further than the tolerance
+        self.assertEqual(images.snap_positions([3.9, 4.1, 30]), [4.0, 4.1, 30])
+        images.settings = dict(SETTINGS, keyframe_snap_tolerance=0)
+        self.assertEqual(images.snap_positions([1, 4, 7]), [1, 4, 7])
@@ -0,0 +1,151 @@
+"""
+ffmpeg child resource limit tests.
+"""
+
+import os
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from ddt import ddt, data, unpack
+
+from video_worker.limits import (
+    CPU_LIMIT,
+    MEGABYTE,
+    MEMORY_LIMIT,
+    OPEN_FILES_LIMIT,
+    JobCgroup,
+    ResourceLimits
+)
+
+SETTINGS = {
+    'ffmpeg_limits': True,
+    'ffmpeg_memory_base_mb': 1000,
+    'ffmpeg_memory_per_megapixel_mb': 500,
+    'ffmpeg_memory_per_thread_mb': 100,
+    'ffmpeg_cpu_time_min': 600,
+    'ffmpeg_cpu_seconds_per_second': 10,
+    'ffmpeg_open_files': 128,
+}
+
+
+@ddt
+class ResourceLimitsTest(unittest.TestCase):
+    """
+    ResourceLimits tests.
+    """
+    def test_disabled(self):
+        limits = ResourceLimits.for_encode('1920x1080', 600, settings={'ffmpeg_limits': False})
+
+        self.assertFalse(limits)
+        self.assertEqual(limits.popen_kwargs(), {})
+
+    @data(
+        ('1920x1080', 30, 2, 1000 + 2.0736 * 500 + 200, 600),
+        ('1280x720', 3600, 4, 1000 + 0.9216 * 500 + 400, 36000),
+        (None, None, 1, 1000 + 2.1 * 500 + 100, 600),
+    )
+    @unpack
+    def test_for_encode(self, mezz_resolution, mezz_duration, threads, memory_mb, cpu_time):
+        limits = ResourceLimits.for_encode(mezz_resolution, mezz_duration, settings=SETTINGS, threads=threads)
+
+        self.assertEqual(limits.address_space, int(memory_mb * MEGABYTE))
+        self.assertEqual(limits.cpu_time, cpu_time)
+        self.assertEqual(limits.open_files, 128)
+        self.assertIn('preexec_fn', limits.popen_kwargs())
+
+    def test_apply(self):
+        """
+        The limits land on the child only
+        """
+        limits = ResourceLimits(address_space=2048 * MEGABYTE, cpu_time=300, open_files=64)
+        script = (
+            'import resource; print(*[resource.getrlimit(getattr(resource, name))[0] '
+            'for name in ("RLIMIT_AS", "RLIMIT_CPU", "RLIMIT_NOFILE")])'
+        )
+        output = subprocess.check_output([sys.executable, '-c', script], **limits.popen_kwargs())
+
+        self.assertEqual(output.split(), [str(2048 * MEGABYTE).encode(), b'300', b'64'])
+        self.assertNotEqual(resource.getrlimit(resource.RLIMIT_NOFILE)[0], 64)
+
+    def test_apply_to(self):
+        """
+        The limits land on an already started child
+        """
+        limits = ResourceLimits(address_space=2048 * MEGABYTE, cpu_time=300, open_files=64)
+        script = (
+            'import resource, sys; sys.stdin.readline(); print(*[resource.getrlimit(getattr(resource, name))[0] '
+            'for name in ("RLIMIT_AS", "RLIMIT_CPU", "RLIMIT_NOFILE")])'
+        )
+        process = subprocess.Popen(
+            [sys.executable, '-c', script], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        limits.apply_to(process.pid)
+        output, _ = process.communicate(b'\n')
+
+        self.assertEqual(output.split(), [str(2048 * MEGABYTE).encode(), b'300', b'64'])
+        self.assertNotEqual(resource.getrlimit(resource.RLIMIT_NOFILE)[0], 64)
+
+    def test_cpu_limit_hit(self):
+        limits = ResourceLimits(cpu_time=1)
+        process = subprocess.Popen([sys.executable, '-c', 'while True: pass'], **limits.popen_kwargs())
+        process.wait()
+
+        self.assertEqual(process.returncode, -signal.SIGXCPU)
+        self.assertEqual(limits.failure_reason(process.returncode), CPU_LIMIT)
+
+    @data(
+        (0, [], None, None),
+        (1, [], 10, None),
+        (1, [], 299.5, CPU_LIMIT),
+        (-signal.SIGXCPU, [], None, CPU_LIMIT),
+        (1, ['[libx264 @ 0x55] malloc of size 8294400 failed: Cannot allocate memory'], 10, MEMORY_LIMIT),
+        (1, ['Error opening output file out.mp4: Too many open files'], 10, OPEN_FILES_LIMIT),
+        (-signal.SIGKILL, [], 10, None),
+    )
+    @unpack
+    def test_failure_reason(self, returncode, errors, cpu_time, expected):
+        limits = ResourceLimits(address_space=1024 * MEGABYTE, cpu_time=300, open_files=64)
+
+        self.assertEqual(limits.failure_reason(returncode, errors, cpu_time), expected)
+
+
+class JobCgroupTest(unittest.TestCase):
+    """
+    JobCgroup tests, against a plain directory standing in for a delegated cgroup.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_create(self):
+        cgroup = JobCgroup.create(self.root, 'job-1', memory_max=512 * MEGABYTE, pids_max=64)
+
+        with open(os.path.join(cgroup.path, 'memory.max')) as memory_max:
+            self.assertEqual(memory_max.read(), str(512 * MEGABYTE))
+        with open(os.path.join(cgroup.path, 'pids.max')) as pids_max:
+            self.assertEqual(pids_max.read(), '64')
+        self.assertFalse(cgroup.oom_killed())
+
+        with open(os.path.join(cgroup.path, 'memory.events'), 'w') as events:
+            events.write('low 0\nhigh 0\nmax 3\noom 1\noom_kill 1\n')
+        self.assertTrue(cgroup.oom_killed())
+
+    def test_unavailable(self):
+        self.assertIsNone(JobCgroup.create(os.path.join(self.root, 'missing'), 'job-1', memory_max=1))
+
+    def test_encode_limits_with_cgroup(self):
+        settings = dict(SETTINGS, ffmpeg_cgroup_root=self.root)
+        limits = ResourceLimits.for_encode('1280x720', 60, settings=settings, job='job-2', threads=1)
+
+        self.assertIsNotNone(limits.cgroup)
+        # memory is held by memory.max, not the address space rlimit
+        self.assertIsNone(limits.address_space)
+
+        with open(os.path.join(limits.cgroup.path, 'memory.events'), 'w') as events:
+            events.write('oom_kill 2\n')
+        self.assertEqual(limits.failure_reason(-signal.SIGKILL), MEMORY_LIMIT)
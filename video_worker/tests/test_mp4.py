@@ -0,0 +1,142 @@
+"""
+MP4 box reader tests.
+"""
+
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+
+from ddt import ddt, data, unpack
+from mock import patch
+
+from video_worker.abstractions import Video
+from video_worker.mp4 import read_mp4
+from video_worker.validate import ValidateVideo
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+TEST_VIDEO = os.path.join(TEST_DATA_DIR, 'test.mp4')
+
+
+def box(box_type, payload=b''):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type, version, payload):
+    return box(box_type, struct.pack('>B3x', version) + payload)
+
+
+def synthetic_mp4(edits=(0,), movie_duration=30000, mdat_first=False):
+    """
+    ftyp / moov (one 'vide' track, 1000 timescale) / mdat
+    """
+    elst = full_box(b'elst', 0, struct.pack('>I', len(edits)) + b''.join(
+        struct.pack('>Iii', 1000, media_time, 0x10000) for media_time in edits
+    ))
+    trak = box(b'trak', b''.join([
+        full_box(b'tkhd', 0, struct.pack('>IIIII', 0, 0, 1, 0, movie_duration)),
+        box(b'edts', elst),
+        box(b'mdia', b''.join([
+            full_box(b'mdhd', 0, struct.pack('>IIII', 0, 0, 1000, movie_duration)),
+            full_box(b'hdlr', 0, struct.pack('>I4s', 0, b'vide') + b'\0' * 13),
+        ])),
+    ]))
+    moov = box(b'moov', full_box(b'mvhd', 0, struct.pack('>IIII', 0, 0, 1000, movie_duration)) + trak)
+    mdat = box(b'mdat', b'\0' * 64)
+    return box(b'ftyp', b'isom\0\0\x02\0isom') + (mdat + moov if mdat_first else moov + mdat)
+
+
+@ddt
+class ReadMp4Test(unittest.TestCase):
+    """
+    read_mp4 tests.
+    """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def write(self, name, content):
+        path = os.path.join(self.workdir, name)
+        with open(path, 'wb') as mp4_file:
+            mp4_file.write(content)
+        return path
+
+    def test_test_video(self):
+        info = read_mp4(TEST_VIDEO)
+
+        self.assertEqual(info.major_brand, 'isom')
+        self.assertAlmostEqual(info.duration, 16.8, delta=0.01)
+        self.assertEqual([track.handler for track in info.tracks], ['vide'])
+        self.assertFalse(info.moov_first)
+        self.assertFalse(info.desync)
+
+    @data(
+        ([], False, False),
+        (['-movflags', '+faststart'], True, False),
+        (['-moov_size', '100000'], True, False),
+        (['-movflags', '+frag_keyframe'], True, True),
+    )
+    @unpack
+    def test_moov_modes(self, flags, moov_first, fragmented):
+        product = os.path.join(self.workdir, 'product.mp4')
+        subprocess.check_call(['ffmpeg', '-v', 'error', '-y', '-i', TEST_VIDEO, '-c', 'copy'] + flags + [product])
+
+        info = read_mp4(product)
+
+        self.assertAlmostEqual(info.duration, 16.8, delta=0.1)
+        self.assertEqual(info.moov_first, moov_first)
+        self.assertEqual(info.fragmented, fragmented)
+
+    @data(
+        ((0,), False, False, 30.0),
+        ((-1, 0), False, False, 30.0),
+        ((0, 500), False, True, 30.0),
+        ((0,), True, False, 30.0),
+    )
+    @unpack
+    def test_synthetic(self, edits, mdat_first, desync, duration):
+        info = read_mp4(self.write('synthetic.mp4', synthetic_mp4(edits=edits, mdat_first=mdat_first)))
+
+        self.assertEqual(info.duration, duration)
+        self.assertEqual(info.moov_first, not mdat_first)
+        self.assertEqual(info.desync, desync)
+        self.assertEqual(info.tracks[0].track_id, 1)
+
+    def test_unknown_layouts(self):
+        with open(TEST_VIDEO, 'rb') as video:
+            truncated = video.read(os.path.getsize(TEST_VIDEO) // 2)
+
+        for content in (truncated, synthetic_mp4(movie_duration=0), b'ID3\x03' + b'\0' * 100, b''):
+            self.assertIsNone(read_mp4(self.write('unknown.mp4', content)))
+        self.assertIsNone(read_mp4(os.path.join(self.workdir, 'missing.mp4')))
+
+
+class Mp4ValidationTest(unittest.TestCase):
+    """
+    ValidateVideo mp4 backend tests.
+    """
+    def setUp(self):
+        self.video = Video()
+        self.video.mezz_duration = 16.8
+
+    @patch('video_worker.validate.probe_file')
+    def test_product_without_probe(self, mock_probe_file):
+        validator = ValidateVideo(TEST_VIDEO, VideoObject=self.video, product_file=True)
+
+        self.assertTrue(validator.valid)
+        self.assertIsNotNone(validator.mp4)
+        self.assertFalse(mock_probe_file.called)
+
+    @patch('video_worker.validate.read_mp4')
+    def test_fallback(self, mock_read_mp4):
+        mock_read_mp4.return_value = None
+        validator = ValidateVideo(TEST_VIDEO, VideoObject=self.video, product_file=True)
+
+        self.assertTrue(validator.valid)
+        self.assertIsNotNone(validator.probe)
+
+    def test_duration_mismatch(self):
+        self.video.mezz_duration = 60
+        self.assertFalse(ValidateVideo(TEST_VIDEO, VideoObject=self.video, product_file=True).valid)
@@ -0,0 +1,213 @@
+"""
+Multipart upload tests.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import boto
+from boto.exception import S3ResponseError
+from ddt import ddt, data, unpack
+from mock import Mock, patch
+from moto import mock_s3_deprecated
+
+from boto.s3.multipart import MultiPartUpload
+from video_worker.multipart import (
+    MEGABYTE,
+    MIN_PART_SIZE,
+    MultipartUpload,
+    abort_abandoned_states,
+    part_size_for
+)
+
+BUCKET = 'multipart-bucket'
+
+
+@ddt
+class MultipartUploadTest(unittest.TestCase):
+    """
+    MultipartUpload tests.
+    """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.content = os.urandom(11 * MEGABYTE + 17)
+        self.filepath = os.path.join(self.workdir, 'product.mp4')
+        with open(self.filepath, 'wb') as product:
+            product.write(self.content)
+        self.state_path = os.path.join(self.workdir, 'product.mp4.upload.json')
+
+    def connect(self):
+        return boto.connect_s3().lookup(BUCKET)
+
+    def upload(self, **kwargs):
+        kwargs.setdefault('state_path', self.state_path)
+        return MultipartUpload(
+            self.filepath, 'product.mp4', self.connect, part_size=MIN_PART_SIZE, concurrency=1, backoff=0, **kwargs
+        )
+
+    @data(
+        (0, 16 * MEGABYTE, 16 * MEGABYTE),
+        (0, MEGABYTE, MIN_PART_SIZE),
+        (100000 * MEGABYTE, 5 * MEGABYTE, 10 * MEGABYTE),
+    )
+    @unpack
+    def test_part_size_for(self, filesize, part_size, expected):
+        self.assertEqual(part_size_for(filesize, part_size), expected)
+
+    @mock_s3_deprecated
+    def test_upload(self):
+        bucket = boto.connect_s3().create_bucket(BUCKET)
+        upload = MultipartUpload(self.filepath, 'product.mp4', self.connect, part_size=MIN_PART_SIZE, concurrency=1)
+
+        self.assertTrue(upload.run())
+        self.assertEqual(upload.parts, 3)
+        self.assertEqual(upload.hash_sum, hashlib.md5(self.content).hexdigest())
+        self.assertEqual(bucket.get_key('product.mp4').get_contents_as_string(), self.content)
+        # nothing but the product in the workdir
+        self.assertEqual(os.listdir(self.workdir), ['product.mp4'])
+
+    @mock_s3_deprecated
+    def test_failed_part(self):
+        bucket = boto.connect_s3().create_bucket(BUCKET)
+        upload = self.upload(state_path=None)
+
+        with patch.object(MultipartUpload, '_upload_part', side_effect=S3ResponseError(500, 'InternalError')):
+            self.assertFalse(upload.run())
+
+        self.assertIsNone(upload.hash_sum)
+        self.assertIsNone(bucket.get_key('product.mp4'))
+        # nothing to resume from: aborted
+        self.assertEqual(bucket.get_all_multipart_uploads(), [])
+
+    @mock_s3_deprecated
+    def test_part_retry(self):
+        bucket = boto.connect_s3().create_bucket(BUCKET)
+        upload_part = MultiPartUpload.upload_part_from_file
+        failures = []
+
+        def flaky(self, fp, part_num, **kwargs):
+            if part_num == 2 and not failures:
+                failures.append(part_num)
+                raise S3ResponseError(503, 'SlowDown')
+            return upload_part(self, fp, part_num, **kwargs)
+
+        upload = self.upload()
+        with patch.object(MultiPartUpload, 'upload_part_from_file', new=flaky):
+            self.assertTrue(upload.run())
+
+        self.assertEqual(upload.part_retries, 1)
+        self.assertEqual(bucket.get_key('product.mp4').get_contents_as_string(), self.content)
+        self.assertFalse(os.path.exists(self.state_path))
+
+    @mock_s3_deprecated
+    def test_resume(self):
+        """
+        A part failing past its retries leaves the upload open; the next attempt resumes it
+        """
+        bucket = boto.connect_s3().create_bucket(BUCKET)
+        upload_part = MultiPartUpload.upload_part_from_file
+
+        def failing(self, fp, part_num, **kwargs):
+            if part_num == 2:
+                raise S3ResponseError(500, 'InternalError')
+            return upload_part(self, fp, part_num, **kwargs)
+
+        first = self.upload(retries=1)
+        with patch.object(MultiPartUpload, 'upload_part_from_file', new=failing):
+            self.assertFalse(first.run())
+        with open(self.state_path) as state_file:
+            state = json.load(state_file)
+        self.assertEqual(list(state['parts']), ['1'])
+        self.assertEqual([upload.id for upload in bucket.get_all_multipart_uploads()], [state['upload_id']])
+
+        second = self.upload()
+        self.assertTrue(second.run())
+
+        self.assertEqual(second.resumed_parts, 1)
+        self.assertEqual(second.parts, 3)
+        self.assertEqual(second.hash_sum, hashlib.md5(self.content).hexdigest())
+        self.assertEqual(bucket.get_key('product.mp4').get_contents_as_string(), self.content)
+        self.assertEqual(bucket.get_all_multipart_uploads(), [])
+        self.assertFalse(os.path.exists(self.state_path))
+
+    @mock_s3_deprecated
+    def test_abort_stale(self):
+        """
+        An upload of a different product, and old uploads of the key, are aborted
+        """
+        bucket = boto.connect_s3().create_bucket(BUCKET)
+        stale = bucket.initiate_multipart_upload('product.mp4')
+        abandoned = bucket.initiate_multipart_upload('product.mp4')
+        with open(self.state_path, 'w') as state_file:
+            json.dump({
+                'key_name': 'product.mp4', 'upload_id': stale.id, 'filesize': 1, 'part_size': MIN_PART_SIZE, 'parts': {}
+            }, state_file)
+
+        upload = self.upload(abandon_after=-60)
+        self.assertTrue(upload.run())
+
+        self.assertEqual(upload.resumed_parts, 0)
+        self.assertNotIn(abandoned.id, [other.id for other in bucket.get_all_multipart_uploads()])
+        self.assertEqual(bucket.get_all_multipart_uploads(), [])
+
+    @mock_s3_deprecated
+    def test_state_not_stored(self):
+        """
+        An upload whose state can not be written is aborted: nothing could resume it
+        """
+        bucket = boto.connect_s3().create_bucket(BUCKET)
+        upload = self.upload(state_path=os.path.join(self.workdir, 'missing', 'product.mp4.upload.json'))
+
+        self.assertFalse(upload.run())
+        self.assertEqual(bucket.get_all_multipart_uploads(), [])
+
+    @mock_s3_deprecated
+    def test_abort_abandoned_states(self):
+        bucket = boto.connect_s3().create_bucket(BUCKET)
+        abandoned = bucket.initiate_multipart_upload('product.mp4')
+        recent = bucket.initiate_multipart_upload('other.mp4')
+        for key_name, upload_id, age in (('product.mp4', abandoned.id, 7200), ('other.mp4', recent.id, 0)):
+            state_path = os.path.join(self.workdir, key_name + '.upload.json')
+            with open(state_path, 'w') as state_file:
+                json.dump({'key_name': key_name, 'upload_id': upload_id}, state_file)
+            os.utime(state_path, (time.time() - age, time.time() - age))
+
+        self.assertEqual(abort_abandoned_states(self.workdir, self.connect, abandon_after=3600), 1)
+
+        self.assertEqual([upload.id for upload in bucket.get_all_multipart_uploads()], [recent.id])
+        self.assertEqual(sorted(os.listdir(self.workdir)), ['other.mp4.upload.json', 'product.mp4'])
+
+    def test_concurrency(self):
+        """
+        Parts go out concurrently, never more than `concurrency` at once, each read from its offset
+        """
+        parts = {}
+        in_flight = []
+        lock = threading.Lock()
+
+        def upload_part(upload, upload_id, part_number, data, md5):
+            with lock:
+                in_flight.append(part_number)
+                parts[part_number] = (data, len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.remove(part_number)
+
+        bucket = Mock(**{'get_all_multipart_uploads.return_value': []})
+        upload = MultipartUpload(self.filepath, 'product.mp4', lambda: bucket, part_size=MIN_PART_SIZE, concurrency=2)
+        with patch.object(MultipartUpload, '_upload_part', new=upload_part):
+            self.assertTrue(upload.run())
+
+        self.assertEqual(b''.join(parts[number][0] for number in sorted(parts)), self.content)
+        self.assertEqual(max(concurrent for _, concurrent in parts.values()), 2)
+        self.assertTrue(bucket.initiate_multipart_upload.return_value.complete_upload.called)
+
+    def test_no_bucket(self):
+        self.assertFalse(MultipartUpload(self.filepath, 'product.mp4', lambda: None).run())
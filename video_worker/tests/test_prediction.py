@@ -0,0 +1,144 @@
+"""
+Encode time prediction tests.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ddt import ddt, data, unpack
+from mock import patch
+
+from video_worker.celeryapp import app, encode_time_prediction
+from video_worker.prediction import (
+    MIN_FIT_RECORDS,
+    EncodeHistory,
+    EncodeTimeModel,
+    features,
+    history_key,
+    predict_encode_time
+)
+
+
+def _record(duration, resolution='1280x720', bitrate='3000 kb/s', cpu_count=4, encode_time=None):
+    record = features(duration, resolution, bitrate, cpu_count)
+    record['profile'] = 'desktop_mp4'
+    if encode_time is None:
+        # 2s flat + 0.1 per source second + 0.2 per source second per megapixel
+        encode_time = 2.0 + 0.1 * duration + 0.2 * duration * (record['source_width'] * record['source_height']) / 1e6
+    record['encode_time'] = encode_time
+    return record
+
+
+@ddt
+class EncodeTimeModelTest(unittest.TestCase):
+    """
+    EncodeTimeModel tests.
+    """
+    def test_no_history(self):
+        self.assertIsNone(EncodeTimeModel([]).predict(60))
+
+    def test_no_duration(self):
+        self.assertIsNone(EncodeTimeModel([_record(60)]).predict(None))
+
+    def test_ratio_fallback(self):
+        """
+        Below MIN_FIT_RECORDS the median seconds per source second is used
+        """
+        records = [_record(100, encode_time=50), _record(10, encode_time=5), _record(20, encode_time=40)]
+        model = EncodeTimeModel(records)
+        self.assertIsNone(model.coefficients)
+        self.assertEqual(model.predict(60), 30.0)
+
+    @data(
+        (300, '1280x720'),
+        (1800, '1920x1080'),
+        (45, '640x360'),
+    )
+    @unpack
+    def test_fit(self, duration, resolution):
+        """
+        The fit recovers the encode time relationship it was trained on
+        """
+        records = []
+        for index in range(MIN_FIT_RECORDS * 3):
+            size = ['640x360', '1280x720', '1920x1080'][index % 3]
+            records.append(_record(30 + index * 97 % 1200, resolution=size))
+        model = EncodeTimeModel(records)
+        self.assertIsNotNone(model.coefficients)
+        expected = _record(duration, resolution=resolution)['encode_time']
+        self.assertAlmostEqual(model.predict(duration, resolution, '3000 kb/s', 4), expected, delta=expected * 0.01)
+
+    def test_unknown_inputs(self):
+        """
+        Missing resolution / bitrate fall back to the history's medians
+        """
+        records = [_record(30 + index * 60) for index in range(MIN_FIT_RECORDS)]
+        model = EncodeTimeModel(records)
+        self.assertAlmostEqual(model.predict(600, None, None, 4), _record(600)['encode_time'], delta=1.0)
+
+
+class EncodeHistoryTest(unittest.TestCase):
+    """
+    EncodeHistory tests.
+    """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.history_file = os.path.join(self.workdir, 'encode_history.jsonl')
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def test_missing_file(self):
+        self.assertEqual(EncodeHistory(self.history_file).records('desktop_mp4'), [])
+        self.assertIsNone(predict_encode_time(self.history_file, 'desktop_mp4', 60))
+
+    def test_roundtrip(self):
+        history = EncodeHistory(self.history_file)
+        history.record('desktop_mp4', 60.0, '1280x720', '3000 kb/s', 30.0, cpu_count=4)
+        history.record('mobile_low', 60.0, '1280x720', '3000 kb/s', 6.0, cpu_count=4)
+        with open(self.history_file, 'a') as history_file:
+            history_file.write('{not json\n')
+
+        records = history.records('desktop_mp4')
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['source_width'], 1280)
+        self.assertEqual(records[0]['source_kbps'], 3000)
+        self.assertEqual(records[0]['encode_time'], 30.0)
+        self.assertEqual(predict_encode_time(self.history_file, 'desktop_mp4', 120), 60.0)
+        self.assertEqual(predict_encode_time(self.history_file, 'mobile_low', 120), 12.0)
+
+    def test_remux_history(self):
+        """
+        Stream copy remuxes are timed apart from the profile's encodes
+        """
+        history = EncodeHistory(self.history_file)
+        encode = ['ffmpeg', '-i', 'source.mov', '-c:v', 'libx264', 'out.mp4']
+        remux = ['ffmpeg', '-i', 'source.mov', '-c:v', 'copy', 'out.mp4']
+        history.record(history_key('desktop_mp4', encode), 60.0, '1280x720', '3000 kb/s', 30.0)
+        history.record(history_key('desktop_mp4', remux), 60.0, '1280x720', '3000 kb/s', 1.0)
+
+        self.assertEqual(history_key('desktop_mp4', remux), 'desktop_mp4_remux')
+        self.assertEqual(predict_encode_time(self.history_file, 'desktop_mp4', 120), 60.0)
+        self.assertEqual(predict_encode_time(self.history_file, 'desktop_mp4_remux', 120), 2.0)
+
+    def test_prediction_task(self):
+        """
+        The prediction is available before the job is queued
+        """
+        EncodeHistory(self.history_file).record('desktop_mp4', 60.0, '1280x720', '3000 kb/s', 30.0)
+        EncodeHistory(self.history_file).record('desktop_mp4_remux', 60.0, '1280x720', '3000 kb/s', 1.0)
+
+        with patch('video_worker.celeryapp.ENCODE_HISTORY_FILE', self.history_file):
+            self.assertEqual(encode_time_prediction('desktop_mp4', 120), 60.0)
+            self.assertEqual(encode_time_prediction('desktop_mp4', 120, '1280x720', remux=True), 2.0)
+            self.assertIsNone(encode_time_prediction('mobile_low', 120))
+
+    def test_prediction_queue(self):
+        """
+        Predictions never wait behind an encode, and their results outlive the round trip
+        """
+        route = app.amqp.router.route({}, encode_time_prediction.name)
+
+        self.assertEqual(route['queue'].name, 'prediction_worker')
+        self.assertEqual(encode_time_prediction.expires, 60)
+        self.assertEqual(app.conf.result_expires, 3600)
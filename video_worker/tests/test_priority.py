@@ -0,0 +1,96 @@
+"""
+CPU / IO priority class tests.
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+from ddt import ddt, data, unpack
+from mock import patch
+
+from video_worker.celeryapp import worker_task_fire
+from video_worker.priority import BULK, INTERACTIVE, apply_priority, priority_classes, priority_for_queue
+
+SETTINGS = {
+    'queue_priority_classes': {'encode_worker': INTERACTIVE, 'encode_worker_hls': BULK},
+}
+
+
+@ddt
+class PriorityTest(unittest.TestCase):
+    """
+    Priority class tests.
+    """
+    @data(
+        ('encode_worker', {}, INTERACTIVE),
+        ('encode_worker_hls', {}, BULK),
+        ('other_queue', {}, None),
+        ('other_queue', {'default_priority_class': 'normal'}, 'normal'),
+        (None, {}, None),
+    )
+    @unpack
+    def test_priority_for_queue(self, queue, extra_settings, expected):
+        self.assertEqual(priority_for_queue(queue, settings=dict(SETTINGS, **extra_settings)), expected)
+
+    def test_priority_classes_setting(self):
+        classes = priority_classes(settings={'priority_classes': {'backfill': {'nice': 15, 'ionice_class': 'idle'}}})
+
+        self.assertEqual(classes['backfill']['nice'], 15)
+        self.assertEqual(classes[BULK]['nice'], 19)
+
+    @patch('video_worker.priority.os.setpriority')
+    def test_unknown_class(self, mock_setpriority):
+        self.assertFalse(apply_priority('urgent', settings=SETTINGS))
+        self.assertFalse(apply_priority(None, settings=SETTINGS))
+        self.assertFalse(mock_setpriority.called)
+
+    def test_apply(self):
+        """
+        Applied in a child process: nice and io priority carry over to what it spawns next
+        """
+        script = (
+            'import os, subprocess, sys; '
+            'from video_worker.priority import apply_priority; '
+            'apply_priority("bulk", settings={"priority_classes": {}}); '
+            'subprocess.check_call([sys.executable, "-c", "import os; print(os.getpriority(os.PRIO_PROCESS, 0))"]); '
+            'subprocess.check_call(["ionice", "-p", str(os.getpid())])'
+        )
+        output = subprocess.check_output(
+            [sys.executable, '-c', script],
+            cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+            universal_newlines=True
+        )
+
+        nice, io = output.splitlines()
+        self.assertEqual(nice, '19')
+        self.assertEqual(io, 'idle')
+        self.assertNotEqual(os.getpriority(os.PRIO_PROCESS, 0), 19)
+
+
+@ddt
+class WorkerTaskPriorityTest(unittest.TestCase):
+    """
+    worker_task_fire priority class tests.
+    """
+    @data(
+        ('encode_worker_hls', None, '--priority bulk'),
+        ('encode_worker', None, '--priority interactive'),
+        ('encode_worker', BULK, '--priority bulk'),
+        ('other_queue', None, None),
+    )
+    @unpack
+    @patch('video_worker.celeryapp.settings', SETTINGS)
+    @patch('video_worker.celeryapp.os.system')
+    def test_priority_class(self, queue, priority_class, expected, mock_system):
+        worker_task_fire.push_request(delivery_info={'routing_key': queue})
+        self.addCleanup(worker_task_fire.pop_request)
+
+        worker_task_fire('veda-id', 'desktop_mp4', 'job-id', priority_class=priority_class)
+
+        task_command = mock_system.call_args[0][0]
+        if expected is None:
+            self.assertNotIn('--priority', task_command)
+        else:
+            self.assertIn(expected, task_command)
@@ -0,0 +1,189 @@
+"""
+Cached json probe tests.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ddt import ddt, data, unpack
+from mock import patch
+
+from video_worker import probe
+from video_worker.engines import CLIEngine
+from video_worker.probe import ProbeResult, ProbeStats, clear_cache, fast_probe, probe_file
+from video_worker.validate import ValidateVideo
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+TEST_VIDEO = os.path.join(TEST_DATA_DIR, 'test.mp4')
+SETTINGS = {'ffmpeg_compiled': 'ffmpeg', 'ffprobe_compiled': 'ffprobe'}
+
+FFPROBE_DATA = {
+    'streams': [
+        {'codec_type': 'video', 'codec_name': 'mjpeg', 'width': 300, 'height': 300,
+         'disposition': {'attached_pic': 1}},
+        {'codec_type': 'video', 'codec_name': 'h264', 'pix_fmt': 'yuv420p', 'width': 1280, 'height': 720,
+         'disposition': {'attached_pic': 0}},
+        {'codec_type': 'audio', 'codec_name': 'aac', 'bit_rate': '128000'},
+    ],
+    'format': {
+        'format_name': 'mov,mp4,m4a,3gp,3g2,mj2', 'duration': '61.250000', 'size': '1000', 'bit_rate': '2500000'
+    },
+}
+
+
+@ddt
+class ProbeResultTest(unittest.TestCase):
+    """
+    ProbeResult tests.
+    """
+    def test_from_ffprobe(self):
+        result = ProbeResult.from_ffprobe('video.mp4', FFPROBE_DATA)
+
+        self.assertEqual(result.duration, 61.25)
+        self.assertEqual(result.resolution, '1280x720')
+        self.assertEqual(result.video_codec, 'h264')
+        self.assertEqual(result.pix_fmt, 'yuv420p')
+        self.assertEqual(result.bitrate, '2500 kb/s')
+        self.assertEqual(result.audio_codec, 'aac')
+        self.assertEqual(result.audio_bitrate, '128 kb/s')
+        self.assertFalse(result.desync)
+
+    def test_from_ffprobe_no_duration(self):
+        result = ProbeResult.from_ffprobe(
+            'video.mp4',
+            {'streams': [], 'format': {'duration': '0.000000'}},
+            '[mov,mp4,m4a,3gp,3g2,mj2 @ 0x1] multiple edit list entries, a/v desync might occur'
+        )
+
+        self.assertIsNone(result.duration)
+        self.assertIsNone(result.resolution)
+        self.assertTrue(result.desync)
+
+    @data(
+        ({}, '', False),
+        ({'format': {'duration': 'N/A'}}, '', True),
+        ({'streams': [{'codec_type': 'video', 'codec_name': 'h264', 'width': 1280, 'height': 720}]}, '', True),
+        ({}, '[mp3 @ 0x1] Estimating duration from bitrate, this may be inaccurate', True),
+        ({}, "[mpegts @ 0x1] Could not find codec parameters for stream 1 (Audio: aac, 0 channels): "
+             "unspecified sample format\nConsider increasing the value for the 'analyzeduration' (0) and "
+             "'probesize' (32) options", True),
+    )
+    @unpack
+    def test_ambiguous(self, override, warnings, expected):
+        probe_data = dict(FFPROBE_DATA, **override)
+        if 'duration' in probe_data['format']:
+            probe_data['format'] = dict(FFPROBE_DATA['format'], **probe_data['format'])
+        self.assertEqual(ProbeResult.from_ffprobe('video.mp4', probe_data, warnings).ambiguous(), expected)
+
+
+class ProbeFileTest(unittest.TestCase):
+    """
+    probe_file cache tests.
+    """
+    def setUp(self):
+        clear_cache()
+        self.addCleanup(clear_cache)
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.video = os.path.join(self.workdir, 'video.mp4')
+        shutil.copy(TEST_VIDEO, self.video)
+        self.engine = CLIEngine(settings=SETTINGS)
+
+    def test_single_probe(self):
+        """
+        Validation and attribute reads of the same file share one ffprobe
+        """
+        with patch('video_worker.engines.ffprobe', wraps=probe.ffprobe) as mock_ffprobe:
+            validator = ValidateVideo(self.video, engine=self.engine)
+            attributes = validator.get_video_attributes()
+            self.assertIs(probe_file(self.video, self.engine), validator.probe)
+
+        self.assertEqual(mock_ffprobe.call_count, 1)
+        self.assertTrue(validator.valid)
+        self.assertEqual(attributes['filesize'], os.stat(self.video).st_size)
+        self.assertEqual(attributes['resolution'], '450x450')
+
+    def test_changed_file(self):
+        first = probe_file(self.video, self.engine)
+        with open(self.video, 'ab') as video:
+            video.write(b'\0' * 16)
+
+        second = probe_file(self.video, self.engine)
+        self.assertIsNot(first, second)
+        self.assertEqual(second.filesize, first.filesize + 16)
+
+    def test_unreadable(self):
+        with open(self.video, 'w') as video:
+            video.write('not a video')
+
+        self.assertIsNone(probe_file(self.video, self.engine))
+        self.assertIsNone(probe_file(os.path.join(self.workdir, 'missing.mp4'), self.engine))
+
+
+class FastProbeTest(unittest.TestCase):
+    """
+    Bounded probe / escalation tests.
+    """
+    def setUp(self):
+        probe.stats.reset()
+        self.addCleanup(probe.stats.reset)
+
+    def test_conclusive(self):
+        result = fast_probe(TEST_VIDEO, probesize=65536, analyzeduration=100000)
+
+        self.assertAlmostEqual(result.duration, 16.8, delta=0.1)
+        self.assertEqual(probe.stats.escalations, 0)
+        self.assertEqual(probe.stats.fast_probes, 1)
+
+    @patch('video_worker.probe.ffprobe')
+    def test_escalation(self, mock_ffprobe):
+        bounded = ProbeResult.from_ffprobe('video.ts', FFPROBE_DATA, 'Estimating duration from bitrate')
+        full = ProbeResult.from_ffprobe('video.ts', FFPROBE_DATA)
+        mock_ffprobe.side_effect = [bounded, full]
+
+        self.assertIs(fast_probe('video.ts', probesize=65536, analyzeduration=100000), full)
+        self.assertEqual(mock_ffprobe.call_args_list[0][1]['probesize'], 65536)
+        self.assertNotIn('probesize', mock_ffprobe.call_args_list[1][1])
+        self.assertEqual(probe.stats.escalations, 1)
+
+    def test_calibration(self):
+        history_file = os.path.join(tempfile.mkdtemp(), 'probe_history.jsonl')
+        self.addCleanup(shutil.rmtree, os.path.dirname(history_file))
+        with patch.object(probe.stats, 'history_file', history_file):
+            result = fast_probe(TEST_VIDEO, probesize=65536, analyzeduration=100000, calibrate_every=1)
+
+            self.assertAlmostEqual(result.duration, 16.8, delta=0.1)
+            self.assertEqual((probe.stats.fast_probes, probe.stats.calibrations), (1, 1))
+            self.assertIsNotNone(probe.stats.mean_saving())
+            self.assertIn('probe_time_saved', probe.stats.metrics())
+
+    def test_metrics(self):
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        stats = ProbeStats(os.path.join(workdir, 'probe_history.jsonl'))
+        self.assertEqual(stats.metrics(), {})
+
+        stats.record(fast_time=0.5, full_time=2.0)
+        for _ in range(3):
+            stats.record(fast_time=0.5)
+        metrics = stats.metrics()
+
+        self.assertEqual(metrics['probe_count'], 4)
+        self.assertEqual(metrics['probe_escalations'], 1)
+        self.assertEqual(metrics['probe_escalation_rate'], 0.25)
+        self.assertEqual(metrics['probe_time'], 4.0)
+        # nothing measured on this node yet: unavailable, not left out
+        self.assertIsNone(metrics['probe_time_saved'])
+
+        stats.record(fast_time=0.5, full_time=3.0, calibration=True)
+        metrics = stats.metrics()
+
+        self.assertEqual(metrics['probe_time'], 7.5)
+        # 4 bounded probes saving 2.5s each (measured), minus the 0.5s spent before escalating
+        # and the 3s calibration
+        self.assertEqual(metrics['probe_time_saved'], 6.5)
+        self.assertEqual(metrics['probe_time_saved_per_probe'], 1.3)
+        # the saving is kept per node, for the next jobs
+        self.assertEqual(ProbeStats(stats.history_file).mean_saving(), 2.5)
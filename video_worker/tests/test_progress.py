@@ -0,0 +1,127 @@
+"""
+ffmpeg progress parser tests.
+"""
+
+import io
+import unittest
+
+from ddt import ddt, data, unpack
+from mock import Mock, patch
+
+from video_worker.progress import ProgressParser, ProgressLog
+
+FFMPEG_OUTPUT = """Input #0, mov,mp4,m4a,3gp,3g2,mj2, from 'in.mp4':
+  Duration: 00:00:10.00, start: 0.000000, bitrate: 3101 kb/s
+  Stream #0:0[0x1](und): Video: h264 (High) (avc1 / 0x31637661), yuv420p, 1280x720, 2900 kb/s, 30 fps
+frame=0
+fps=0.00
+stream_0_0_q=0.0
+bitrate=  -0.0kbits/s
+total_size=0
+out_time_us=-9223372036854775807
+out_time_ms=-9223372036854775807
+out_time=-577014:32:22.775807
+dup_frames=0
+drop_frames=0
+speed=N/A
+progress=continue
+[h264 @ 0x55d0] error while decoding MB 12 4, bytestream -5
+frame=150
+fps=75.00
+stream_0_0_q=20.0
+bitrate=7100.5kbits/s
+total_size=4431000
+out_time_us=5000000
+out_time_ms=5000000
+out_time=00:00:05.000000
+dup_frames=0
+drop_frames=0
+speed=2.5x
+progress=continue
+frame=  300 fps= 75 q=-1.0 Lsize=    8862kB time=00:00:10.00 bitrate=7100.5kbits/s speed=2.5x
+frame=300
+fps=75.00
+bitrate=7100.5kbits/s
+total_size=8862000
+out_time_us=10000000
+out_time=00:00:10.000000
+speed=2.5x
+progress=end
+[libx264 @ 0x55e0] kb/s:6994.38
+"""
+
+
+@ddt
+class ProgressParserTest(unittest.TestCase):
+    """
+    Test class for ProgressParser.
+    """
+
+    def test_run(self):
+        """
+        Tests that progress blocks become events and stderr lines are kept apart.
+        """
+        listener = Mock()
+        parser = ProgressParser().subscribe(listener)
+
+        parser.run(io.StringIO(FFMPEG_OUTPUT))
+
+        self.assertEqual(parser.events, 3)
+        self.assertEqual(listener.call_count, 3)
+        self.assertEqual(parser.duration, 10.0)
+        self.assertEqual(parser.errors, ['[h264 @ 0x55d0] error while decoding MB 12 4, bytestream -5'])
+
+        first = listener.call_args_list[0][0][1]
+        self.assertIsNone(first.out_time)
+        self.assertIsNone(first.speed)
+        self.assertEqual(first.marker, 0)
+
+        event = parser.last_event
+        self.assertTrue(event.end)
+        self.assertEqual(event.frame, 300)
+        self.assertEqual(event.fps, 75.0)
+        self.assertEqual(event.speed, 2.5)
+        self.assertEqual(event.bitrate, 7100.5)
+        self.assertEqual(event.out_time, 10.0)
+        self.assertEqual(event.total_size, 8862000)
+
+    @data(
+        ('out_time_us=2500000', 25.0),
+        ('out_time_us=N/A', None),
+    )
+    @unpack
+    def test_percent(self, out_time_line, expected):
+        """
+        Tests that progress percentage is out_time relative to the duration.
+        """
+        parser = ProgressParser(duration=10)
+        parser.feed(out_time_line)
+        parser.feed('progress=continue')
+        self.assertEqual(parser.percent(), expected)
+
+    @data(
+        (FFMPEG_OUTPUT.replace('[h264 @ 0x55d0] error while decoding MB 12 4, bytestream -5\n', ''), None, None),
+        (FFMPEG_OUTPUT, None, '1 error lines'),
+        (FFMPEG_OUTPUT.split('frame=300')[0], None, 'no end of stream'),
+        (FFMPEG_OUTPUT.replace('[h264 @ 0x55d0] error while decoding MB 12 4, bytestream -5\n', ''), 30,
+         'out_time 10.0 for a 30s source'),
+    )
+    @unpack
+    def test_incomplete(self, output, duration, expected):
+        """
+        Tests that only a clean, ended stream of the right length vouches for the output.
+        """
+        parser = ProgressParser().run(io.StringIO(output))
+        self.assertEqual(parser.incomplete(duration=duration), expected)
+
+    @patch('video_worker.progress.logger')
+    def test_log_rate_limited(self, mock_logger):
+        """
+        Tests that progress logging is rate limited, but the end is always logged.
+        """
+        parser = ProgressParser(duration=10).subscribe(ProgressLog('test', interval=3600))
+
+        parser.run(io.StringIO(FFMPEG_OUTPUT))
+
+        self.assertEqual(mock_logger.info.call_count, 2)
+        self.assertIn('100%', mock_logger.info.call_args[0][0])
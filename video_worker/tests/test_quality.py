@@ -0,0 +1,75 @@
+"""
+Sampled quality scoring tests.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from video_worker.probe import ProbeResult
+from video_worker.quality import ASPECT_MISMATCH, MAX_PSNR, NO_VIDEO, OVER_BUDGET, QualityScore
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+TEST_VIDEO = os.path.join(TEST_DATA_DIR, 'test.mp4')
+SETTINGS = {'ffmpeg_compiled': 'ffmpeg', 'ffmpeg_limits': False}
+
+
+def probe_result(filepath, width=450, height=450, duration=16.8):
+    return ProbeResult(filepath, width=width, height=height, duration=duration)
+
+
+class QualityScoreTest(unittest.TestCase):
+    """
+    QualityScore tests.
+    """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def test_identical(self):
+        quality = QualityScore(probe_result(TEST_VIDEO), probe_result(TEST_VIDEO), SETTINGS, windows=2)
+        quality.run()
+        metrics = quality.metrics()
+
+        self.assertEqual(metrics['quality_windows'], 2)
+        self.assertEqual(metrics['quality_psnr'], MAX_PSNR)
+        self.assertEqual(metrics['quality_ssim'], 1.0)
+
+    def test_scaled_product(self):
+        """
+        A low bitrate, downscaled product scores below the source, against the upscaled-to-match source
+        """
+        product = os.path.join(self.workdir, 'product.mp4')
+        subprocess.check_call([
+            'ffmpeg', '-v', 'error', '-y', '-t', '4', '-i', TEST_VIDEO,
+            '-vf', 'scale=224:224', '-c:v', 'libx264', '-crf', '40', '-preset', 'ultrafast', product
+        ])
+        quality = QualityScore(probe_result(product, 224, 224, 4.0), probe_result(TEST_VIDEO), SETTINGS, windows=2)
+        quality.run()
+        metrics = quality.metrics()
+
+        self.assertEqual(metrics['quality_windows'], 2)
+        self.assertLess(metrics['quality_psnr'], 40)
+        self.assertLess(metrics['quality_ssim'], 0.99)
+        self.assertLessEqual(metrics['quality_psnr_min'], metrics['quality_psnr'])
+
+    def test_unscorable(self):
+        letterboxed = QualityScore(probe_result('product.mp4', 1280, 720), probe_result(TEST_VIDEO), SETTINGS)
+        audio = QualityScore(probe_result('product.mp3', None, None), probe_result(TEST_VIDEO), SETTINGS)
+
+        for quality, reason in ((letterboxed, ASPECT_MISMATCH), (audio, NO_VIDEO)):
+            self.assertEqual(quality.run(), [])
+            self.assertEqual(quality.metrics(), {'quality_skipped': reason})
+
+    def test_budget(self):
+        """
+        With the encode's own speed, not even one window fits a tiny budget
+        """
+        quality = QualityScore(
+            probe_result(TEST_VIDEO), probe_result(TEST_VIDEO), SETTINGS, budget=0.5, encode_ratio=2.0
+        )
+
+        self.assertEqual(quality.run(), [])
+        self.assertEqual(quality.metrics(), {'quality_skipped': OVER_BUDGET})
@@ -3,6 +3,7 @@ This file tests the working of Video Worker.
 """
 
 
+import io
 import os
 import unittest
 
@@ -13,6 +14,7 @@ from mock import Mock, patch
 from video_worker import VideoWorker, logger as video_worker_logger, deliverable_route
 from video_worker.abstractions import Video
 from video_worker.global_vars import ENCODE_WORK_DIR
+from video_worker.progress import ProgressParser
 from video_worker.utils import get_config
 
 worker_settings = get_config()
@@ -215,7 +217,7 @@ class VideoWorkerTest(unittest.TestCase):
         ),
         (
             {
-                'ffcommand': 'dummy-ffcommand',
+                'ffcommand': ['dummy-ffcommand'],
                 'generate_encode_mock_called': True,
                 'validate_encode_mock_called': True,
                 'execute_encode_mock_called': True
@@ -223,7 +225,7 @@ class VideoWorkerTest(unittest.TestCase):
         ),
         (
             {
-                'ffcommand': 'dummy-ffcommand',
+                'ffcommand': ['dummy-ffcommand'],
                 'is_encoded': True,
                 'generate_encode_mock_called': True,
                 'validate_encode_mock_called': True,
@@ -251,6 +253,110 @@ class VideoWorkerTest(unittest.TestCase):
         self.assertEqual(validate_encode_mock.called, mock_data.get('validate_encode_mock_called', False))
         self.assertEqual(deliver_file_mock.called, mock_data.get('deliver_file_mock_called', False))
 
+    @data(
+        (False, ()),
+        (True, ({'preview': True},)),
+    )
+    @unpack
+    @patch.object(deliverable_route, 'apply_async')
+    def test_route_deliverable(self, preview, extra_args, route_mock):
+        """
+        Test that only a preview carries the preview kwarg; the full encode is routed as before.
+        """
+        self.VW.settings = worker_settings
+        self.VW.veda_id = 'dummy-veda-id'
+        self.VW.encode_profile = 'desktop_mp4'
+
+        self.VW._route_deliverable(preview=preview)
+
+        route_mock.assert_called_once_with(
+            ('dummy-veda-id', 'desktop_mp4'), *extra_args, queue=worker_settings['celery_deliver_queue']
+        )
+
+    @data(
+        ('[mp4 @ 0x1] reserved_moov_size is too small, needed 1019 additional', 2, ['-movflags', 'faststart']),
+        ('[out#0/mp4 @ 0x1] Error writing trailer: Invalid argument', 1, ['-moov_size', '100']),
+    )
+    @unpack
+    @patch.object(VideoWorker, '_deliver_file')
+    @patch.object(VideoWorker, '_validate_encode')
+    @patch.object(VideoWorker, '_execute_encode')
+    def test_moov_retry(self, error_line, encodes, moov_flags, execute_encode_mock, validate_encode_mock,
+                        deliver_file_mock):
+        """
+        Test that an encode whose reserved moov space was too small is redone with faststart.
+        """
+        self.VW.ffcommand = 'ffmpeg -i in.mp4 -c:v libx264 -moov_size 100 -write_tmcd off out.mp4'.split()
+
+        def execute_encode():
+            self.VW.progress = ProgressParser()
+            if execute_encode_mock.call_count == 1:
+                self.VW.progress.feed(error_line)
+
+        execute_encode_mock.side_effect = execute_encode
+        with patch.object(VideoWorker, '_generate_encode'):
+            self.VW._static_pipeline()
+
+        self.assertEqual(execute_encode_mock.call_count, encodes)
+        self.assertEqual(self.VW.ffcommand[5:7], moov_flags)
+
+    @data(
+        (True, True, True, 2),
+        (True, False, True, 2),
+        (False, False, True, 1),
+        (True, True, False, 2),
+    )
+    @unpack
+    @patch('video_worker.UpdateAPIStatus')
+    @patch.object(deliverable_route, 'apply_async')
+    @patch.object(VideoWorker, '_deliver_file')
+    @patch.object(VideoWorker, '_validate_encode')
+    @patch.object(VideoWorker, '_execute_encode')
+    @patch('video_worker.CommandGenerate.generate')
+    def test_static_pipeline_preview(self, preview_encoded, preview_delivered, full_delivered, expected_deliveries,
+                                     generate_mock, execute_encode_mock, validate_encode_mock, deliver_file_mock,
+                                     route_mock, update_api_mock):
+        """
+        Test that preview-first delivers and routes the preview before the full encode replaces it.
+        """
+        self.VW.preview = True
+        self.VW.encode_profile = 'desktop_mp4'
+        self.VW.settings = worker_settings
+        self.VW.encoding = Mock(preview=Mock(return_value=Mock()))
+        generate_mock.return_value = 'ffmpeg -i in.mp4 -c:v libx264 -preset ultrafast /dummy-work-dir/out.mp4'.split()
+
+        def generate_encode(worker):
+            worker.ffcommand = 'ffmpeg -i in.mp4 -c:v libx264 -preset slow /dummy-work-dir/out.mp4'.split()
+
+        def validate():
+            self.VW.encoded = preview_encoded if execute_encode_mock.call_count == 1 else True
+
+        def deliver():
+            self.VW.delivered = preview_delivered if execute_encode_mock.call_count == 1 else full_delivered
+            self.VW.endpoint_url = '/dummy-endpoint-url' if self.VW.delivered else None
+
+        validate_encode_mock.side_effect = validate
+        deliver_file_mock.side_effect = deliver
+
+        with patch.object(VideoWorker, '_generate_encode', new=generate_encode):
+            self.VW._static_pipeline()
+
+        self.assertEqual(execute_encode_mock.call_count, 2)
+        self.assertIn('ultrafast', execute_encode_mock.call_args_list[0][1]['ffcommand'])
+        self.assertEqual(execute_encode_mock.call_args_list[1][1], {})
+        self.assertEqual(deliver_file_mock.call_count, expected_deliveries)
+        # only the preview is routed here (flagged as such), the full encode is routed by run()
+        self.assertEqual(route_mock.call_count, 1 if preview_delivered else 0)
+        if preview_delivered:
+            self.assertEqual(route_mock.call_args[0][1], {'preview': True})
+        self.assertEqual(self.VW.delivered, full_delivered)
+        self.assertEqual(self.VW.endpoint_url, '/dummy-endpoint-url' if full_delivered else None)
+        # a preview left in place of a failed full encode is reported as a failed transcode
+        replaced = full_delivered or not preview_delivered
+        self.assertEqual(update_api_mock.called, not replaced)
+        if not replaced:
+            self.assertEqual(update_api_mock.call_args[1]['veda_video_status'], 'Transcode Error')
+
     @patch('os.path.exists')
     @patch('os.chdir')
     def test_hls_pipeline(self, mock_chdir, mock_exists):
@@ -380,7 +486,7 @@ class VideoWorkerTest(unittest.TestCase):
 
     @data(
         ('', ''),
-        ('video/mp4', 'dummy-ffcommand')
+        ('video/mp4', ['dummy-ffcommand'])
     )
     @unpack
     @patch('video_worker.generate_encode.CommandGenerate.generate')
@@ -430,14 +536,16 @@ class VideoWorkerTest(unittest.TestCase):
             }
         )
     )
+    @patch('subprocess.Popen')
     @patch('os.path.exists')
     @patch.object(video_worker_logger, 'error')
-    def test_execute_encode(self, mock_data, mock_logger, mock_exists):
+    def test_execute_encode(self, mock_data, mock_logger, mock_exists, mock_popen):
         """
         Test that `_execute_encode` method worrks correctly.
         """
         expected_output_file = 'dummy-outfile'
-        self.VW.ffcommand = '/dummy/test/path/ffcommand-outfile'
+        mock_popen.return_value = Mock(stdout=io.StringIO(''), returncode=1)
+        self.VW.ffcommand = ['ffmpeg', '/dummy/test/path/ffcommand-outfile']
         mock_exists.side_effect = mock_data.get('path_exists', [False, False])
 
         self.assertEqual(self.VW.output_file, expected_output_file)
@@ -449,6 +557,90 @@ class VideoWorkerTest(unittest.TestCase):
 
         expected_output_file = 'ffcommand-outfile' if len(mock_data.get('path_exists', [])) else expected_output_file
         self.assertEqual(self.VW.output_file, expected_output_file)
+        if mock_popen.called:
+            self.assertEqual(mock_popen.call_args[0][0], self.VW.ffcommand)
+            self.assertNotIn('shell', mock_popen.call_args[1])
+
+    @patch('subprocess.Popen')
+    @patch('os.path.exists')
+    @patch.object(video_worker_logger, 'error')
+    def test_execute_encode_launch_error(self, mock_logger, mock_exists, mock_popen):
+        """
+        Test that an ffmpeg which cannot be started fails the encode.
+        """
+        mock_exists.return_value = True
+        mock_popen.side_effect = OSError(2, 'No such file or directory')
+        self.VW.ffcommand = ['/missing/ffmpeg', '/dummy/test/path/ffcommand-outfile']
+
+        self.VW._execute_encode()
+
+        mock_logger.assert_called_with(': XXXXXXXX2016-V00TEST Encode failed: [Errno 2] No such file or directory')
+        self.assertIsNone(self.VW.output_file)
+
+    @patch('subprocess.Popen')
+    @patch('os.remove')
+    @patch('os.path.exists')
+    @patch('video_worker.EncodeWatchdog')
+    @patch.object(video_worker_logger, 'error')
+    def test_execute_encode_watchdog(self, mock_logger, mock_watchdog, mock_exists, mock_remove, mock_popen):
+        """
+        Test that an encode killed by the watchdog drops its partial output.
+        """
+        mock_watchdog.return_value.start.return_value.tripped = 'stalled'
+        mock_exists.return_value = True
+        mock_popen.return_value = Mock(stdout=io.StringIO(''), returncode=-15)
+        self.VW.ffcommand = ['ffmpeg', '/dummy/test/path/ffcommand-outfile']
+
+        self.VW._execute_encode()
+
+        mock_logger.assert_called_with(': XXXXXXXX2016-V00TEST Encode failed: ffmpeg stalled, killed')
+        mock_remove.assert_called_with('/dummy-work-dir/ffcommand-outfile')
+        self.assertIsNone(self.VW.output_file)
+
+    @data(
+        (0, 'progress=end', 'progress', True),
+        (1, 'progress=end', 'probe', False),
+        (0, 'progress=continue', 'probe', False),
+    )
+    @unpack
+    @patch('video_worker.validate.ValidateVideo.validate')
+    @patch('os.stat')
+    @patch('os.path.exists')
+    def test_validate_encode_progress(self, returncode, last_line, validated_by, is_valid, mock_exists, mock_stat,
+                                      mock_valid):
+        """
+        Tests that a clean progress stream validates the encode without probing it.
+        """
+        mock_exists.return_value = True
+        mock_stat.return_value = Mock(st_size=1000)
+        mock_valid.return_value = False
+        self.VW.settings = dict(worker_settings, progress_validation=True, decode_check=False)
+        self.VW.VideoObject.mezz_duration = 10
+        self.VW.encode_returncode = returncode
+        self.VW.progress = ProgressParser()
+        for line in ('frame=300', 'out_time_us=10000000', last_line):
+            self.VW.progress.feed(line)
+
+        self.VW._validate_encode()
+
+        self.assertEqual(self.VW.metrics['validated_by'], validated_by)
+        self.assertEqual(mock_valid.called, validated_by == 'probe')
+        self.assertEqual(self.VW.encoded, is_valid)
+
+    def test_score_quality(self):
+        """
+        Tests `_score_quality` puts the sampled scores in the job metrics.
+        """
+        self.VW.workdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+        self.VW.source_file = 'test.mp4'
+        self.VW.output_file = 'test.mp4'
+        self.VW.settings = dict(worker_settings, quality_windows=2, quality_budget_percent=None)
+        self.VW.metrics['encode_time'] = 10.0
+
+        self.VW._score_quality()
+
+        self.assertEqual(self.VW.metrics['quality_windows'], 2)
+        self.assertEqual(self.VW.metrics['quality_ssim'], 1.0)
 
     @data(True, False)
     @patch('video_worker.validate.ValidateVideo.validate')
@@ -502,3 +694,4 @@ class VideoWorkerTest(unittest.TestCase):
         self.assertTrue(self.VW.delivered)
         self.assertIsNotNone(self.VW.endpoint_url)
         self.assertEqual(self.VW.endpoint_url, '/dummy-endpoint-url')
+
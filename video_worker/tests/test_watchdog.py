@@ -0,0 +1,79 @@
+"""
+Encode watchdog tests.
+"""
+
+import subprocess
+import time
+import unittest
+
+from ddt import ddt, data, unpack
+from mock import Mock
+
+from video_worker.watchdog import EncodeWatchdog, STALLED, TIME_LIMIT
+
+
+@ddt
+class EncodeWatchdogTest(unittest.TestCase):
+    """
+    Test class for EncodeWatchdog.
+    """
+
+    @data(
+        (None, None, 1000, None),
+        (10, None, 5, None),
+        (10, None, 11, STALLED),
+        (None, 60, 59, None),
+        (None, 60, 61, TIME_LIMIT),
+        (10, 60, 61, TIME_LIMIT),
+    )
+    @unpack
+    def test_check(self, stall_timeout, time_limit, elapsed, expected):
+        """
+        Tests that `check` reports stalls and the hard time limit.
+        """
+        watchdog = EncodeWatchdog(Mock(), stall_timeout=stall_timeout, time_limit=time_limit)
+        self.assertEqual(watchdog.check(now=watchdog.started + elapsed), expected)
+
+    def test_progress_resets_stall(self):
+        """
+        Tests that only an advancing progress marker resets the stall clock.
+        """
+        watchdog = EncodeWatchdog(Mock(), stall_timeout=10)
+        watchdog.last_progress = watchdog.started - 100
+
+        watchdog.progress(None)
+        self.assertEqual(watchdog.check(), STALLED)
+
+        watchdog.progress('120')
+        self.assertIsNone(watchdog.check())
+
+        watchdog.last_progress = watchdog.started - 100
+        watchdog.progress('120')
+        self.assertEqual(watchdog.check(), STALLED)
+
+    def test_kills_stalled_process_group(self):
+        """
+        Tests that a stalled child (and its shell) is killed and the reason recorded.
+        """
+        process = subprocess.Popen('sleep 60; echo done', shell=True, start_new_session=True)
+        watchdog = EncodeWatchdog(process, stall_timeout=0.2, poll_interval=0.05).start()
+
+        start = time.time()
+        process.wait()
+        watchdog.stop()
+
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(watchdog.tripped, STALLED)
+        self.assertNotEqual(process.returncode, 0)
+
+    def test_leaves_finished_process(self):
+        """
+        Tests that a process finishing in time is left alone.
+        """
+        process = subprocess.Popen('true', shell=True, start_new_session=True)
+        watchdog = EncodeWatchdog(process, stall_timeout=5, time_limit=5, poll_interval=0.05).start()
+        process.wait()
+        watchdog.stop()
+
+        self.assertIsNone(watchdog.tripped)
+        self.assertEqual(process.returncode, 0)
@@ -7,8 +7,9 @@ but will catch ~0.95 of them
 
 This should do some basic testing on the intake or generated file:
     - general file test (exists, size > 0)
-    - ffmpeg test (compatible, duration > 0)
+    - ffmpeg test (compatible, duration > 0), from the mp4 boxes for mp4 / m4a products (see mp4.py)
     - duration test (if not mezz, is equal to mezz)
+    - deep (optional): sampled, parallel decode check (see decode_check.py)
 
 FUTURE:
     - size/score ratio
@@ -18,16 +19,20 @@ FUTURE:
 
 import logging
 import os
-import subprocess
 import sys
 
-from .reporting import Output
+from .decode_check import DecodeCheck
+from .engines import get_engine
+from .mp4 import read_mp4
+from .probe import probe_file
 from video_worker.utils import get_config
 
 settings = get_config()
 
 logger = logging.getLogger(__name__)
 
+MP4_EXTENSIONS = ('.mp4', '.m4a')
+
 
 class ValidateVideo:
 
@@ -35,6 +40,18 @@ class ValidateVideo:
         self.filepath = filepath
         self.VideoObject = VideoObject
         self.product_file = kwargs.get('product_file', False)
+        # fast_probe: True / False overrides the `fast_probe` setting (bounded probe, see probe.py)
+        fast_probe = kwargs.get('fast_probe', None)
+        self.engine = kwargs.get('engine', None) or get_engine(
+            settings=settings if fast_probe is None else dict(settings, fast_probe=fast_probe)
+        )
+        # ProbeResult, shared with every other reader of this file (see probe.py),
+        # or for mp4 / m4a products the Mp4Info of the box reader (see mp4.py)
+        self.probe = None
+        self.mp4 = None
+        # sampled decode check of the file (deep validation), DecodeCheck once run
+        self.deep = kwargs.get('deep', False)
+        self.decode_check = None
         self.valid = self.validate()
 
     def validate(self):
@@ -60,45 +77,29 @@ class ValidateVideo:
             return False
 
         """
-        ffprobe file information
+        probe file information: box reader for mp4 / m4a products, ffprobe otherwise
+        (or when the boxes are not understood)
         """
-        ffcommand = 'ffprobe -hide_banner '
-        ffcommand += '\"' + self.filepath + '\"'
-
-        p = subprocess.Popen(
-            ffcommand,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            shell=True
-        )
-
-        for line in iter(p.stdout.readline, b''):
-            line = line.decode('utf-8')
-            if 'No such file or directory' in line:
-                return False
-
-            if 'Invalid data found when processing input' in line:
-                return False
-
-            if "multiple edit list entries, a/v desync might occur, patch welcome" in line:
+        if self.product_file and settings.get('mp4_box_validation', True) and \
+                os.path.splitext(self.filepath)[1].lower() in MP4_EXTENSIONS:
+            self.mp4 = read_mp4(self.filepath)
+        if self.mp4 is not None:
+            desync, duration = self.mp4.desync, self.mp4.duration
+            if not self.mp4.moov_first:
+                logger.warning(': {filepath} moov after mdat, no progressive playback'.format(
+                    filepath=self.filepath
+                ))
+        else:
+            self.probe = probe_file(self.filepath, self.engine)
+            if self.probe is None:
                 return False
+            desync, duration = self.probe.desync, self.probe.duration
 
-            if "Duration: " in line:
-                """Get and Test Duration"""
-                if "Duration: 00:00:00.0" in line:
-                    return False
-                elif "Duration: N/A, " in line:
-                    return False
-
-                vid_duration = line.split('Duration: ')[1].split(',')[0].strip()
-                duration = Output.seconds_from_string(duration=vid_duration)
-
-                if duration < 1.05:
-                    return False
+        if desync:
+            # multiple edit list entries, a/v desync might occur
+            return False
 
-        try:
-            duration
-        except:
+        if duration is None or duration < 1.05:
             return False
 
         """
@@ -109,6 +110,11 @@ class ValidateVideo:
             if not (self.VideoObject.mezz_duration - 5) <= duration <= (self.VideoObject.mezz_duration + 5):
                 return False
 
+        if self.deep:
+            self.decode_check = DecodeCheck(self.filepath, duration, settings)
+            self.decode_check.run()
+            return self.decode_check.valid
+
         return True
 
     def get_video_attributes(self):
@@ -128,47 +134,14 @@ class ValidateVideo:
         # Filesize
         return_dict.setdefault('filesize', os.stat(self.filepath).st_size)
 
-        # ffprobe file information
-        ffcommand = 'ffprobe -hide_banner '
-        ffcommand += '\"' + self.filepath + '\"'
-
-        p = subprocess.Popen(
-            ffcommand,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            shell=True
-        )
+        # probe file information
+        self.probe = probe_file(self.filepath, self.engine)
+        if self.probe is None:
+            return return_dict
+        if self.probe.duration is None:
+            return False
 
-        for line in iter(p.stdout.readline, b''):
-            line = line.decode('utf-8')
-            if "Duration: " in line:
-                # Get duration
-                if "Duration: 00:00:00.0" in line:
-                    return False
-                elif "Duration: N/A, " in line:
-                    return False
-
-                vid_duration = line.split('Duration: ')[1].split(',')[0].strip()
-                return_dict.setdefault(
-                    'duration',
-                    Output.seconds_from_string(duration=vid_duration),
-                )
-            elif "Stream #" in line and 'Video: ' in line:
-                # Resolution
-                codec_array = line.strip().split(',')
-
-                for c in codec_array:
-                    if len(c.split('x')) == 2 and '/' not in c.split('x')[0]:
-                        if '[' not in c:
-                            return_dict.setdefault(
-                                'resolution',
-                                c.strip()
-                            )
-                        else:
-                            return_dict.setdefault(
-                                'resolution',
-                                c.strip().split(' ')[0]
-                            )
+        return_dict.update(self.probe.attributes())
         return return_dict
 
 
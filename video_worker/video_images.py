@@ -7,7 +7,6 @@ import json
 import logging
 import math
 import os
-import subprocess
 from uuid import uuid4
 
 import requests
@@ -17,6 +16,10 @@ from boto.s3.key import Key
 from edx_rest_api_client.client import OAuthAPIClient
 
 from . import generate_apitoken
+from .engines import get_engine
+from .keyframes import KeyframeIndex, merge_intervals
+from .limits import ResourceLimits
+from .probe import probe_file
 from video_worker.utils import get_config
 from video_worker.utils import build_url
 from six.moves import range
@@ -45,6 +48,7 @@ class VideoImages(object):
         self.source_video_file = os.path.join(self.work_dir, self.source_file)
         self.jobid = kwargs.get('jobid', None)
         self.settings = kwargs.get('settings', self.settings_setup())
+        self.engine = kwargs.get('engine', None) or get_engine(settings=self.settings)
 
     def settings_setup(self):
         """
@@ -78,9 +82,35 @@ class VideoImages(object):
         step = math.ceil((video_duration - end - start) / IMAGE_COUNT)
         return [int(start + i * step) for i in range(IMAGE_COUNT)]
 
+    def snap_positions(self, positions):
+        """
+        Move positions onto the source's nearest keyframes (no decode forward from the seek point),
+        where one is within keyframe_snap_tolerance seconds and the positions stay distinct
+        """
+        tolerance = self.settings.get('keyframe_snap_tolerance')
+        if not tolerance:
+            return positions
+        # only the windows the positions can snap within are scanned
+        index = KeyframeIndex.scan(
+            self.source_video_file,
+            ffprobe_path=self.settings.get('ffprobe_compiled', 'ffprobe'),
+            popen_kwargs=ResourceLimits.for_probe(settings=self.settings).popen_kwargs(),
+            intervals=merge_intervals((position - tolerance, position + tolerance) for position in positions)
+        )
+        if not index:
+            return positions
+
+        snapped = []
+        for position in positions:
+            keyframe = index.nearest(position)
+            if abs(keyframe - position) <= tolerance and keyframe not in snapped:
+                position = keyframe
+            snapped.append(position)
+        return snapped
+
     def generate(self):
         """
-        Generate video images using ffmpeg.
+        Generate video images using the media engine.
         """
         if not self.video_object:
             logger.error(
@@ -89,30 +119,22 @@ class VideoImages(object):
             )
             return
 
+        # the local copy's probed duration (cached since intake) over the VEDA record's
+        probe = probe_file(self.source_video_file, self.engine)
+        duration = probe.duration if probe is not None and probe.duration else self.video_object.mezz_duration
+
         generated_images = []
-        for position in self.calculate_positions(self.video_object.mezz_duration):
+        for position in self.snap_positions(self.calculate_positions(duration)):
             generated_images.append(
                 os.path.join(self.work_dir, '{}.png'.format(uuid4().hex))
             )
-            command = ('{ffmpeg} -ss {position} -i {video_file} -y -vf scale={width}:{height}'
-                       ' -vsync 2 -vframes 1 {output_file}'.format(
-                           ffmpeg=self.settings['ffmpeg_compiled'],
-                           position=position,
-                           video_file=self.source_video_file,
-                           width=IMAGE_WIDTH,
-                           height=IMAGE_HEIGHT,
-                           output_file=generated_images[-1]))
-
-            process = subprocess.Popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                shell=True,
-                universal_newlines=True
+            self.engine.extract_frame(
+                self.source_video_file,
+                position,
+                generated_images[-1],
+                IMAGE_WIDTH,
+                IMAGE_HEIGHT
             )
-            stdoutdata, stderrdata = process.communicate()
-            logger.info('executing command >> %s', command)
-            logger.info('command output >> out=%s -- err=%s', stdoutdata, stderrdata)
 
         return_images = []
         for image in generated_images:
@@ -0,0 +1,98 @@
+"""
+Encoder watchdog
+
+A hung ffmpeg would otherwise pin a worker (celery) slot forever;
+this kills the child's process group when
+    - progress (frame / out_time) stops advancing for stall_timeout seconds, or
+    - the encode runs past a hard time_limit
+
+"""
+
+import logging
+import os
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+STALLED = 'stalled'
+TIME_LIMIT = 'time_limit'
+
+
+class EncodeWatchdog(object):
+    """
+    Watch a subprocess started with start_new_session=True (so it leads its own process group)
+    """
+    def __init__(self, process, stall_timeout=None, time_limit=None, **kwargs):
+        self.process = process
+        self.stall_timeout = stall_timeout
+        self.time_limit = time_limit
+        self.poll_interval = kwargs.get('poll_interval', 1.0)
+        self.kill_grace = kwargs.get('kill_grace', 5.0)
+        # reason the process was killed (STALLED / TIME_LIMIT), None if it was left alone
+        self.tripped = None
+        self.started = time.time()
+        self.last_progress = self.started
+        self.last_marker = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, name='encode-watchdog')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def progress(self, marker):
+        """
+        Record a progress marker (frame count, out_time, ...), the stall clock only resets if it moved
+        """
+        if marker is not None and marker != self.last_marker:
+            self.last_marker = marker
+            self.last_progress = time.time()
+
+    def check(self, now=None):
+        """
+        Reason to kill the process now, or None
+        """
+        now = now or time.time()
+        if self.time_limit is not None and now - self.started > self.time_limit:
+            return TIME_LIMIT
+        if self.stall_timeout is not None and now - self.last_progress > self.stall_timeout:
+            return STALLED
+        return None
+
+    def kill(self, reason):
+        """
+        TERM then KILL the whole process group (shell + ffmpeg)
+        """
+        self.tripped = reason
+        logger.error('Encode watchdog: {reason} after {elapsed}s, killing pid {pid}'.format(
+            reason=reason,
+            elapsed=int(time.time() - self.started),
+            pid=self.process.pid
+        ))
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(os.getpgid(self.process.pid), sig)
+            except OSError:
+                return
+            deadline = time.time() + self.kill_grace
+            while time.time() < deadline:
+                if self.process.poll() is not None:
+                    return
+                time.sleep(0.1)
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            if self.process.poll() is not None:
+                return
+            reason = self.check()
+            if reason is not None:
+                self.kill(reason)
+                return